@@ -0,0 +1,287 @@
+"""
+RTB DSP Auction Replay Simulator
+Replays logged auctions through the trained models and clears each bid strategy
+against simulated competing bids, vectorized over whole chunks
+"""
+
+import argparse
+import json
+from time import perf_counter
+
+import numpy as np
+
+from evaluation import format_metric
+
+AUCTION_TYPES = ['first', 'second']
+
+# Competing bids: competition_level + 1 rival bidders per auction, each bidding
+# log-normally around a multiple of the floor price (CPM)
+COMPETITOR_MEDIAN = 1.25
+COMPETITOR_SIGMA = 0.35
+MAX_COMPETITORS = 5
+
+# Counters kept per strategy
+TOTALS = ['auctions', 'bids', 'wins', 'spend', 'clicks', 'conversions', 'expected_clicks', 'expected_conversions']
+
+
+def competing_bids(floor_price, competition_level, rng, median=COMPETITOR_MEDIAN, sigma=COMPETITOR_SIGMA):
+    """Highest rival bid (CPM) per auction"""
+    n = len(floor_price)
+    rivals = np.clip(np.asarray(competition_level, dtype=np.intp) + 1, 1, MAX_COMPETITORS)
+    
+    # exp() is monotonic, so take the max over standard normals and transform once
+    draws = rng.standard_normal((n, MAX_COMPETITORS), dtype=np.float32)
+    draws[np.arange(MAX_COMPETITORS) >= rivals[:, None]] = -np.inf
+    best = draws.max(axis=1).astype(np.float64)
+    return np.asarray(floor_price, dtype=np.float64) * median * np.exp(sigma * best)
+
+
+def clear(bids, floor_price, rival_bid, auction_type='second'):
+    """Win mask and clearing price (CPM) per auction
+    
+    A bid wins if it meets the floor and beats the highest rival. First price
+    pays the bid; second price pays the larger of the rival bid and the floor.
+    """
+    wins = (bids >= floor_price) & (bids > rival_bid)
+    if auction_type == 'first':
+        price = bids
+    elif auction_type == 'second':
+        price = np.maximum(rival_bid, floor_price)
+    else:
+        raise ValueError(f"Unknown auction type: {auction_type}")
+    return wins, np.where(wins, price, 0.0)
+
+
+def value_bidder(conversion_value=1.0):
+    """Bid the expected value per thousand impressions: pCTR * pCVR * value * 1000"""
+    def bid(auctions):
+        return auctions['ctr'] * auctions['cvr'] * (conversion_value * 1000)
+    return bid
+
+
+def shaded_bidder(bidder, shading=0.8):
+    """Bid a fixed fraction of another bidder's bid (first-price bid shading)"""
+    def bid(auctions):
+        return bidder(auctions) * shading
+    return bid
+
+
+class Strategy:
+    """A named bid function over a chunk of auctions, optionally capped by a budget
+    
+    bid receives a dict of column arrays (the dataset's columns plus the
+    models' 'ctr' and 'cvr') and returns one CPM bid per auction; bids below
+    the floor sit the auction out. With a budget (in dollars) the strategy
+    is exhausted at the first auction, in replay order, whose price would
+    take its spend past the budget; it sits out that auction and every later
+    one, so totals do not depend on how the replay is chunked.
+    """
+    
+    def __init__(self, name, bid, budget=None):
+        self.name = name
+        self.bid = bid
+        self.budget = budget
+        self.exhausted = False
+        self.totals = dict.fromkeys(TOTALS, 0)
+    
+    def run(self, auctions, rival_bid, auction_type):
+        """Clear one chunk and fold it into the totals"""
+        bids = np.asarray(self.bid(auctions), dtype=np.float64)
+        wins, price = clear(bids, auctions['floor_price'], rival_bid, auction_type)
+        cost = price / 1000
+        bidding = bids >= auctions['floor_price']
+        
+        if self.budget is not None:
+            # Spend only grows, so the affordable auctions are a prefix in
+            # replay order; a cut inside this chunk ends all later ones too
+            if self.exhausted:
+                affordable = np.zeros(len(bids), dtype=bool)
+            else:
+                affordable = np.cumsum(cost) <= self.budget - self.totals['spend']
+                self.exhausted = not affordable.all()
+            bidding &= affordable
+            wins &= affordable
+            cost = np.where(affordable, cost, 0.0)
+        
+        totals = self.totals
+        totals['auctions'] += len(bids)
+        totals['bids'] += int(bidding.sum())
+        totals['wins'] += int(wins.sum())
+        totals['spend'] += float(cost.sum())
+        totals['clicks'] += int(auctions['clicked'][wins].sum())
+        totals['conversions'] += int(auctions['converted'][wins].sum())
+        totals['expected_clicks'] += float(auctions['ctr'][wins].sum())
+        totals['expected_conversions'] += float((auctions['ctr'] * auctions['cvr'])[wins].sum())
+    
+    def results(self, conversion_value=1.0):
+        """Totals plus the rates derived from them"""
+        totals = self.totals
+        wins, spend = totals['wins'], totals['spend']
+        value = totals['conversions'] * conversion_value
+        return dict(
+            totals,
+            budget=self.budget,
+            exhausted=self.exhausted,
+            win_rate=wins / totals['auctions'] if totals['auctions'] else 0.0,
+            avg_cpm=spend * 1000 / wins if wins else None,
+            ctr=totals['clicks'] / wins if wins else None,
+            cpc=spend / totals['clicks'] if totals['clicks'] else None,
+            cpa=spend / totals['conversions'] if totals['conversions'] else None,
+            value=value,
+            roi=(value - spend) / spend if spend else None,
+        )
+
+
+class AuctionSimulator:
+    """Replay auctions: score each chunk once, draw rival bids once, clear every strategy
+    
+    All strategies see the same predictions and the same rival bids, so
+    their differences come from the bid functions alone.
+    """
+    
+    def __init__(self, bundle, strategies, auction_type='second', seed=42,
+                 competitor_median=COMPETITOR_MEDIAN, competitor_sigma=COMPETITOR_SIGMA):
+        if auction_type not in AUCTION_TYPES:
+            raise ValueError(f"Unknown auction type: {auction_type}")
+        self.bundle = bundle
+        self.strategies = strategies
+        self.auction_type = auction_type
+        self.rng = np.random.default_rng(seed)
+        self.competitor_median = competitor_median
+        self.competitor_sigma = competitor_sigma
+        self.timings = {'score': 0.0, 'clear': 0.0}
+        self.auctions = 0
+    
+    def columns(self):
+        """Dataset columns a replay reads"""
+        columns = list(self.bundle.feature_columns)
+        for name in ('floor_price', 'competition_level', 'clicked', 'converted'):
+            if name not in columns:
+                columns.append(name)
+        return columns
+    
+    def run_chunk(self, chunk):
+        """Score and clear one dict of column arrays"""
+        start = perf_counter()
+        X = np.column_stack([chunk[name] for name in self.bundle.feature_columns]).astype(np.float32)
+        ctr, cvr, _ = self.bundle.score(X)
+        auctions = {name: np.asarray(column) for name, column in chunk.items()}
+        auctions['ctr'], auctions['cvr'] = np.asarray(ctr, dtype=np.float64), np.asarray(cvr, dtype=np.float64)
+        auctions['floor_price'] = auctions['floor_price'].astype(np.float64)
+        auctions['clicked'] = auctions['clicked'] > 0
+        auctions['converted'] = auctions['converted'] > 0
+        scored = perf_counter()
+        
+        rival_bid = competing_bids(auctions['floor_price'], auctions['competition_level'], self.rng,
+                                   self.competitor_median, self.competitor_sigma)
+        for strategy in self.strategies:
+            strategy.run(auctions, rival_bid, self.auction_type)
+        
+        self.timings['score'] += scored - start
+        self.timings['clear'] += perf_counter() - scored
+        self.auctions += len(X)
+    
+    def run(self, data_path, chunk_size=200000, max_auctions=None):
+        """Replay a CSV file, columnar directory or sharded directory"""
+        from columnar import iter_chunks
+        
+        for chunk in iter_chunks(data_path, self.columns(), chunk_size):
+            if max_auctions is not None:
+                left = max_auctions - self.auctions
+                if left <= 0:
+                    break
+                chunk = {name: column[:left] for name, column in chunk.items()}
+            self.run_chunk(chunk)
+    
+    def results(self, conversion_value=1.0):
+        return {
+            'auction_type': self.auction_type,
+            'auctions': self.auctions,
+            'model_version': self.bundle.version,
+            'engine': self.bundle.engine,
+            'score_auctions_per_sec': self.auctions / self.timings['score'] if self.timings['score'] else None,
+            'clear_auctions_per_sec': self.auctions / self.timings['clear'] if self.timings['clear'] else None,
+            'strategies': {strategy.name: strategy.results(conversion_value) for strategy in self.strategies},
+        }
+
+
+def default_strategies(conversion_value, shading, budget=None):
+    """Value-based, shaded and (with a budget) budget-capped value bidding"""
+    value = value_bidder(conversion_value)
+    strategies = [
+        Strategy('value', value),
+        Strategy(f'shaded_{shading:g}', shaded_bidder(value, shading)),
+    ]
+    if budget is not None:
+        strategies.append(Strategy(f'value_budget_{budget:g}', value, budget=budget))
+    return strategies
+
+
+def print_results(results):
+    print(f"\n{results['auctions']} auctions, {results['auction_type']}-price, "
+          f"model version {results['model_version']} ({results['engine']})")
+    print(f"Scoring: {format_metric(results['score_auctions_per_sec'], '{:,.0f}')} auctions/s, "
+          f"clearing: {format_metric(results['clear_auctions_per_sec'], '{:,.0f}')} auctions/s")
+    
+    print(f"\n{'strategy':<24} {'win_rate':>9} {'wins':>9} {'spend':>11} {'avg_cpm':>8} "
+          f"{'clicks':>7} {'conv':>6} {'cpa':>8} {'roi':>7}")
+    for name, r in results['strategies'].items():
+        print(f"{name:<24} {r['win_rate']:>9.2%} {r['wins']:>9} {r['spend']:>11.2f} "
+              f"{format_metric(r['avg_cpm'], '{:.3f}'):>8} {r['clicks']:>7} {r['conversions']:>6} "
+              f"{format_metric(r['cpa'], '{:.2f}'):>8} {format_metric(r['roi'], '{:.2f}'):>7}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay logged auctions to compare bid strategies offline')
+    parser.add_argument('--data', required=True,
+                        help='auctions to replay: CSV file, columnar directory or sharded directory')
+    parser.add_argument('--model-dir', default='models', help='directory holding the trained models')
+    parser.add_argument('--version', default=None, help='model version to replay with (default: newest)')
+    parser.add_argument('--engine', default='auto', choices=['auto', 'xgboost', 'compiled', 'lookup'],
+                        help='scoring engine, as for MODEL_ENGINE')
+    parser.add_argument('--auction', choices=AUCTION_TYPES, default='second', help='clearing rule')
+    parser.add_argument('--conversion-value', type=float, default=2.0,
+                        help='value of one conversion in dollars, for value bidding and ROI')
+    parser.add_argument('--shading', type=float, default=0.8, help='bid multiplier of the shaded strategy')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='also run value bidding capped at this spend in dollars')
+    parser.add_argument('--competitor-median', type=float, default=COMPETITOR_MEDIAN,
+                        help='median rival bid as a multiple of the floor price')
+    parser.add_argument('--competitor-sigma', type=float, default=COMPETITOR_SIGMA,
+                        help='log-normal spread of rival bids')
+    parser.add_argument('--chunk-size', type=int, default=200000, help='auctions per chunk')
+    parser.add_argument('--max-auctions', type=int, default=None, help='stop after this many auctions')
+    parser.add_argument('--seed', type=int, default=42, help='seed for the rival bids')
+    parser.add_argument('--output', default=None, help='also write the results as JSON to this path')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    
+    print("="*60)
+    print("RTB DSP Auction Replay Simulator")
+    print("="*60)
+    
+    from model_store import ModelStore
+    
+    store = ModelStore(args.model_dir, engine=args.engine)
+    bundle = store.load(args.version, warm=False) if args.version else store.active
+    
+    simulator = AuctionSimulator(
+        bundle, default_strategies(args.conversion_value, args.shading, args.budget),
+        auction_type=args.auction, seed=args.seed,
+        competitor_median=args.competitor_median, competitor_sigma=args.competitor_sigma
+    )
+    simulator.run(args.data, args.chunk_size, args.max_auctions)
+    results = simulator.results(args.conversion_value)
+    print_results(results)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+RTB DSP Binary Batch Protocol
+Packed float32 request/response bodies for /predict/batch
+
+Request:  header (magic, rows, columns) + rows x columns float32, row-major,
+          columns in feature_columns order (derived features included)
+Response: header (magic, rows, 3) + ctr, cvr and performance_score as three
+          contiguous float32 arrays of length rows
+All values little-endian.
+"""
+
+import struct
+
+import numpy as np
+
+CONTENT_TYPE = 'application/x-rtb-batch'
+MAGIC = b'RTB1'
+HEADER = struct.Struct('<4sII')
+OUTPUTS = ['ctr', 'cvr', 'performance_score']
+
+
+def _read_header(body):
+    """Validate the header; returns (rows, columns)"""
+    if len(body) < HEADER.size:
+        raise ValueError("Body shorter than the batch header")
+    magic, rows, columns = HEADER.unpack_from(body)
+    if magic != MAGIC:
+        raise ValueError(f"Bad magic {magic!r}, expected {MAGIC!r}")
+    if len(body) != HEADER.size + rows * columns * 4:
+        raise ValueError(f"Body size does not match {rows} x {columns} float32 values")
+    return rows, columns
+
+
+def encode_features(X):
+    """Pack a (rows, columns) feature matrix into a request body"""
+    X = np.ascontiguousarray(X, dtype='<f4')
+    return HEADER.pack(MAGIC, *X.shape) + X.tobytes()
+
+
+def decode_features(body):
+    """Read-only (rows, columns) float32 view over a request body, without copying"""
+    rows, columns = _read_header(body)
+    return np.frombuffer(body, dtype='<f4', offset=HEADER.size).reshape(rows, columns)
+
+
+def encode_scores(ctr, cvr, performance_score):
+    """Pack the three score arrays into a response body"""
+    scores = np.stack([ctr, cvr, performance_score]).astype('<f4')
+    return HEADER.pack(MAGIC, scores.shape[1], len(OUTPUTS)) + scores.tobytes()
+
+
+def decode_scores(body):
+    """Map a response body to {'ctr', 'cvr', 'performance_score'} float32 arrays"""
+    rows, outputs = _read_header(body)
+    scores = np.frombuffer(body, dtype='<f4', offset=HEADER.size).reshape(outputs, rows)
+    return dict(zip(OUTPUTS, scores))
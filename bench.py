@@ -0,0 +1,456 @@
+"""
+RTB DSP Model API Benchmark
+Replay or synthesize bid requests against /predict and /predict/batch and
+report throughput and latency percentiles as JSON; --startup measures cold start instead
+"""
+
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from time import perf_counter
+from urllib.parse import urlsplit
+
+import numpy as np
+
+import batch_protocol
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Regression mode: fields identifying a case, and compared metrics (name, higher is better)
+LOAD_KEY = ('transport', 'endpoint', 'format', 'batch_size', 'concurrency')
+LOAD_METRICS = [('requests_per_s', True), ('p99_ms', False)]
+STARTUP_KEY = ('engine',)
+STARTUP_METRICS = [('import_p50_s', False), ('ready_p50_s', False)]
+
+
+def parse_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Benchmark the CTR/CVR model API')
+    parser.add_argument('--replay', default=None,
+                        help='JSON lines of /predict bodies (or {"requests": [...]} batches) to replay; '
+                             'default: synthetic traffic from RTBDatasetGenerator')
+    parser.add_argument('--num-samples', type=int, default=10000,
+                        help='synthetic bid requests to generate')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--transport', choices=['test-client', 'socket', 'both'], default='both',
+                        help='in-process Flask test client, a real local HTTP socket, or both')
+    parser.add_argument('--url', default=None,
+                        help='socket target such as http://127.0.0.1:5000 (e.g. serve.py); '
+                             'default: an in-process threaded server on a free port')
+    parser.add_argument('--concurrency', type=parse_list, default=[1, 4, 16],
+                        help='comma-separated client thread counts')
+    parser.add_argument('--batch-sizes', type=parse_list, default=[1, 32, 256],
+                        help='comma-separated /predict/batch sizes')
+    parser.add_argument('--formats', default='json,binary',
+                        help='/predict/batch body formats to run: json, binary or both')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='timed /predict requests per case')
+    parser.add_argument('--batch-requests', type=int, default=100,
+                        help='timed /predict/batch requests per case')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='untimed requests before each case')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the in-process response cache on (replayed rows repeat, '
+                             'so by default it is disabled to measure the scoring path)')
+    parser.add_argument('--startup', type=int, default=0,
+                        help='instead of load, time this many cold starts per engine '
+                             '(import model_api, and serve.py launch to a healthy /health)')
+    parser.add_argument('--engines', default='auto,xgboost',
+                        help='comma-separated MODEL_ENGINE values for --startup')
+    parser.add_argument('--output', default=None, help='write results here instead of stdout')
+    parser.add_argument('--baseline', default=None,
+                        help='compare against this earlier output; exits 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed fractional throughput drop before flagging a regression')
+    parser.add_argument('--latency-tolerance', type=float, default=0.25,
+                        help='allowed fractional increase of p99 latency or startup time '
+                             'before flagging a regression')
+    return parser.parse_args()
+
+
+def log(message):
+    # Progress goes to stderr so stdout stays valid JSON
+    print(message, file=sys.stderr, flush=True)
+
+
+# Traffic
+
+def synthetic_traffic(num_samples, seed, request_fields):
+    """Bid request bodies drawn from the training data generator"""
+    from dataset import RTBDatasetGenerator
+    
+    # Fixed window so the same seed always yields the same requests
+    generator = RTBDatasetGenerator(num_samples=num_samples, seed=seed, start_date=datetime(2024, 1, 1))
+    columns = generator.generate_arrays(num_samples, np.random.default_rng(seed), generator.start_date)
+    values = [columns[column].tolist() for _, column, _ in request_fields]
+    keys = [key for key, _, _ in request_fields]
+    return [dict(zip(keys, row)) for row in zip(*values)]
+
+
+def replay_traffic(path, request_fields):
+    """Bid request bodies from a JSON lines capture; other lines are skipped"""
+    keys = {key for key, _, _ in request_fields}
+    traffic = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict):
+                continue
+            for body in record.get('requests', [record]):
+                if isinstance(body, dict) and keys & body.keys():
+                    traffic.append(body)
+    if not traffic:
+        raise ValueError(f"No bid requests found in {path}")
+    return traffic
+
+
+def build_bodies(traffic, batch_size, fmt, feature_columns, build_feature_matrix, count):
+    """Encode `count` request bodies, cycling through the traffic"""
+    rows = itertools.cycle(traffic)
+    bodies = []
+    for _ in range(count):
+        batch = list(itertools.islice(rows, batch_size))
+        if fmt == 'predict':
+            bodies.append(json.dumps(batch[0]).encode())
+        elif fmt == 'json':
+            bodies.append(json.dumps({'requests': batch}).encode())
+        else:
+            X = build_feature_matrix(batch, feature_columns)
+            bodies.append(batch_protocol.encode_features(X))
+    return bodies
+
+
+# Transports
+
+class TestClientTransport:
+    """In-process Flask test client: the WSGI app without any networking"""
+    
+    name = 'test-client'
+    
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+    
+    def request(self, method, path, body=None, content_type=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=body, content_type=content_type)
+        return response.status_code, response.get_data()
+
+
+class SocketTransport:
+    """HTTP over a real TCP socket; one connection per client thread"""
+    
+    name = 'socket'
+    
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.local = threading.local()
+    
+    def request(self, method, path, body=None, content_type=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = {'Content-Type': content_type} if content_type else {}
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            # Reconnect on the next request
+            connection.close()
+            self.local.connection = None
+            raise
+
+
+def start_local_server(app):
+    """Threaded werkzeug server on a free loopback port; returns (host, port)"""
+    from werkzeug.serving import make_server
+    
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return '127.0.0.1', server.server_port
+
+
+# Load generation
+
+def run_case(transport, path, bodies, content_type, concurrency, num_requests, warmup):
+    """Send num_requests bodies from `concurrency` threads; returns the case's measurements"""
+    for i in range(warmup):
+        transport.request('POST', path, bodies[i % len(bodies)], content_type)
+    
+    counter = itertools.count()
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start = threading.Barrier(concurrency + 1)
+    
+    def client(slot):
+        start.wait()
+        while True:
+            i = next(counter)
+            if i >= num_requests:
+                return
+            sent = perf_counter()
+            try:
+                status, _ = transport.request('POST', path, bodies[i % len(bodies)], content_type)
+            except Exception:
+                status = None
+            latencies[slot].append(perf_counter() - sent)
+            if status != 200:
+                errors[slot] += 1
+    
+    threads = [threading.Thread(target=client, args=(slot,)) for slot in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = perf_counter() - began
+    
+    latency_ms = np.concatenate([np.asarray(values) for values in latencies]) * 1000.0
+    p50, p95, p99 = np.percentile(latency_ms, [50, 95, 99])
+    return {
+        'requests': num_requests,
+        'errors': sum(errors),
+        'seconds': round(seconds, 4),
+        'requests_per_s': round(num_requests / seconds, 2),
+        'mean_ms': round(float(latency_ms.mean()), 4),
+        'p50_ms': round(float(p50), 4),
+        'p95_ms': round(float(p95), 4),
+        'p99_ms': round(float(p99), 4),
+        'max_ms': round(float(latency_ms.max()), 4),
+    }
+
+
+def free_port():
+    """A loopback port that is free right now"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def summarize(prefix, values):
+    return {
+        f'{prefix}_min_s': round(min(values), 4),
+        f'{prefix}_p50_s': round(float(np.median(values)), 4),
+        f'{prefix}_max_s': round(max(values), 4),
+    }
+
+
+def measure_startup(engine, runs, timeout=120.0):
+    """Cold starts of one engine: `import model_api` time, and serve.py launch to first healthy /health"""
+    env = dict(os.environ, MODEL_ENGINE=engine, MODEL_WATCH_INTERVAL='0')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+    import_code = 'import time; t = time.perf_counter(); import model_api; print(time.perf_counter() - t)'
+    
+    import_seconds = []
+    ready_seconds = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', import_code], env=env, check=True,
+                                capture_output=True, text=True).stdout
+        import_seconds.append(float(output.split()[-1]))
+        
+        port = free_port()
+        launched = perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, 'serve.py'), '--host', '127.0.0.1',
+             '--port', str(port), '--workers', '1'],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            while True:
+                if perf_counter() - launched > timeout or server.poll() is not None:
+                    raise RuntimeError(f"serve.py ({engine}) did not become healthy")
+                try:
+                    status, _ = SocketTransport('127.0.0.1', port).request('GET', '/health')
+                    if status == 200:
+                        break
+                except OSError:
+                    pass
+                time.sleep(0.005)
+            ready_seconds.append(perf_counter() - launched)
+        finally:
+            server.terminate()
+            server.wait()
+    
+    result = {'engine': engine, 'runs': runs}
+    result.update(summarize('import', import_seconds))
+    result.update(summarize('ready', ready_seconds))
+    return result
+
+
+def run_startup(args):
+    """Startup benchmark: every engine in --engines, --startup launches each"""
+    results = []
+    for engine in args.engines.split(','):
+        result = measure_startup(engine, args.startup)
+        results.append(result)
+        log(f"startup {engine:<9} import p50={result['import_p50_s']:.3f}s  "
+            f"ready p50={result['ready_p50_s']:.3f}s (min {result['ready_min_s']:.3f}s)")
+    return results
+
+
+def run_load(args):
+    """Load benchmark: every transport, endpoint, format, batch size and concurrency"""
+    # Configure the in-process API before it is imported
+    os.environ.setdefault('MODEL_WATCH_INTERVAL', '0')
+    if not args.cache:
+        os.environ['PREDICTION_CACHE_SIZE'] = '0'
+    with contextlib.redirect_stdout(sys.stderr):
+        import model_api
+    
+    if args.replay:
+        traffic = replay_traffic(args.replay, model_api.REQUEST_FIELDS)
+    else:
+        traffic = synthetic_traffic(args.num_samples, args.seed, model_api.REQUEST_FIELDS)
+    
+    transports = []
+    if args.transport in ('test-client', 'both'):
+        transports.append(TestClientTransport(model_api.app))
+    if args.transport in ('socket', 'both'):
+        if args.url:
+            target = urlsplit(args.url)
+            transports.append(SocketTransport(target.hostname, target.port or 80))
+        else:
+            transports.append(SocketTransport(*start_local_server(model_api.app)))
+    
+    formats = args.formats.split(',')
+    results = []
+    servers = {}
+    for transport in transports:
+        # Column order and model identity come from the server under test
+        status, body = transport.request('GET', '/model/info')
+        if status != 200:
+            raise RuntimeError(f"{transport.name}: /model/info returned {status}")
+        info = json.loads(body)
+        feature_columns = info['models']['ctr']['features']
+        servers[transport.name] = {'engine': info['engine'], 'version': info['version']}
+        
+        cases = [('/predict', 'predict', 1, args.requests)]
+        cases += [
+            ('/predict/batch', fmt, batch_size, args.batch_requests)
+            for batch_size in args.batch_sizes for fmt in formats
+        ]
+        for path, fmt, batch_size, num_requests in cases:
+            bodies = build_bodies(
+                traffic, batch_size, fmt, feature_columns, model_api.build_feature_matrix,
+                min(num_requests, max(1, len(traffic) // batch_size))
+            )
+            content_type = batch_protocol.CONTENT_TYPE if fmt == 'binary' else 'application/json'
+            for concurrency in args.concurrency:
+                result = {
+                    'transport': transport.name,
+                    'endpoint': path,
+                    'format': fmt,
+                    'batch_size': batch_size,
+                    'concurrency': concurrency,
+                }
+                result.update(run_case(transport, path, bodies, content_type, concurrency,
+                                       num_requests, args.warmup))
+                result['rows_per_s'] = round(result['requests_per_s'] * batch_size, 2)
+                results.append(result)
+                log(f"{transport.name:<11} {path:<15} {fmt:<7} batch={batch_size:<5} "
+                    f"c={concurrency:<3} {result['requests_per_s']:>9.1f} req/s  "
+                    f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms errors={result['errors']}")
+    return results, servers
+
+
+def compare(results, baseline, key_fields, metrics, tolerance, latency_tolerance):
+    """Per-case changes against a baseline run; regressions are marked"""
+    previous = {tuple(result[field] for field in key_fields): result for result in baseline}
+    comparisons = []
+    for result in results:
+        key = tuple(result[field] for field in key_fields)
+        before = previous.get(key)
+        if before is None:
+            continue
+        entry = dict(zip(key_fields, key))
+        entry['regressions'] = []
+        for metric, higher_is_better in metrics:
+            change = result[metric] / before[metric] - 1.0 if before[metric] else 0.0
+            entry[f'{metric}_change'] = round(change, 4)
+            if higher_is_better and change < -tolerance:
+                entry['regressions'].append(metric)
+            elif not higher_is_better and change > latency_tolerance:
+                entry['regressions'].append(metric)
+        if result.get('errors', 0) > before.get('errors', 0):
+            entry['regressions'].append('errors')
+        comparisons.append(entry)
+    return comparisons
+
+
+def main():
+    """Run the load or startup benchmark and print or save the results"""
+    args = parse_args()
+    
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'micro_batching': os.environ.get('MICRO_BATCHING', '0') == '1',
+        }
+    }
+    if args.startup:
+        section, key_fields, metrics = 'startup', STARTUP_KEY, STARTUP_METRICS
+        report['startup'] = run_startup(args)
+    else:
+        section, key_fields, metrics = 'results', LOAD_KEY, LOAD_METRICS
+        report['results'], servers = run_load(args)
+        report['meta'].update({
+            'source': args.replay or f'synthetic:{args.num_samples}:seed={args.seed}',
+            'servers': servers,
+            'url': args.url,
+            'response_cache': args.cache,
+        })
+    
+    regressed = False
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f).get(section, [])
+        report['comparison'] = compare(report[section], baseline, key_fields, metrics,
+                                       args.tolerance, args.latency_tolerance)
+        for entry in report['comparison']:
+            if entry['regressions']:
+                regressed = True
+                case = ' '.join(f'{field}={entry[field]}' for field in key_fields)
+                changes = ', '.join(f"{metric} {entry[metric + '_change']:+.1%}" for metric, _ in metrics)
+                log(f"REGRESSION {case}: {changes}")
+        log(f"{len(report['comparison'])} cases compared, "
+            f"{sum(1 for entry in report['comparison'] if entry['regressions'])} regressed")
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        log(f"Results saved to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+    
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
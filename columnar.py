@@ -0,0 +1,150 @@
+"""
+RTB DSP Columnar Dataset Format
+Directory of raw .npy columns with narrow dtypes, shared by the generator and trainer
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_FILE = 'schema.json'
+MANIFEST_FILE = 'manifest.json'
+
+# Narrowest dtype that holds each column's full range
+COLUMN_DTYPES = {
+    'timestamp': 'datetime64[us]',
+    'user_age': 'int8',
+    'device_type': 'int8',
+    'location': 'int8',
+    'hour_of_day': 'int8',
+    'day_of_week': 'int8',
+    'ad_category': 'int8',
+    'frequency_count': 'int8',
+    'floor_price': 'float32',
+    'competition_level': 'int8',
+    'clicked': 'int8',
+    'converted': 'int8',
+    'true_ctr': 'float32',
+    'true_cvr': 'float32',
+    'is_weekend': 'int8',
+    'is_peak_hour': 'int8',
+    'is_mobile': 'int8',
+}
+
+
+def is_columnar(path):
+    """True if path is a columnar dataset directory or a manifest of them"""
+    if not os.path.isdir(path):
+        return False
+    if os.path.exists(os.path.join(path, SCHEMA_FILE)):
+        return True
+    
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, 'r') as f:
+        return json.load(f).get('format') == 'npy'
+
+
+class ColumnarWriter:
+    """Write chunks into preallocated, memory-mapped .npy columns"""
+    
+    def __init__(self, path, num_rows, columns=None):
+        self.path = path
+        self.num_rows = num_rows
+        self.offset = 0
+        
+        os.makedirs(path, exist_ok=True)
+        self.columns = {
+            name: np.lib.format.open_memmap(
+                os.path.join(path, f'{name}.npy'), mode='w+',
+                dtype=COLUMN_DTYPES[name], shape=(num_rows,)
+            )
+            for name in (columns or COLUMN_DTYPES)
+        }
+    
+    def write(self, chunk):
+        """Append a chunk (DataFrame or dict of arrays)"""
+        n = len(chunk['timestamp'])
+        for name, column in self.columns.items():
+            column[self.offset:self.offset + n] = np.asarray(chunk[name])
+        self.offset += n
+    
+    def close(self):
+        """Flush columns and write the schema"""
+        for column in self.columns.values():
+            column.flush()
+        
+        schema = {
+            'rows': self.offset,
+            'columns': {name: str(column.dtype) for name, column in self.columns.items()},
+        }
+        with open(os.path.join(self.path, SCHEMA_FILE), 'w') as f:
+            json.dump(schema, f, indent=2)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_columns(path, columns=None):
+    """Load columns as read-only memory maps
+    
+    A single dataset directory is mapped zero-copy. A sharded directory
+    (manifest.json) is concatenated shard by shard, which copies.
+    """
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(os.path.join(path, SCHEMA_FILE)) and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        shards = [load_columns(os.path.join(path, shard['path']), columns) for shard in manifest['shards']]
+        if not shards:
+            # A manifest with no shards is an empty dataset, typed like a written one
+            names = columns if columns is not None else list(COLUMN_DTYPES)
+            return {name: np.empty(0, dtype=COLUMN_DTYPES[name]) for name in names}
+        return {name: np.concatenate([shard[name] for shard in shards]) for name in shards[0]}
+    
+    with open(os.path.join(path, SCHEMA_FILE), 'r') as f:
+        schema = json.load(f)
+    
+    names = columns if columns is not None else list(schema['columns'])
+    return {
+        name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        for name in names
+    }
+
+
+def read_columnar(path, columns=None):
+    """Read a columnar dataset into a DataFrame backed by the mapped columns"""
+    return pd.DataFrame(load_columns(path, columns), copy=False)
+
+
+def iter_chunks(path, columns, chunk_size=100000):
+    """Yield dicts of column arrays with at most chunk_size rows
+    
+    Works on a columnar directory (slices of the memory maps), a sharded
+    directory (shard by shard, CSV or npy) and a plain CSV file, so memory
+    stays bounded by chunk_size whatever the source.
+    """
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if os.path.isdir(path) and not os.path.exists(os.path.join(path, SCHEMA_FILE)):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        for shard in manifest['shards']:
+            yield from iter_chunks(os.path.join(path, shard['path']), columns, chunk_size)
+        return
+    
+    if os.path.isdir(path):
+        mapped = load_columns(path, columns)
+        num_rows = len(mapped[columns[0]])
+        for start in range(0, num_rows, chunk_size):
+            yield {name: column[start:start + chunk_size] for name, column in mapped.items()}
+        return
+    
+    parse_dates = ['timestamp'] if 'timestamp' in columns else False
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size, parse_dates=parse_dates):
+        yield {name: chunk[name].to_numpy() for name in columns}
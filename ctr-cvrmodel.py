@@ -7,34 +7,232 @@ import numpy as np
 import pandas as pd
 import xgboost as xgb
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import (
-    accuracy_score, precision_score, recall_score, f1_score,
-    roc_auc_score, log_loss, confusion_matrix
-)
+from sklearn.metrics import roc_auc_score, log_loss
 import joblib
 import json
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+from columnar import is_columnar, read_columnar, iter_chunks
+from evaluation import Evaluation, format_metric
+from model_store import READY_FILE, esmm_cvr
+from tree_engine import compile_booster, LookupTable, LOOKUP_MAX_CELLS
+
+# Feature columns (exclude labels and metadata)
+FEATURE_COLUMNS = [
+    'user_age', 'device_type', 'location', 'hour_of_day',
+    'day_of_week', 'ad_category', 'frequency_count',
+    'floor_price', 'competition_level', 'is_weekend',
+    'is_peak_hour', 'is_mobile'
+]
+LABEL_COLUMNS = ['clicked', 'converted']
+
+# XGBoost parameters
+CTR_PARAMS = {
+    'objective': 'binary:logistic',
+    'eval_metric': ['auc', 'logloss'],  # last metric drives early stopping
+    'max_depth': 6,
+    'learning_rate': 0.1,
+    'n_estimators': 200,
+    'early_stopping_rounds': 20,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'random_state': 42,
+    'tree_method': 'hist',
+}
+
+CVR_PARAMS = {
+    'objective': 'binary:logistic',
+    'eval_metric': ['auc', 'logloss'],  # last metric drives early stopping
+    'max_depth': 5,
+    'learning_rate': 0.1,
+    'n_estimators': 150,
+    'early_stopping_rounds': 20,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'random_state': 42,
+    'tree_method': 'hist',
+}
+
+# ESMM formulation: a pCTCVR (click and convert) model trained on all
+# impressions replaces the clicked-only CVR model; CVR = pCTCVR / pCTR
+CTCVR_PARAMS = dict(CVR_PARAMS)
+FORMULATIONS = ['split', 'esmm']
+
+# Hyperparameter search: sampled configurations are boosted in rungs of
+# increasing round budgets (successive halving); after each rung only the
+# best SEARCH_KEEP fraction by validation logloss continues
+SEARCH_SPACE = {
+    'max_depth': [3, 4, 5, 6, 7, 8],
+    'learning_rate': [0.03, 0.05, 0.1, 0.2, 0.3],
+    'subsample': [0.6, 0.7, 0.8, 0.9, 1.0],
+    'colsample_bytree': [0.6, 0.8, 1.0],
+    'min_child_weight': [1, 5, 10, 20],
+}
+SEARCH_RUNGS = [50, 150, 400]
+SEARCH_KEEP = 1 / 3
+
+
+def native_params(params):
+    """Translate XGBClassifier keyword params to xgb.train params, round count and patience"""
+    params = dict(params)
+    num_boost_round = params.pop('n_estimators')
+    early_stopping_rounds = params.pop('early_stopping_rounds', None)
+    params['seed'] = params.pop('random_state')
+    return params, num_boost_round, early_stopping_rounds
+
+
+def truncate_to_best(booster):
+    """Drop trees grown after the early-stopping best iteration"""
+    best_iteration = booster.attr('best_iteration')
+    if best_iteration is None:
+        return booster
+    return booster[:int(best_iteration) + 1]
+
+
+def booster_to_classifier(booster, params):
+    """Wrap a native Booster as an XGBClassifier so save_models and the API can use it"""
+    model = xgb.XGBClassifier(**params)
+    # The raw booster is ours, so the "native model" warning does not apply
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='Loading a native XGBoost model', category=UserWarning)
+        model.load_model(bytearray(booster.save_raw()))
+    return model
+
+
+def newest_model_dir(versions_dir, base_dir='models'):
+    """Newest complete version directory under versions_dir, else base_dir"""
+    if os.path.isdir(versions_dir):
+        versions = sorted(
+            name for name in os.listdir(versions_dir)
+            if os.path.exists(os.path.join(versions_dir, name, READY_FILE))
+        )
+        if versions:
+            return os.path.join(versions_dir, versions[-1])
+    return base_dir
+
+
+def claim_version_dir(versions_dir):
+    """Create a new, empty timestamped version directory; returns (version, path)
+    
+    Refreshes within the same second get a -01, -02, ... suffix, which
+    still sorts after the plain timestamp.
+    """
+    os.makedirs(versions_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    for attempt in range(100):
+        version = stamp if attempt == 0 else f'{stamp}-{attempt:02d}'
+        path = os.path.join(versions_dir, version)
+        try:
+            os.makedirs(path, exist_ok=False)
+        except FileExistsError:
+            continue
+        return version, path
+    raise RuntimeError(f"Could not create a new version directory for {stamp} under {versions_dir}")
+
+
+def in_validation_split(row_index, test_size=0.2):
+    """Deterministic per-row train/validation assignment, independent of chunking"""
+    # Knuth multiplicative hash of the global row index, mapped to [0, 1)
+    hashed = (row_index.astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2**32)
+    return hashed / 2**32 < test_size
+
+
+class ChunkIterator(xgb.DataIter):
+    """Stream feature/label chunks from disk into XGBoost
+    
+    Yields one split (train or validation) of the dataset, optionally only
+    clicked rows, one chunk at a time. With cache_prefix set XGBoost keeps
+    the resulting pages on disk (external memory).
+    """
+    
+    def __init__(self, data_path, label, chunk_size, validation=False,
+                 clicked_only=False, cache_prefix=None):
+        self.data_path = data_path
+        self.label = label
+        self.chunk_size = chunk_size
+        self.validation = validation
+        self.clicked_only = clicked_only
+        self._chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+    
+    def iter_arrays(self):
+        """Yield (X, y) float32/int arrays for this split"""
+        row_offset = 0
+        for chunk in iter_chunks(self.data_path, FEATURE_COLUMNS + LABEL_COLUMNS, self.chunk_size):
+            n = len(chunk[self.label])
+            row_index = np.arange(row_offset, row_offset + n)
+            row_offset += n
+            
+            mask = in_validation_split(row_index) == self.validation
+            if self.clicked_only:
+                mask &= np.asarray(chunk['clicked']) > 0
+            if not mask.any():
+                continue
+            
+            X = np.column_stack([np.asarray(chunk[col], dtype=np.float32)[mask] for col in FEATURE_COLUMNS])
+            yield X, np.asarray(chunk[self.label])[mask]
+    
+    def next(self, input_data):
+        if self._chunks is None:
+            self._chunks = self.iter_arrays()
+        batch = next(self._chunks, None)
+        if batch is None:
+            return False
+        X, y = batch
+        input_data(data=X, label=y, feature_names=FEATURE_COLUMNS)
+        return True
+    
+    def reset(self):
+        self._chunks = None
 
 
 class CTRCVRModelTrainer:
     """Train and evaluate CTR/CVR prediction models"""
     
-    def __init__(self, data_path='rtb_dataset.csv'):
+    def __init__(self, data_path='rtb_dataset.csv', formulation='split', export_lookup=False,
+                 lookup_max_cells=LOOKUP_MAX_CELLS):
+        # data_path may be a CSV file or a columnar directory written with
+        # `dataset.py --format npy`; load_data detects which
         self.data_path = data_path
+        self.formulation = formulation
+        # The lookup table grows exponentially with tree depth, so it is only
+        # exported on request and only while it fits lookup_max_cells
+        self.export_lookup = export_lookup
+        self.lookup_max_cells = lookup_max_cells
         self.ctr_model = None
         self.cvr_model = None
+        self.ctcvr_model = None
         self.feature_columns = None
         self.metrics = {}
+        
+        # Per-model XGBoost parameters; the hyperparameter search updates these
+        self.params = {'ctr': dict(CTR_PARAMS), 'cvr': dict(CVR_PARAMS), 'ctcvr': dict(CTCVR_PARAMS)}
+    
+    def second_model(self):
+        """(name, model) of the model served next to CTR: 'cvr', or 'ctcvr' for ESMM"""
+        if self.formulation == 'esmm':
+            return 'ctcvr', self.ctcvr_model
+        return 'cvr', self.cvr_model
     
-    def load_data(self):
+    def load_data(self, extra_columns=None):
         """Load and prepare dataset"""
         print("Loading dataset...")
-        df = pd.read_csv(self.data_path)
-        
-        # Convert timestamp to datetime
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        if is_columnar(self.data_path):
+            # Memory-mapped .npy columns with native dtypes; only what training needs
+            columns = FEATURE_COLUMNS + LABEL_COLUMNS + list(extra_columns or [])
+            df = read_columnar(self.data_path, columns)
+        else:
+            df = pd.read_csv(self.data_path)
+            
+            # Convert timestamp to datetime
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
         
         print(f"Loaded {len(df)} samples")
         print(f"Click rate: {df['clicked'].mean()*100:.2f}%")
@@ -44,13 +242,7 @@ class CTRCVRModelTrainer:
     
     def prepare_features(self, df):
         """Prepare features for training"""
-        # Feature columns (exclude labels and metadata)
-        feature_cols = [
-            'user_age', 'device_type', 'location', 'hour_of_day',
-            'day_of_week', 'ad_category', 'frequency_count',
-            'floor_price', 'competition_level', 'is_weekend',
-            'is_peak_hour', 'is_mobile'
-        ]
+        feature_cols = FEATURE_COLUMNS
         
         self.feature_columns = feature_cols
         
@@ -67,19 +259,9 @@ class CTRCVRModelTrainer:
         print("="*60)
         
         # XGBoost parameters
-        params = {
-            'objective': 'binary:logistic',
-            'eval_metric': ['logloss', 'auc'],
-            'max_depth': 6,
-            'learning_rate': 0.1,
-            'n_estimators': 200,
-            'subsample': 0.8,
-            'colsample_bytree': 0.8,
-            'random_state': 42,
-            'tree_method': 'hist',
-        }
+        params = dict(self.params['ctr'])
         
-        # Train model
+        # Train model, stopping once validation logloss stops improving
         self.ctr_model = xgb.XGBClassifier(**params)
         
         eval_set = [(X_train, y_train), (X_val, y_val)]
@@ -88,47 +270,23 @@ class CTRCVRModelTrainer:
             eval_set=eval_set,
             verbose=10
         )
+        self.ctr_model = booster_to_classifier(truncate_to_best(self.ctr_model.get_booster()), params)
         
         # Predictions
         y_pred_proba = self.ctr_model.predict_proba(X_val)[:, 1]
-        y_pred = (y_pred_proba >= 0.5).astype(int)
-        
-        # Metrics
-        metrics = {
-            'accuracy': accuracy_score(y_val, y_pred),
-            'precision': precision_score(y_val, y_pred),
-            'recall': recall_score(y_val, y_pred),
-            'f1_score': f1_score(y_val, y_pred),
-            'auc': roc_auc_score(y_val, y_pred_proba),
-            'log_loss': log_loss(y_val, y_pred_proba),
-        }
-        
-        self.metrics['ctr'] = metrics
-        
-        print("\nCTR Model Performance:")
-        for metric, value in metrics.items():
-            print(f"  {metric}: {value:.4f}")
-        
-        # Feature importance
-        feature_importance = pd.DataFrame({
-            'feature': self.feature_columns,
-            'importance': self.ctr_model.feature_importances_
-        }).sort_values('importance', ascending=False)
-        
-        print("\nTop 5 Important Features:")
-        print(feature_importance.head())
         
-        return metrics, feature_importance
+        evaluation = Evaluation().update_features(y_val, y_pred_proba, X_val, self.feature_columns)
+        return self.report_model('ctr', self.ctr_model, evaluation)
     
-    def train_cvr_model(self, X_train, y_train, X_val, y_val):
+    def train_cvr_model(self, X_train, y_train, X_val, y_val, clicks_train, clicks_val):
         """Train CVR prediction model"""
         print("\n" + "="*60)
         print("TRAINING CVR MODEL")
         print("="*60)
         
         # Filter only clicked samples for CVR
-        clicked_train = y_train > 0
-        clicked_val = y_val > 0
+        clicked_train = clicks_train > 0
+        clicked_val = clicks_val > 0
         
         if clicked_train.sum() == 0 or clicked_val.sum() == 0:
             print("Not enough clicked samples for CVR training")
@@ -143,19 +301,9 @@ class CTRCVRModelTrainer:
         print(f"Validation on {len(X_val_cvr)} clicked samples")
         
         # XGBoost parameters
-        params = {
-            'objective': 'binary:logistic',
-            'eval_metric': ['logloss', 'auc'],
-            'max_depth': 5,
-            'learning_rate': 0.1,
-            'n_estimators': 150,
-            'subsample': 0.8,
-            'colsample_bytree': 0.8,
-            'random_state': 42,
-            'tree_method': 'hist',
-        }
+        params = dict(self.params['cvr'])
         
-        # Train model
+        # Train model, stopping once validation logloss stops improving
         self.cvr_model = xgb.XGBClassifier(**params)
         
         eval_set = [(X_train_cvr, y_train_cvr), (X_val_cvr, y_val_cvr)]
@@ -164,31 +312,126 @@ class CTRCVRModelTrainer:
             eval_set=eval_set,
             verbose=10
         )
+        self.cvr_model = booster_to_classifier(truncate_to_best(self.cvr_model.get_booster()), params)
         
         # Predictions
         y_pred_proba = self.cvr_model.predict_proba(X_val_cvr)[:, 1]
-        y_pred = (y_pred_proba >= 0.5).astype(int)
         
-        # Metrics
-        metrics = {
-            'accuracy': accuracy_score(y_val_cvr, y_pred),
-            'precision': precision_score(y_val_cvr, y_pred),
-            'recall': recall_score(y_val_cvr, y_pred),
-            'f1_score': f1_score(y_val_cvr, y_pred),
-            'auc': roc_auc_score(y_val_cvr, y_pred_proba),
-            'log_loss': log_loss(y_val_cvr, y_pred_proba),
-        }
+        evaluation = Evaluation().update_features(y_val_cvr, y_pred_proba, X_val_cvr, self.feature_columns)
+        return self.report_model('cvr', self.cvr_model, evaluation)
+    
+    def train_ctcvr_model(self, X_train, y_train, X_val, y_val):
+        """Train the ESMM pCTCVR model on all impressions"""
+        print("\n" + "="*60)
+        print("TRAINING CTCVR MODEL (ESMM)")
+        print("="*60)
+        
+        # XGBoost parameters
+        params = dict(self.params['ctcvr'])
+        
+        # Train model, stopping once validation logloss stops improving
+        self.ctcvr_model = xgb.XGBClassifier(**params)
+        
+        eval_set = [(X_train, y_train), (X_val, y_val)]
+        self.ctcvr_model.fit(
+            X_train, y_train,
+            eval_set=eval_set,
+            verbose=10
+        )
+        self.ctcvr_model = booster_to_classifier(truncate_to_best(self.ctcvr_model.get_booster()), params)
+        
+        y_pred_proba = self.ctcvr_model.predict_proba(X_val)[:, 1]
+        evaluation = Evaluation().update_features(y_val, y_pred_proba, X_val, self.feature_columns)
+        return self.report_model('ctcvr', self.ctcvr_model, evaluation)
+    
+    def update_esmm_cvr(self, evaluation, X_val, converted, clicked, ctr_proba, ctcvr_proba):
+        """Fold one chunk of the ESMM pair's CVR (pCTCVR / pCTR) on clicked rows into evaluation"""
+        clicked = np.asarray(clicked) > 0
+        cvr_proba = esmm_cvr(np.asarray(ctr_proba), np.asarray(ctcvr_proba))
+        return evaluation.update_features(np.asarray(converted)[clicked], cvr_proba[clicked],
+                                          np.asarray(X_val)[clicked], self.feature_columns)
+    
+    def report_esmm_cvr(self, evaluation):
+        """CVR metrics of the ESMM pair on clicked validation rows, comparable to the split CVR model"""
+        metrics = self.record_evaluation('cvr', evaluation)
+        
+        print("\nCVR (pCTCVR / pCTR) on clicked rows:")
+        for metric, value in metrics.items():
+            print(f"  {metric}: {format_metric(value)}")
+        return metrics
+    
+    def train_streaming_model(self, name, params, label, chunk_size,
+                              clicked_only=False, external_memory=False):
+        """Train one model from on-disk chunks without materializing the dataset"""
+        print("\n" + "="*60)
+        print(f"TRAINING {name.upper()} MODEL (STREAMING)")
+        print("="*60)
+        
+        # XGBoost's external-memory pages can be as large as the dataset, so
+        # the cache directory is removed however training ends
+        cache_dir = tempfile.mkdtemp(prefix=f'xgb-{name}-') if external_memory else None
+        dtrain = dval = None
+        try:
+            def make_iter(validation):
+                cache_prefix = os.path.join(cache_dir, 'val' if validation else 'train') if cache_dir else None
+                return ChunkIterator(self.data_path, label, chunk_size, validation=validation,
+                                     clicked_only=clicked_only, cache_prefix=cache_prefix)
+            
+            # External memory keeps pages on disk; otherwise only the quantized
+            # (one byte per feature) matrix is held in RAM
+            if external_memory:
+                dtrain = xgb.DMatrix(make_iter(False))
+                dval = xgb.DMatrix(make_iter(True))
+            else:
+                dtrain = xgb.QuantileDMatrix(make_iter(False))
+                dval = xgb.QuantileDMatrix(make_iter(True), ref=dtrain)
+            
+            print(f"Training on {dtrain.num_row()} samples")
+            print(f"Validation on {dval.num_row()} samples")
+            
+            booster_params, num_boost_round, early_stopping_rounds = native_params(params)
+            booster = xgb.train(
+                booster_params, dtrain, num_boost_round=num_boost_round,
+                evals=[(dtrain, 'train'), (dval, 'validation')],
+                early_stopping_rounds=early_stopping_rounds,
+                verbose_eval=10
+            )
+            booster = truncate_to_best(booster)
+            model = booster_to_classifier(booster, params)
+            
+            # Metrics, folded in chunk by chunk over the validation split
+            evaluation = Evaluation()
+            for X_val, y_val in make_iter(True).iter_arrays():
+                evaluation.update_features(y_val, booster.inplace_predict(X_val), X_val, self.feature_columns)
+        finally:
+            if cache_dir:
+                # Drop the matrices first: they hold the page files open
+                dtrain = dval = None
+                shutil.rmtree(cache_dir, ignore_errors=True)
         
-        self.metrics['cvr'] = metrics
+        metrics, feature_importance = self.report_model(name, model, evaluation)
+        return model, metrics, feature_importance
+    
+    def record_evaluation(self, name, evaluation):
+        """Store headline metrics under name and the per-slice report under 'evaluation'"""
+        metrics = evaluation.summary()
+        self.metrics[name] = metrics
+        self.metrics.setdefault('evaluation', {})[name] = evaluation.report()
+        return metrics
+    
+    def report_model(self, name, model, evaluation):
+        """Record validation metrics and print them with the top features"""
+        # Metrics
+        metrics = self.record_evaluation(name, evaluation)
         
-        print("\nCVR Model Performance:")
+        print(f"\n{name.upper()} Model Performance:")
         for metric, value in metrics.items():
-            print(f"  {metric}: {value:.4f}")
+            print(f"  {metric}: {format_metric(value)}")
         
         # Feature importance
         feature_importance = pd.DataFrame({
             'feature': self.feature_columns,
-            'importance': self.cvr_model.feature_importances_
+            'importance': model.feature_importances_
         }).sort_values('importance', ascending=False)
         
         print("\nTop 5 Important Features:")
@@ -196,27 +439,255 @@ class CTRCVRModelTrainer:
         
         return metrics, feature_importance
     
+    def train_streaming(self, chunk_size=100000, external_memory=False):
+        """Train both models from on-disk chunks; peak memory is bounded by chunk_size"""
+        self.feature_columns = FEATURE_COLUMNS
+        
+        self.ctr_model, _, ctr_importance = self.train_streaming_model(
+            'ctr', self.params['ctr'], 'clicked', chunk_size, external_memory=external_memory
+        )
+        if self.formulation == 'esmm':
+            self.ctcvr_model, _, ctcvr_importance = self.train_streaming_model(
+                'ctcvr', self.params['ctcvr'], 'converted', chunk_size, external_memory=external_memory
+            )
+            
+            # Both labels of the validation split, read chunk by chunk in the same order
+            ctr_booster, ctcvr_booster = self.ctr_model.get_booster(), self.ctcvr_model.get_booster()
+            evaluation = Evaluation()
+            for (X_val, y_clicked), (_, y_converted) in zip(
+                ChunkIterator(self.data_path, 'clicked', chunk_size, validation=True).iter_arrays(),
+                ChunkIterator(self.data_path, 'converted', chunk_size, validation=True).iter_arrays()
+            ):
+                self.update_esmm_cvr(evaluation, X_val, y_converted, y_clicked,
+                                     ctr_booster.inplace_predict(X_val), ctcvr_booster.inplace_predict(X_val))
+            self.report_esmm_cvr(evaluation)
+            return ctr_importance, ctcvr_importance
+        
+        self.cvr_model, _, cvr_importance = self.train_streaming_model(
+            'cvr', self.params['cvr'], 'converted', chunk_size,
+            clicked_only=True, external_memory=external_memory
+        )
+        
+        return ctr_importance, cvr_importance
+    
+    def train_shared(self, threads=None, ctr_thread_share=0.75):
+        """Train CTR and CVR concurrently on one shared quantized matrix
+        
+        Rows are ordered clicked-first, so the CVR training set is a slice
+        (a view) of the CTR one. The CVR matrices reuse the CTR quantile
+        cuts through ``ref`` instead of sketching again. Both boosters then
+        train at the same time on a fixed split of the cores.
+        """
+        df = self.load_data()
+        self.feature_columns = FEATURE_COLUMNS
+        
+        # One float32 copy of the features; labels as plain arrays
+        X = np.ascontiguousarray(df[FEATURE_COLUMNS].to_numpy(dtype=np.float32))
+        clicked = df['clicked'].to_numpy()
+        converted = df['converted'].to_numpy()
+        
+        # Split data (indices only), then order each side clicked-first
+        train_idx, val_idx = train_test_split(
+            np.arange(len(X)), test_size=0.2, random_state=42, stratify=clicked
+        )
+        train_idx = np.concatenate([train_idx[clicked[train_idx] > 0], train_idx[clicked[train_idx] == 0]])
+        val_idx = np.concatenate([val_idx[clicked[val_idx] > 0], val_idx[clicked[val_idx] == 0]])
+        n_clicked_train = int((clicked[train_idx] > 0).sum())
+        n_clicked_val = int((clicked[val_idx] > 0).sum())
+        
+        X_train, X_val = X[train_idx], X[val_idx]
+        del X
+        
+        print(f"\nTraining set: {len(X_train)} samples ({n_clicked_train} clicked)")
+        print(f"Validation set: {len(X_val)} samples ({n_clicked_val} clicked)")
+        
+        # Quantile sketch and binning happen once, on the full training set
+        dtrain_ctr = xgb.QuantileDMatrix(X_train, label=clicked[train_idx], feature_names=FEATURE_COLUMNS)
+        dval_ctr = xgb.QuantileDMatrix(X_val, label=clicked[val_idx], ref=dtrain_ctr,
+                                       feature_names=FEATURE_COLUMNS)
+        
+        # Clicked rows are a leading slice: views, binned against the same cuts
+        dtrain_cvr = xgb.QuantileDMatrix(X_train[:n_clicked_train], label=converted[train_idx[:n_clicked_train]],
+                                         ref=dtrain_ctr, feature_names=FEATURE_COLUMNS)
+        dval_cvr = xgb.QuantileDMatrix(X_val[:n_clicked_val], label=converted[val_idx[:n_clicked_val]],
+                                       ref=dtrain_cvr, feature_names=FEATURE_COLUMNS)
+        
+        # Explicit core split between the two boosters
+        total_threads = threads or os.cpu_count()
+        ctr_threads = max(1, min(total_threads - 1, round(total_threads * ctr_thread_share)))
+        cvr_threads = max(1, total_threads - ctr_threads)
+        print(f"Training CTR on {ctr_threads} threads and CVR on {cvr_threads} threads concurrently")
+        
+        def fit(name, params, dtrain, dval, nthread):
+            booster_params, num_boost_round, early_stopping_rounds = native_params(params)
+            booster_params['nthread'] = nthread
+            return truncate_to_best(xgb.train(
+                booster_params, dtrain, num_boost_round=num_boost_round,
+                evals=[(dtrain, f'{name}_train'), (dval, f'{name}_validation')],
+                early_stopping_rounds=early_stopping_rounds,
+                verbose_eval=10
+            ))
+        
+        # XGBoost releases the GIL while boosting, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            ctr_future = pool.submit(fit, 'ctr', self.params['ctr'], dtrain_ctr, dval_ctr, ctr_threads)
+            cvr_future = pool.submit(fit, 'cvr', self.params['cvr'], dtrain_cvr, dval_cvr, cvr_threads)
+            ctr_booster, cvr_booster = ctr_future.result(), cvr_future.result()
+        
+        self.ctr_model = booster_to_classifier(ctr_booster, self.params['ctr'])
+        self.cvr_model = booster_to_classifier(cvr_booster, self.params['cvr'])
+        
+        ctr_evaluation = Evaluation().update_features(
+            clicked[val_idx], ctr_booster.inplace_predict(X_val), X_val, FEATURE_COLUMNS
+        )
+        cvr_evaluation = Evaluation().update_features(
+            converted[val_idx[:n_clicked_val]], cvr_booster.inplace_predict(X_val[:n_clicked_val]),
+            X_val[:n_clicked_val], FEATURE_COLUMNS
+        )
+        _, ctr_importance = self.report_model('ctr', self.ctr_model, ctr_evaluation)
+        _, cvr_importance = self.report_model('cvr', self.cvr_model, cvr_evaluation)
+        
+        return ctr_importance, cvr_importance
+    
+    def search_hyperparameters(self, name, X_train, y_train, X_val, y_val,
+                               n_trials=12, workers=None, threads_per_trial=1, seed=42):
+        """Successive-halving hyperparameter search across a process pool
+        
+        Each trial boosts with a fixed thread budget and early stopping.
+        After every rung in SEARCH_RUNGS the weakest of the still-improving
+        trials are pruned and the survivors continue boosting from their best
+        iteration so far; a rung that does not beat a trial's earlier best
+        keeps the earlier result. The best
+        configuration replaces self.params[name], and every trial's AUC,
+        logloss, wall-clock time and inference cost per tree count are
+        recorded under metrics['search'][name].
+        """
+        print("\n" + "="*60)
+        print(f"HYPERPARAMETER SEARCH: {name.upper()} MODEL")
+        print("="*60)
+        
+        workers = workers or max(1, (os.cpu_count() or 1) // threads_per_trial)
+        rng = np.random.default_rng(seed)
+        base_params, _, early_stopping_rounds = native_params(self.params[name])
+        base_params['nthread'] = threads_per_trial
+        
+        trials = [
+            {'trial': i, 'config': {key: rng.choice(values).item() for key, values in SEARCH_SPACE.items()},
+             'rounds': 0, 'train_seconds': 0.0, 'status': 'running', 'model': None, 'log_loss': np.inf}
+            for i in range(n_trials)
+        ]
+        print(f"{n_trials} trials on {workers} workers x {threads_per_trial} threads")
+        
+        alive = trials
+        init_args = (
+            np.ascontiguousarray(X_train, dtype=np.float32), np.asarray(y_train),
+            np.ascontiguousarray(X_val, dtype=np.float32), np.asarray(y_val), threads_per_trial
+        )
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_search_worker,
+                                 initargs=init_args) as pool:
+            for rung, rounds in enumerate(SEARCH_RUNGS):
+                tasks = [
+                    ({**base_params, **trial['config']}, rounds - trial['rounds'],
+                     early_stopping_rounds, trial['model'])
+                    for trial in alive
+                ]
+                for trial, result in zip(alive, pool.map(_run_trial, tasks)):
+                    trial['train_seconds'] += result.pop('train_seconds')
+                    trial['status'] = result.pop('status')
+                    # Early stopping restarts its count on every resume, so a
+                    # rung that ends worse keeps the trial's earlier best
+                    if result['log_loss'] < trial['log_loss']:
+                        trial.update(result)
+                        trial['rounds'] = trial['best_iteration'] + 1
+                
+                alive.sort(key=lambda trial: trial['log_loss'])
+                print(f"Rung {rung + 1}: {len(alive)} trials at up to {rounds} rounds, "
+                      f"best logloss {alive[0]['log_loss']:.5f}")
+                
+                # Early-stopped trials are final and take no promotion slot;
+                # only the still-improving ones compete for the next rung
+                if rung < len(SEARCH_RUNGS) - 1:
+                    running = [trial for trial in alive if trial['status'] == 'running']
+                    keep = max(1, int(np.ceil(len(running) * SEARCH_KEEP)))
+                    for trial in running[keep:]:
+                        trial['status'] = f'pruned_at_rung_{rung + 1}'
+                    alive = running[:keep]
+                    if not alive:
+                        break
+        
+        for trial in trials:
+            trial.pop('model')
+            if trial['status'] == 'running':
+                trial['status'] = 'completed'
+        
+        best = min(trials, key=lambda trial: trial['log_loss'])
+        print(f"Best trial {best['trial']}: {best['config']} "
+              f"(AUC {best['auc']:.4f}, logloss {best['log_loss']:.5f}, {best['best_iteration'] + 1} trees)")
+        
+        self.params[name].update(best['config'])
+        self.params[name]['n_estimators'] = max(SEARCH_RUNGS)
+        self.metrics.setdefault('search', {})[name] = {'best': best, 'trials': trials}
+        
+        return best
+    
+    def save_lookup_table(self, ensembles, output_dir):
+        """Export the lookup table when requested and small enough"""
+        # A table left over from earlier models would be served by MODEL_ENGINE=auto
+        table_path = f'{output_dir}/score_table'
+        if os.path.isdir(table_path):
+            shutil.rmtree(table_path)
+        if not self.export_lookup:
+            return
+        
+        # Sized before anything is allocated: each level of depth can double it
+        cells = LookupTable.estimate_cells(ensembles)
+        if cells > self.lookup_max_cells:
+            print(f"Lookup table not exported: {cells:,} cells ({cells * 4 / 1e9:.1f} GB) "
+                  f"exceeds the budget of {self.lookup_max_cells:,}; the API serves the compiled engine")
+            return
+        LookupTable(ensembles, max_cells=self.lookup_max_cells).save(table_path)
+        print(f"Lookup table exported: {cells:,} cells ({cells * 4 / 1e6:.0f} MB)")
+        self.metrics['lookup_cells'] = cells
+    
     def save_models(self, output_dir='models'):
         """Save trained models"""
         import os
         os.makedirs(output_dir, exist_ok=True)
         
-        # Save models
-        joblib.dump(self.ctr_model, f'{output_dir}/ctr_model.pkl')
-        joblib.dump(self.cvr_model, f'{output_dir}/cvr_model.pkl')
+        # Save models: pickles for sklearn users, XGBoost's native binary
+        # format for the API, which loads it without sklearn or unpickling
+        models = [('ctr', self.ctr_model), self.second_model()]
+        for name, model in models:
+            joblib.dump(model, f'{output_dir}/{name}_model.pkl')
+            model.get_booster().save_model(f'{output_dir}/{name}_model.ubj')
+        
+        # Compile flat-array evaluators that the API memory-maps, so it serves
+        # without xgboost or unpickling
+        ensembles = []
+        for name, model in models:
+            ensemble = compile_booster(model.get_booster(), model.feature_importances_)
+            ensemble.save(f'{output_dir}/{name}_trees')
+            ensembles.append(ensemble)
+        self.save_lookup_table(ensembles, output_dir)
         
         # Save feature columns
         with open(f'{output_dir}/feature_columns.json', 'w') as f:
             json.dump(self.feature_columns, f)
         
-        # Save metrics
+        # Save metrics; the API reads the formulation from here
+        self.metrics['formulation'] = self.formulation
         with open(f'{output_dir}/metrics.json', 'w') as f:
             json.dump(self.metrics, f, indent=2)
         
         print(f"\nModels saved to {output_dir}/")
     
-    def plot_feature_importance(self, ctr_importance, cvr_importance):
+    def plot_feature_importance(self, ctr_importance, cvr_importance, second_name='cvr'):
         """Plot feature importance"""
+        # Imported here so training never pays for plotting libraries it may not use
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        
         fig, axes = plt.subplots(1, 2, figsize=(15, 6))
         
         # CTR feature importance
@@ -229,15 +700,57 @@ class CTRCVRModelTrainer:
         if cvr_importance is not None:
             axes[1].barh(cvr_importance['feature'][:10], cvr_importance['importance'][:10])
             axes[1].set_xlabel('Importance')
-            axes[1].set_title('CVR Model - Top 10 Features')
+            axes[1].set_title(f'{second_name.upper()} Model - Top 10 Features')
             axes[1].invert_yaxis()
         
         plt.tight_layout()
         plt.savefig('models/feature_importance.png', dpi=300, bbox_inches='tight')
         print("Feature importance plot saved to models/feature_importance.png")
     
-    def train(self):
+    def train(self, mode='memory', chunk_size=100000, external_memory=False,
+              threads=None, ctr_thread_share=0.75, search_trials=0, search_workers=None,
+              threads_per_trial=1):
         """Main training pipeline"""
+        if self.formulation == 'esmm' and mode == 'shared':
+            raise ValueError("--formulation esmm supports --mode memory and stream")
+        
+        if mode == 'stream':
+            # Out-of-core: chunks stream from disk straight into XGBoost
+            ctr_importance, cvr_importance = self.train_streaming(chunk_size, external_memory)
+        elif mode == 'shared':
+            # One quantized matrix, both boosters trained concurrently
+            ctr_importance, cvr_importance = self.train_shared(threads, ctr_thread_share)
+        else:
+            ctr_importance, cvr_importance = self.train_in_memory(
+                search_trials, search_workers, threads_per_trial
+            )
+        
+        # Save models
+        self.save_models()
+        
+        # Plot feature importance
+        self.plot_feature_importance(ctr_importance, cvr_importance, self.second_model()[0])
+        
+        # Generate report
+        self.generate_report()
+        
+        print("\n" + "="*60)
+        print("TRAINING COMPLETE!")
+        print("="*60)
+        second = self.second_model()[0]
+        print("\nModels saved to models/")
+        print("  - ctr_model.pkl")
+        print(f"  - {second}_model.pkl")
+        print(f"  - ctr_model.ubj, {second}_model.ubj (XGBoost native format)")
+        print(f"  - ctr_trees/, {second}_trees/ (compiled for serving)")
+        if self.metrics.get('lookup_cells'):
+            print("  - score_table/ (lookup table for serving)")
+        print("  - feature_columns.json")
+        print("  - metrics.json")
+        print("  - training_report.txt")
+    
+    def train_in_memory(self, search_trials=0, search_workers=None, threads_per_trial=1):
+        """Load the full dataset and train both models on pandas frames"""
         # Load data
         df = self.load_data()
         
@@ -252,34 +765,212 @@ class CTRCVRModelTrainer:
         print(f"\nTraining set: {len(X_train)} samples")
         print(f"Validation set: {len(X_val)} samples")
         
+        # Optional hyperparameter search before the final fits
+        if search_trials:
+            clicked_train, clicked_val = y_ctr_train.to_numpy() > 0, y_ctr_val.to_numpy() > 0
+            self.search_hyperparameters(
+                'ctr', X_train.to_numpy(), y_ctr_train.to_numpy(), X_val.to_numpy(), y_ctr_val.to_numpy(),
+                n_trials=search_trials, workers=search_workers, threads_per_trial=threads_per_trial
+            )
+            if self.formulation == 'esmm':
+                self.search_hyperparameters(
+                    'ctcvr', X_train.to_numpy(), y_cvr_train.to_numpy(), X_val.to_numpy(), y_cvr_val.to_numpy(),
+                    n_trials=search_trials, workers=search_workers, threads_per_trial=threads_per_trial
+                )
+            else:
+                self.search_hyperparameters(
+                    'cvr', X_train.to_numpy()[clicked_train], y_cvr_train.to_numpy()[clicked_train],
+                    X_val.to_numpy()[clicked_val], y_cvr_val.to_numpy()[clicked_val],
+                    n_trials=search_trials, workers=search_workers, threads_per_trial=threads_per_trial
+                )
+        
         # Train CTR model
         ctr_metrics, ctr_importance = self.train_ctr_model(
             X_train, y_ctr_train, X_val, y_ctr_val
         )
         
+        if self.formulation == 'esmm':
+            # pCTCVR on the same impressions; CVR is judged on the clicked ones
+            ctcvr_metrics, ctcvr_importance = self.train_ctcvr_model(
+                X_train, y_cvr_train, X_val, y_cvr_val
+            )
+            self.report_esmm_cvr(self.update_esmm_cvr(
+                Evaluation(), X_val, y_cvr_val, y_ctr_val,
+                self.ctr_model.predict_proba(X_val)[:, 1], self.ctcvr_model.predict_proba(X_val)[:, 1]
+            ))
+            return ctr_importance, ctcvr_importance
+        
         # Train CVR model
         cvr_metrics, cvr_importance = self.train_cvr_model(
-            X_train, y_cvr_train, X_val, y_cvr_val
+            X_train, y_cvr_train, X_val, y_cvr_val, y_ctr_train, y_ctr_val
         )
         
-        # Save models
-        self.save_models()
+        return ctr_importance, cvr_importance
+    
+    def load_window(self, since=None, window_days=7, chunk_size=1000000):
+        """Load only the rows in the newest time window, sorted by timestamp, in one pass"""
+        columns = FEATURE_COLUMNS + LABEL_COLUMNS + ['timestamp']
+        window = np.timedelta64(window_days, 'D')
+        if since is not None:
+            since = np.datetime64(since)
         
-        # Plot feature importance
-        self.plot_feature_importance(ctr_importance, cvr_importance)
+        # Without an explicit start the window ends at the latest timestamp;
+        # rows older than the running latest minus the window can never be in it
+        parts = []
+        latest = None
+        for chunk in iter_chunks(self.data_path, columns, chunk_size):
+            timestamps = chunk['timestamp']
+            if since is None:
+                chunk_latest = timestamps.max()
+                latest = chunk_latest if latest is None else max(latest, chunk_latest)
+                mask = timestamps >= latest - window
+            else:
+                mask = timestamps >= since
+            if mask.any():
+                parts.append(pd.DataFrame({name: chunk[name][mask] for name in columns}))
         
-        # Generate report
-        self.generate_report()
+        if not parts:
+            raise ValueError(f"No rows at or after {since} in {self.data_path}")
         
+        df = pd.concat(parts, ignore_index=True)
+        if since is None:
+            since = latest - window
+            df = df[df['timestamp'] >= since]
+        df = df.sort_values('timestamp', ignore_index=True)
+        print(f"Loaded {len(df)} samples from {df['timestamp'].min()} to {df['timestamp'].max()}")
+        return df
+    
+    def refresh_model(self, name, model, X_train, y_train, X_val, y_val,
+                      strategy='add', extra_rounds=50):
+        """Continue boosting an existing model on new data
+        
+        'add' appends up to extra_rounds trees (with early stopping);
+        'refresh' keeps the tree structure and re-fits leaf values.
+        """
         print("\n" + "="*60)
-        print("TRAINING COMPLETE!")
+        print(f"REFRESHING {name.upper()} MODEL ({strategy})")
         print("="*60)
-        print("\nModels saved to models/")
-        print("  - ctr_model.pkl")
-        print("  - cvr_model.pkl")
-        print("  - feature_columns.json")
-        print("  - metrics.json")
-        print("  - training_report.txt")
+        print(f"Training on {len(X_train)} samples")
+        print(f"Validation on {len(X_val)} samples")
+        
+        booster = model.get_booster()
+        params, _, early_stopping_rounds = native_params(self.params[name])
+        if strategy == 'refresh':
+            params.update(process_type='update', updater='refresh', refresh_leaf=True)
+            num_boost_round, early_stopping_rounds = booster.num_boosted_rounds(), None
+        else:
+            num_boost_round = extra_rounds
+        
+        dtrain = xgb.DMatrix(X_train, label=y_train, feature_names=FEATURE_COLUMNS)
+        dval = xgb.DMatrix(X_val, label=y_val, feature_names=FEATURE_COLUMNS)
+        refreshed = xgb.train(
+            params, dtrain, num_boost_round=num_boost_round,
+            evals=[(dtrain, 'train'), (dval, 'validation')],
+            early_stopping_rounds=early_stopping_rounds,
+            xgb_model=booster,
+            verbose_eval=10
+        )
+        print(f"{name.upper()} trees: {booster.num_boosted_rounds()} -> {truncate_to_best(refreshed).num_boosted_rounds()}")
+        
+        return booster_to_classifier(truncate_to_best(refreshed), self.params[name])
+    
+    def refresh(self, previous_dir=None, versions_dir='models/versions', since=None,
+                window_days=7, strategy='add', extra_rounds=50):
+        """Warm-start both models from previous_dir on the newest time window only
+        
+        The window is split by timestamp: the oldest 80% continues training
+        and the newest 20% is the holdout on which the previous and the
+        refreshed models are compared. The result is written to a new
+        versioned directory under versions_dir. previous_dir defaults to the
+        newest version there, so refreshes chain.
+        """
+        previous_dir = previous_dir or newest_model_dir(versions_dir)
+        print(f"Refreshing models from {previous_dir}/")
+        with open(f'{previous_dir}/metrics.json', 'r') as f:
+            previous_metrics = json.load(f)
+        if previous_metrics.get('formulation', 'split') != 'split':
+            raise ValueError("Only split CTR/CVR models can be refreshed; retrain ESMM models from scratch")
+        previous_ctr = joblib.load(f'{previous_dir}/ctr_model.pkl')
+        previous_cvr = joblib.load(f'{previous_dir}/cvr_model.pkl')
+        
+        # Temporal split of the newest window
+        df = self.load_window(since, window_days)
+        self.feature_columns = FEATURE_COLUMNS
+        cut = int(len(df) * 0.8)
+        X = df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+        clicked = df['clicked'].to_numpy()
+        converted = df['converted'].to_numpy()
+        train_clicked, val_clicked = clicked[:cut] > 0, clicked[cut:] > 0
+        
+        self.ctr_model = self.refresh_model(
+            'ctr', previous_ctr, X[:cut], clicked[:cut], X[cut:], clicked[cut:],
+            strategy, extra_rounds
+        )
+        self.cvr_model = self.refresh_model(
+            'cvr', previous_cvr, X[:cut][train_clicked], converted[:cut][train_clicked],
+            X[cut:][val_clicked], converted[cut:][val_clicked], strategy, extra_rounds
+        )
+        
+        # Previous and refreshed models on the same holdout
+        holdout = {
+            'ctr': (X[cut:], clicked[cut:]),
+            'cvr': (X[cut:][val_clicked], converted[cut:][val_clicked]),
+        }
+        comparison = {}
+        for name, previous, refreshed in [('ctr', previous_ctr, self.ctr_model),
+                                          ('cvr', previous_cvr, self.cvr_model)]:
+            X_val, y_val = holdout[name]
+            self.record_evaluation(name, Evaluation().update_features(
+                y_val, refreshed.predict_proba(X_val)[:, 1], X_val, FEATURE_COLUMNS
+            ))
+            comparison[name] = Evaluation().update_features(
+                y_val, previous.predict_proba(X_val)[:, 1], X_val, FEATURE_COLUMNS
+            ).summary()
+        
+        version, output_dir = claim_version_dir(versions_dir)
+        self.metrics['refresh'] = {
+            'version': version,
+            'previous_dir': previous_dir,
+            'strategy': strategy,
+            'window_start': str(df['timestamp'].iloc[0]),
+            'window_end': str(df['timestamp'].iloc[-1]),
+            'train_samples': cut,
+            'holdout_samples': len(df) - cut,
+            'previous_on_holdout': comparison,
+            'previous_reported': {name: previous_metrics.get(name) for name in ('ctr', 'cvr')},
+        }
+        
+        self.save_models(output_dir)
+        self.generate_refresh_report(output_dir)
+        return output_dir
+    
+    def generate_refresh_report(self, output_dir):
+        """Write the refreshed-vs-previous comparison report"""
+        refresh = self.metrics['refresh']
+        with open(f'{output_dir}/refresh_report.txt', 'w') as f:
+            f.write("RTB DSP Model Refresh Report\n")
+            f.write("="*60 + "\n\n")
+            f.write(f"Refresh Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.write(f"Version: {refresh['version']}\n")
+            f.write(f"Previous Models: {refresh['previous_dir']}\n")
+            f.write(f"Strategy: {refresh['strategy']}\n")
+            f.write(f"Window: {refresh['window_start']} to {refresh['window_end']}\n")
+            f.write(f"Samples: {refresh['train_samples']} train, {refresh['holdout_samples']} holdout\n")
+            
+            for name in ('ctr', 'cvr'):
+                previous = refresh['previous_on_holdout'][name]
+                f.write(f"\n{name.upper()} Model on Holdout (previous -> refreshed):\n")
+                f.write("-"*40 + "\n")
+                for metric, value in self.metrics[name].items():
+                    change = value - previous[metric] if None not in (value, previous[metric]) else None
+                    f.write(f"  {metric}: {format_metric(previous[metric])} -> {format_metric(value)} "
+                            f"({format_metric(change, '{:+.4f}')})\n")
+        
+        print(f"Refresh report saved to {output_dir}/refresh_report.txt")
+        print("\nHoldout AUC (previous -> refreshed):")
+        for name in ('ctr', 'cvr'):
+            previous = refresh['previous_on_holdout'][name]['auc']
+            print(f"  {name.upper()}: {format_metric(previous)} -> {format_metric(self.metrics[name]['auc'])}")
     
     def generate_report(self):
         """Generate training report"""
@@ -287,17 +978,47 @@ class CTRCVRModelTrainer:
             f.write("RTB DSP Model Training Report\n")
             f.write("="*60 + "\n\n")
             f.write(f"Training Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Dataset: {self.data_path}\n\n")
+            f.write(f"Dataset: {self.data_path}\n")
+            f.write(f"Formulation: {self.formulation}\n\n")
             
             f.write("CTR Model Performance:\n")
             f.write("-"*40 + "\n")
             for metric, value in self.metrics['ctr'].items():
-                f.write(f"  {metric}: {value:.4f}\n")
+                f.write(f"  {metric}: {format_metric(value)}\n")
             
             f.write("\nCVR Model Performance:\n")
             f.write("-"*40 + "\n")
             for metric, value in self.metrics['cvr'].items():
-                f.write(f"  {metric}: {value:.4f}\n")
+                f.write(f"  {metric}: {format_metric(value)}\n")
+            
+            if 'ctcvr' in self.metrics:
+                f.write("\nCTCVR Model Performance (all impressions):\n")
+                f.write("-"*40 + "\n")
+                for metric, value in self.metrics['ctcvr'].items():
+                    f.write(f"  {metric}: {format_metric(value)}\n")
+            
+            for name, evaluation in self.metrics.get('evaluation', {}).items():
+                overall = evaluation['overall']
+                f.write(f"\n{name.upper()} Validation Breakdown:\n")
+                f.write("-"*40 + "\n")
+                f.write(f"  expected_calibration_error: {format_metric(overall['expected_calibration_error'])}\n")
+                for key, breakdown in evaluation.items():
+                    if key == 'overall':
+                        continue
+                    aucs = ', '.join(
+                        f"{value}={format_metric(metrics['auc'], '{:.3f}')}"
+                        for value, metrics in breakdown.items()
+                    )
+                    f.write(f"  auc {key.replace('_', ' ', 1)}: {aucs}\n")
+            
+            for name, search in self.metrics.get('search', {}).items():
+                best = search['best']
+                f.write(f"\n{name.upper()} Hyperparameter Search:\n")
+                f.write("-"*40 + "\n")
+                f.write(f"  trials: {len(search['trials'])}\n")
+                f.write(f"  best config: {best['config']}\n")
+                f.write(f"  best auc: {best['auc']:.4f}\n")
+                f.write(f"  best log_loss: {best['log_loss']:.4f}\n")
             
             f.write("\nFeatures Used:\n")
             f.write("-"*40 + "\n")
@@ -307,17 +1028,145 @@ class CTRCVRModelTrainer:
         print("Training report saved to models/training_report.txt")
 
 
+# Per-process state for hyperparameter search workers
+_search_state = {}
+
+
+def _init_search_worker(X_train, y_train, X_val, y_val, nthread):
+    """Process pool initializer: bin the training data once per worker"""
+    dtrain = xgb.QuantileDMatrix(X_train, label=y_train, feature_names=FEATURE_COLUMNS, nthread=nthread)
+    _search_state.update(
+        dtrain=dtrain,
+        dval=xgb.QuantileDMatrix(X_val, label=y_val, ref=dtrain, feature_names=FEATURE_COLUMNS, nthread=nthread),
+        X_val=X_val,
+        y_val=y_val,
+    )
+
+
+def _run_trial(task):
+    """Process pool worker: boost one configuration for one rung"""
+    params, num_boost_round, early_stopping_rounds, model = task
+    dtrain, dval = _search_state['dtrain'], _search_state['dval']
+    X_val, y_val = _search_state['X_val'], _search_state['y_val']
+    
+    start = time.perf_counter()
+    booster = xgb.train(
+        params, dtrain, num_boost_round=num_boost_round,
+        evals=[(dval, 'validation')], early_stopping_rounds=early_stopping_rounds,
+        xgb_model=None if model is None else xgb.Booster(model_file=model),
+        verbose_eval=False
+    )
+    train_seconds = time.perf_counter() - start
+    
+    # Stopped early if the best iteration is well before the last one;
+    # best_iteration counts the resumed model's trees too
+    n_trees = booster.num_boosted_rounds()
+    best_iteration = int(booster.attr('best_iteration') or n_trees - 1)
+    stopped = n_trees - 1 - best_iteration >= early_stopping_rounds
+    
+    # The next rung resumes from the best iteration, not the overshoot
+    booster = booster[:best_iteration + 1]
+    n_trees = best_iteration + 1
+    y_pred_proba = booster.inplace_predict(X_val)
+    
+    # Inference cost (microseconds per row) at a few tree counts
+    sample = X_val[:10000]
+    inference_us_per_row = {}
+    for trees in sorted({max(1, n_trees // 4), max(1, n_trees // 2), n_trees}):
+        start = time.perf_counter()
+        booster.inplace_predict(sample, iteration_range=(0, trees))
+        inference_us_per_row[trees] = (time.perf_counter() - start) / len(sample) * 1e6
+    
+    return {
+        'best_iteration': best_iteration,
+        'auc': float(roc_auc_score(y_val, y_pred_proba)),
+        'log_loss': float(log_loss(y_val, y_pred_proba)),
+        'train_seconds': train_seconds,
+        'inference_us_per_row': inference_us_per_row,
+        'status': 'early_stopped' if stopped else 'running',
+        'model': booster.save_raw(),
+    }
+
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Train the CTR/CVR models')
+    parser.add_argument('--data', default=None,
+                        help='CSV file, columnar directory or shard directory '
+                             '(default: rtb_dataset/ if present, else rtb_dataset.csv)')
+    parser.add_argument('--mode', choices=['memory', 'stream', 'shared'], default='memory',
+                        help='stream trains out-of-core from chunks read off disk; '
+                             'shared trains CTR and CVR concurrently on one quantized matrix')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help='rows per chunk in stream mode; bounds peak memory')
+    parser.add_argument('--external-memory', action='store_true',
+                        help='in stream mode, keep XGBoost pages on disk instead of a quantized in-RAM matrix')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='total cores for --mode shared (default: all)')
+    parser.add_argument('--ctr-thread-share', type=float, default=0.75,
+                        help='fraction of --threads given to the CTR booster in --mode shared')
+    parser.add_argument('--formulation', choices=FORMULATIONS, default='split',
+                        help='split trains CVR on clicked rows only; esmm trains CTR and pCTCVR on '
+                             'all impressions and serves CVR = pCTCVR / pCTR (memory and stream modes)')
+    parser.add_argument('--search-trials', type=int, default=0,
+                        help='in memory mode, run a hyperparameter search with this many trials per model first')
+    parser.add_argument('--search-workers', type=int, default=None,
+                        help='process pool size for the search (default: CPU count / --threads-per-trial)')
+    parser.add_argument('--threads-per-trial', type=int, default=1)
+    parser.add_argument('--export-lookup', action='store_true',
+                        help='also export the lookup table for MODEL_ENGINE=lookup (memory grows '
+                             'exponentially with max_depth)')
+    parser.add_argument('--lookup-max-cells', type=int, default=LOOKUP_MAX_CELLS,
+                        help='skip the lookup table export above this many float32 cells')
+    parser.add_argument('--refresh', action='store_true',
+                        help='warm-start from --previous on the newest time window instead of training from scratch')
+    parser.add_argument('--previous', default=None,
+                        help='model directory to refresh from (default: newest version under --versions-dir, '
+                             'else models)')
+    parser.add_argument('--versions-dir', default='models/versions',
+                        help='refreshed models go to a new timestamped directory under this one')
+    parser.add_argument('--window-days', type=int, default=7,
+                        help='size of the newest time window used by --refresh')
+    parser.add_argument('--since', default=None,
+                        help='explicit window start (ISO timestamp), overrides --window-days')
+    parser.add_argument('--refresh-strategy', choices=['add', 'refresh'], default='add',
+                        help='add new trees, or re-fit the leaf values of the existing ones')
+    parser.add_argument('--refresh-rounds', type=int, default=50,
+                        help='maximum trees added per model with --refresh-strategy add')
+    return parser.parse_args()
+
+
 def main():
     """Main training script"""
+    args = parse_args()
+    
     print("="*60)
     print("RTB DSP CTR/CVR Model Training")
     print("="*60)
     
+    # Prefer the columnar dataset when the generator wrote one
+    data_path = args.data or ('rtb_dataset' if is_columnar('rtb_dataset') else 'rtb_dataset.csv')
+    
     # Initialize trainer
-    trainer = CTRCVRModelTrainer(data_path='rtb_dataset.csv')
+    trainer = CTRCVRModelTrainer(data_path=data_path, formulation=args.formulation,
+                                 export_lookup=args.export_lookup, lookup_max_cells=args.lookup_max_cells)
+    
+    if args.refresh:
+        output_dir = trainer.refresh(
+            previous_dir=args.previous, versions_dir=args.versions_dir, since=args.since,
+            window_days=args.window_days, strategy=args.refresh_strategy,
+            extra_rounds=args.refresh_rounds
+        )
+        print(f"\nRefreshed models written to {output_dir}/")
+        return
     
     # Train models
-    trainer.train()
+    trainer.train(
+        mode=args.mode, chunk_size=args.chunk_size, external_memory=args.external_memory,
+        threads=args.threads, ctr_thread_share=args.ctr_thread_share,
+        search_trials=args.search_trials, search_workers=args.search_workers,
+        threads_per_trial=args.threads_per_trial
+    )
 
 
 if __name__ == "__main__":
@@ -7,17 +7,77 @@ import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 import random
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from columnar import ColumnarWriter
 
 # Set random seed for reproducibility
 np.random.seed(42)
 random.seed(42)
 
+# Sampling distributions shared by the row-by-row and vectorized engines
+DEVICE_WEIGHTS = [0.3, 0.5, 0.2]
+FREQUENCY_WEIGHTS = [0.3, 0.25, 0.15, 0.1, 0.08, 0.05, 0.03, 0.02, 0.01, 0.005, 0.003, 0.002, 0.001, 0.0005, 0.0005]
+COMPETITION_WEIGHTS = [0.1, 0.2, 0.4, 0.2, 0.1]
+PEAK_HOURS = [9, 10, 11, 12, 13, 14, 18, 19, 20, 21]
+
+
+class DatasetStats:
+    """Running dataset statistics, updated one chunk at a time"""
+    
+    def __init__(self):
+        self.total = 0
+        self.clicks = 0
+        self.conversions = 0
+        self.columns = []
+        self.device_counts = np.zeros(3, dtype=np.int64)
+        self.category_counts = np.zeros(10, dtype=np.int64)
+    
+    def update(self, df):
+        """Fold one chunk into the running totals"""
+        if not self.columns:
+            self.columns = list(df.columns)
+        
+        self.total += len(df)
+        self.clicks += int(df['clicked'].sum())
+        self.conversions += int(df['converted'].sum())
+        self.device_counts += np.bincount(df['device_type'], minlength=3)
+        self.category_counts += np.bincount(df['ad_category'], minlength=10)
+    
+    def merge(self, other):
+        """Fold another DatasetStats (e.g. from a shard) into this one"""
+        if not self.columns:
+            self.columns = list(other.columns)
+        
+        self.total += other.total
+        self.clicks += other.clicks
+        self.conversions += other.conversions
+        self.device_counts += other.device_counts
+        self.category_counts += other.category_counts
+    
+    @property
+    def click_rate(self):
+        return self.clicks / self.total if self.total else 0.0
+    
+    @property
+    def conversion_rate(self):
+        return self.conversions / self.clicks if self.clicks else 0.0
+
 
 class RTBDatasetGenerator:
     """Generate realistic RTB auction data for training"""
     
-    def __init__(self, num_samples=100000):
+    def __init__(self, num_samples=100000, seed=42, start_date=None):
         self.num_samples = num_samples
+        self.seed = seed
+        
+        # Fixed once so every chunk and shard shares the same 90-day window
+        if start_date is None:
+            start_date = datetime.now() - timedelta(days=90)
+        self.start_date = start_date
         
         # Device performance baselines
         self.device_ctr = {0: 0.052, 1: 0.038, 2: 0.045}  # Desktop, Mobile, Tablet
@@ -41,6 +101,24 @@ class RTBDatasetGenerator:
             0: 0.025, 1: 0.032, 2: 0.018, 3: 0.042, 4: 0.035,
             5: 0.028, 6: 0.022, 7: 0.038, 8: 0.015, 9: 0.020,
         }
+        
+        self._build_lookup_tables()
+    
+    def _build_lookup_tables(self):
+        """Tabulate the per-feature multipliers for the vectorized engine"""
+        # Built from the scalar helpers so both engines share one definition
+        self.device_ctr_table = np.array([self.device_ctr[d] for d in range(3)])
+        self.device_cvr_table = np.array([self.device_cvr[d] for d in range(3)])
+        self.category_ctr_table = np.array([self.category_ctr[c] for c in range(10)]) / 0.04
+        self.category_cvr_table = np.array([self.category_cvr[c] for c in range(10)]) / 0.02
+        self.time_table = np.array([self.get_time_multiplier(h) for h in range(24)])
+        self.frequency_table = np.array([self.get_frequency_decay(c) for c in range(15)])
+        self.age_ctr_table = np.array([self.get_age_multiplier(a)['ctr'] for a in range(66)])
+        self.age_cvr_table = np.array([self.get_age_multiplier(a)['cvr'] for a in range(66)])
+        self.geo_table = np.array([self.get_geo_multiplier(l) for l in range(10)])
+        self.peak_hour_table = np.isin(np.arange(24), PEAK_HOURS).astype(np.int64)
+        
+        self.frequency_probs = np.array(FREQUENCY_WEIGHTS) / sum(FREQUENCY_WEIGHTS)
     
     def get_time_multiplier(self, hour):
         """Time of day engagement multiplier"""
@@ -135,10 +213,79 @@ class RTBDatasetGenerator:
         
         return cvr
     
-    def generate_dataset(self):
+    def generate_arrays(self, n, rng, start_date):
+        """Draw n samples as NumPy columns (vectorized engine)"""
+        # Timestamps, with hour and weekday taken straight from datetime64
+        offsets = rng.integers(0, 90 * 24 * 3600, size=n, endpoint=True)
+        timestamp = np.datetime64(start_date, 'us') + offsets.astype('timedelta64[s]')
+        days = timestamp.astype('datetime64[D]')
+        hour_of_day = (timestamp - days).astype('timedelta64[h]').astype(np.int64)
+        day_of_week = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+        
+        # Features
+        user_age = rng.integers(18, 65, size=n, endpoint=True)
+        device_type = rng.choice(3, size=n, p=DEVICE_WEIGHTS)
+        location = rng.integers(0, 10, size=n)
+        ad_category = rng.integers(0, 10, size=n)
+        frequency_count = rng.choice(15, size=n, p=self.frequency_probs)
+        floor_price = np.round(rng.uniform(0.5, 3.0, size=n), 2)
+        competition_level = rng.choice(5, size=n, p=COMPETITION_WEIGHTS)
+        
+        # True CTR: same multipliers as calculate_ctr, as table gathers
+        freq_factor = self.frequency_table[frequency_count]
+        geo_factor = self.geo_table[location]
+        true_ctr = (
+            self.device_ctr_table[device_type] * self.category_ctr_table[ad_category]
+            * self.time_table[hour_of_day] * freq_factor
+            * self.age_ctr_table[user_age] * geo_factor
+        )
+        true_ctr = np.clip(true_ctr + rng.normal(0, 0.005, size=n), 0.001, 0.99)
+        
+        # Simulate clicks (Bernoulli trials)
+        clicked = rng.random(n) < true_ctr
+        
+        # True CVR: same multipliers as calculate_cvr, zeroed for non-clicks
+        true_cvr = (
+            self.device_cvr_table[device_type] * self.category_cvr_table[ad_category]
+            * freq_factor * self.age_cvr_table[user_age] * geo_factor
+        )
+        true_cvr = np.clip(true_cvr + rng.normal(0, 0.003, size=n), 0.001, 0.99)
+        
+        # Simulate conversions (Bernoulli trials)
+        converted = clicked & (rng.random(n) < true_cvr)
+        true_cvr = np.where(clicked, true_cvr, 0.0)
+        
+        return {
+            'timestamp': timestamp,
+            'user_age': user_age,
+            'device_type': device_type,
+            'location': location,
+            'hour_of_day': hour_of_day,
+            'day_of_week': day_of_week,
+            'ad_category': ad_category,
+            'frequency_count': frequency_count,
+            'floor_price': floor_price,
+            'competition_level': competition_level,
+            'clicked': clicked.astype(np.int64),
+            'converted': converted.astype(np.int64),
+            'true_ctr': true_ctr,
+            'true_cvr': true_cvr,
+            'is_weekend': (day_of_week >= 5).astype(np.int64),
+            'is_peak_hour': self.peak_hour_table[hour_of_day],
+            'is_mobile': (device_type == 1).astype(np.int64),
+        }
+    
+    def generate_dataset(self, vectorized=False):
         """Generate complete dataset"""
         print(f"Generating {self.num_samples} samples...")
         
+        # One chunk of every row; with no rows, an empty frame with the same columns
+        if vectorized or self.num_samples <= 0:
+            df = pd.DataFrame(self.generate_arrays(max(self.num_samples, 0), np.random.default_rng(self.seed),
+                                                   self.start_date))
+            self._print_summary(df)
+            return df
+        
         data = []
         start_date = datetime.now() - timedelta(days=90)
         
@@ -151,17 +298,14 @@ class RTBDatasetGenerator:
             features = {
                 'timestamp': timestamp,
                 'user_age': random.randint(18, 65),
-                'device_type': random.choices([0, 1, 2], weights=[0.3, 0.5, 0.2])[0],
+                'device_type': random.choices([0, 1, 2], weights=DEVICE_WEIGHTS)[0],
                 'location': random.randint(0, 9),
                 'hour_of_day': timestamp.hour,
                 'day_of_week': timestamp.weekday(),
                 'ad_category': random.randint(0, 9),
-                'frequency_count': random.choices(
-                    range(15), 
-                    weights=[0.3, 0.25, 0.15, 0.1, 0.08, 0.05, 0.03, 0.02, 0.01, 0.005, 0.003, 0.002, 0.001, 0.0005, 0.0005]
-                )[0],
+                'frequency_count': random.choices(range(15), weights=FREQUENCY_WEIGHTS)[0],
                 'floor_price': round(random.uniform(0.5, 3.0), 2),
-                'competition_level': random.choices([0, 1, 2, 3, 4], weights=[0.1, 0.2, 0.4, 0.2, 0.1])[0],
+                'competition_level': random.choices([0, 1, 2, 3, 4], weights=COMPETITION_WEIGHTS)[0],
             }
             
             # Calculate true CTR and CVR
@@ -191,51 +335,204 @@ class RTBDatasetGenerator:
         
         # Add derived features
         df['is_weekend'] = df['day_of_week'].isin([5, 6]).astype(int)
-        df['is_peak_hour'] = df['hour_of_day'].isin([9, 10, 11, 12, 13, 14, 18, 19, 20, 21]).astype(int)
+        df['is_peak_hour'] = df['hour_of_day'].isin(PEAK_HOURS).astype(int)
         df['is_mobile'] = (df['device_type'] == 1).astype(int)
         
-        print(f"\nDataset generated successfully!")
-        print(f"Total samples: {len(df)}")
-        print(f"Clicks: {df['clicked'].sum()} ({df['clicked'].mean()*100:.2f}%)")
-        print(f"Conversions: {df['converted'].sum()} ({df['converted'].sum()/df['clicked'].sum()*100:.2f}% of clicks)")
-        
+        self._print_summary(df)
         return df
+    
+    def iter_chunks(self, chunk_size=100000, rng=None):
+        """Yield the dataset as DataFrames of at most chunk_size rows"""
+        if rng is None:
+            rng = np.random.default_rng(self.seed)
+        
+        for start in range(0, self.num_samples, chunk_size):
+            n = min(chunk_size, self.num_samples - start)
+            yield pd.DataFrame(self.generate_arrays(n, rng, self.start_date))
+    
+    def stream_to_csv(self, output_file, chunk_size=100000, rng=None, verbose=True):
+        """Write the dataset to CSV chunk by chunk, keeping memory flat"""
+        if verbose:
+            print(f"Streaming {self.num_samples} samples to {output_file} in chunks of {chunk_size}...")
+        
+        stats = DatasetStats()
+        with open(output_file, 'w', newline='') as f:
+            for chunk in self.iter_chunks(chunk_size, rng=rng):
+                chunk.to_csv(f, header=stats.total == 0, index=False)
+                stats.update(chunk)
+                if verbose:
+                    print(f"Generated {stats.total}/{self.num_samples} samples...")
+        
+        return stats
+    
+    def stream_to_columnar(self, output_dir, chunk_size=100000, rng=None, verbose=True):
+        """Write the dataset as narrow-dtype .npy columns chunk by chunk"""
+        if verbose:
+            print(f"Streaming {self.num_samples} samples to {output_dir}/ in chunks of {chunk_size}...")
+        
+        stats = DatasetStats()
+        with ColumnarWriter(output_dir, self.num_samples) as writer:
+            for chunk in self.iter_chunks(chunk_size, rng=rng):
+                writer.write(chunk)
+                stats.update(chunk)
+                if verbose:
+                    print(f"Generated {stats.total}/{self.num_samples} samples...")
+        
+        return stats
+    
+    def generate_shards(self, output_dir, num_shards, workers=None, chunk_size=100000, fmt='csv'):
+        """Generate the dataset as shard files across a process pool
+        
+        Shard i draws from the i-th child of SeedSequence(seed), so shard
+        contents depend only on seed, num_shards and start_date, never on
+        the number of workers.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Split rows evenly; the first (num_samples % num_shards) shards get one extra
+        base, extra = divmod(self.num_samples, num_shards)
+        seed_seqs = np.random.SeedSequence(self.seed).spawn(num_shards)
+        suffix = '.csv' if fmt == 'csv' else ''
+        tasks = [
+            (os.path.join(output_dir, f'shard-{i:05d}{suffix}'), base + (i < extra),
+             self.seed, seed_seqs[i], self.start_date, chunk_size, fmt)
+            for i in range(num_shards)
+        ]
+        
+        print(f"Generating {self.num_samples} samples as {num_shards} shards "
+              f"on {workers or os.cpu_count()} workers...")
+        
+        stats = DatasetStats()
+        shards = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for task, shard_stats in zip(tasks, pool.map(_write_shard, tasks)):
+                stats.merge(shard_stats)
+                shards.append({
+                    'path': os.path.basename(task[0]),
+                    'rows': shard_stats.total,
+                    'clicks': shard_stats.clicks,
+                    'conversions': shard_stats.conversions,
+                    'spawn_key': list(task[3].spawn_key),
+                })
+                print(f"Shard {len(shards)}/{num_shards} written ({stats.total}/{self.num_samples} samples)")
+        
+        # Manifest listing every shard
+        manifest = {
+            'seed': self.seed,
+            'num_samples': self.num_samples,
+            'num_shards': num_shards,
+            'format': fmt,
+            'start_date': self.start_date.isoformat(),
+            'columns': stats.columns,
+            'shards': shards,
+        }
+        with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        
+        return stats
+    
+    def _print_summary(self, df):
+        """Print generation summary"""
+        print(f"\nDataset generated successfully!")
+        stats = DatasetStats()
+        stats.update(df)
+        print(f"Total samples: {stats.total}")
+        print(f"Clicks: {stats.clicks} ({stats.click_rate*100:.2f}%)")
+        print(f"Conversions: {stats.conversions} ({stats.conversion_rate*100:.2f}% of clicks)")
+
+
+def _write_shard(task):
+    """Process pool worker: stream one shard to disk from its own RNG stream"""
+    path, num_samples, seed, seed_seq, start_date, chunk_size, fmt = task
+    generator = RTBDatasetGenerator(num_samples=num_samples, seed=seed, start_date=start_date)
+    rng = np.random.default_rng(seed_seq)
+    if fmt == 'npy':
+        return generator.stream_to_columnar(path, chunk_size=chunk_size, rng=rng, verbose=False)
+    return generator.stream_to_csv(path, chunk_size=chunk_size, rng=rng, verbose=False)
+
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Generate the synthetic RTB dataset')
+    parser.add_argument('--num-samples', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None,
+                        help='output path (default: rtb_dataset.csv, or rtb_dataset/ for --format npy)')
+    parser.add_argument('--format', choices=['csv', 'npy'], default='csv',
+                        help='npy writes a directory of narrow-dtype .npy columns the trainer can memory-map')
+    parser.add_argument('--stream', action='store_true',
+                        help='write chunks straight to disk instead of building one DataFrame')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--shards', type=int, default=0,
+                        help='write this many shard files plus a manifest under --output-dir')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='process pool size for --shards (default: CPU count)')
+    parser.add_argument('--output-dir', default='rtb_dataset_shards')
+    parser.add_argument('--start-date', type=datetime.fromisoformat, default=None,
+                        help='start of the 90-day timestamp window; fix it for reproducible shards')
+    return parser.parse_args()
 
 
 def main():
     """Generate and save dataset"""
-    # Generate dataset
-    generator = RTBDatasetGenerator(num_samples=100000)
-    df = generator.generate_dataset()
+    args = parse_args()
+    generator = RTBDatasetGenerator(
+        num_samples=args.num_samples, seed=args.seed, start_date=args.start_date
+    )
+    output_file = args.output or ('rtb_dataset.csv' if args.format == 'csv' else 'rtb_dataset')
     
-    # Save to CSV
-    output_file = 'rtb_dataset.csv'
-    df.to_csv(output_file, index=False)
+    if args.shards:
+        # One file per shard, generated across a process pool
+        stats = generator.generate_shards(
+            args.output_dir, args.shards, workers=args.workers,
+            chunk_size=args.chunk_size, fmt=args.format
+        )
+        output_file = os.path.join(args.output_dir, 'manifest.json')
+    elif args.stream and args.format == 'npy':
+        stats = generator.stream_to_columnar(output_file, chunk_size=args.chunk_size)
+    elif args.stream:
+        # Stream chunks to CSV; statistics are accumulated as we go
+        stats = generator.stream_to_csv(output_file, chunk_size=args.chunk_size)
+    else:
+        # Generate dataset
+        df = generator.generate_dataset(vectorized=True)
+        
+        # Save to CSV or columnar directory
+        if args.format == 'npy':
+            with ColumnarWriter(output_file, len(df)) as writer:
+                writer.write(df)
+        else:
+            df.to_csv(output_file, index=False)
+        
+        stats = DatasetStats()
+        stats.update(df)
     print(f"\nDataset saved to {output_file}")
     
     # Display statistics
     print("\n" + "="*60)
     print("DATASET STATISTICS")
     print("="*60)
-    print(f"\nShape: {df.shape}")
-    print(f"\nFeatures: {list(df.columns)}")
-    print(f"\nClick Rate (CTR): {df['clicked'].mean()*100:.2f}%")
-    print(f"Conversion Rate (CVR): {df['converted'].sum()/df['clicked'].sum()*100:.2f}%")
+    print(f"\nShape: ({stats.total}, {len(stats.columns)})")
+    print(f"\nFeatures: {stats.columns}")
+    print(f"\nClick Rate (CTR): {stats.click_rate*100:.2f}%")
+    print(f"Conversion Rate (CVR): {stats.conversion_rate*100:.2f}%")
     print(f"\nDevice Distribution:")
-    print(df['device_type'].value_counts(normalize=True) * 100)
+    for device, count in enumerate(stats.device_counts):
+        print(f"  {device}: {count / max(stats.total, 1) * 100:.2f}%")
     print(f"\nCategory Distribution:")
-    print(df['ad_category'].value_counts(normalize=True) * 100)
+    for category, count in enumerate(stats.category_counts):
+        print(f"  {category}: {count / max(stats.total, 1) * 100:.2f}%")
     
     # Save summary
     with open('dataset_summary.txt', 'w') as f:
         f.write("RTB Dataset Summary\n")
         f.write("="*60 + "\n\n")
-        f.write(f"Total Samples: {len(df)}\n")
-        f.write(f"Features: {len(df.columns)}\n")
-        f.write(f"Click Rate: {df['clicked'].mean()*100:.2f}%\n")
-        f.write(f"Conversion Rate: {df['converted'].sum()/df['clicked'].sum()*100:.2f}%\n")
+        f.write(f"Total Samples: {stats.total}\n")
+        f.write(f"Features: {len(stats.columns)}\n")
+        f.write(f"Click Rate: {stats.click_rate*100:.2f}%\n")
+        f.write(f"Conversion Rate: {stats.conversion_rate*100:.2f}%\n")
         f.write(f"\nFeature List:\n")
-        for col in df.columns:
+        for col in stats.columns:
             f.write(f"  - {col}\n")
     
     print("\nSummary saved to dataset_summary.txt")
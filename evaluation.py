@@ -0,0 +1,354 @@
+"""
+RTB DSP Streaming Evaluation
+Mergeable metric state built chunk by chunk: bucketed AUC, log loss, confusion
+counts and calibration bins, overall and per device type, ad category and hour
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+# AUC histogram: equal-width bins in log-odds over [-LOGIT_RANGE, LOGIT_RANGE];
+# fine enough that the bucketed AUC stays within ~1e-4 of the exact value
+AUC_BINS = 4096
+LOGIT_RANGE = 12.0
+
+# Calibration bins over predicted probability (CTR/CVR live at the low end)
+CALIBRATION_EDGES = np.array([0.0, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0])
+
+# Breakdowns reported next to the overall metrics: feature column -> number of values
+SLICES = {'device_type': 3, 'ad_category': 10, 'hour_of_day': 24}
+
+# Probability clip for log loss
+EPS = 1e-15
+
+# Headline metrics, in the order the training report prints them
+SUMMARY_METRICS = ['accuracy', 'precision', 'recall', 'f1_score', 'auc', 'log_loss']
+
+# Reports written next to a model version; kept out of metrics.json, whose
+# every rewrite makes the servers reload
+EVALUATION_FILE = 'evaluation.json'
+
+
+def format_metric(value, pattern='{:.4f}'):
+    """Format a metric, or 'n/a' when it is undefined (no rows, or one class for AUC)"""
+    return pattern.format(value) if value is not None else 'n/a'
+
+
+class Evaluation:
+    """Sufficient statistics for binary classification metrics, updated one chunk at a time
+    
+    Every array is a sum over rows, so states built on different chunks,
+    shards or processes merge by addition and report the same metrics as
+    one pass over all the rows. Group 0 is overall; each slice value has
+    its own group after it.
+    """
+    
+    def __init__(self, slices=None):
+        self.slices = dict(SLICES if slices is None else slices)
+        self.offsets = {}
+        groups = 1
+        for name, size in self.slices.items():
+            self.offsets[name] = groups
+            groups += size
+        
+        calibration_bins = len(CALIBRATION_EDGES) - 1
+        self.positives = np.zeros((groups, AUC_BINS), dtype=np.int64)
+        self.negatives = np.zeros((groups, AUC_BINS), dtype=np.int64)
+        self.log_loss_sum = np.zeros(groups)
+        # tp, fp, fn, tn at a 0.5 threshold
+        self.confusion = np.zeros((groups, 4), dtype=np.int64)
+        # rows, summed prediction, summed label
+        self.calibration = np.zeros((groups, calibration_bins, 3))
+    
+    def update(self, y_true, y_pred, slice_values=None):
+        """Fold one chunk of labels and predicted probabilities into the state
+        
+        slice_values maps each slice name to its integer column for the chunk.
+        """
+        y = np.asarray(y_true).reshape(-1) > 0
+        p = np.clip(np.asarray(y_pred, dtype=np.float64).reshape(-1), EPS, 1 - EPS)
+        n = len(p)
+        if n == 0:
+            return self
+        
+        # Each row counts once overall and once in each slice
+        group_ids = [np.zeros(n, dtype=np.intp)]
+        for name, size in self.slices.items():
+            values = np.asarray(slice_values[name]).reshape(-1).astype(np.intp)
+            if values.min() < 0 or values.max() >= size:
+                raise ValueError(f"{name} values must be in [0, {size})")
+            group_ids.append(values + self.offsets[name])
+        group = np.concatenate(group_ids)
+        copies = len(group_ids)
+        groups = len(self.log_loss_sum)
+        
+        # Per-row quantities, computed once and repeated per group
+        logit = np.log(p) - np.log1p(-p)
+        score_bin = ((logit + LOGIT_RANGE) * (AUC_BINS / (2 * LOGIT_RANGE))).astype(np.intp)
+        score_bin = np.clip(score_bin, 0, AUC_BINS - 1)
+        loss = -np.where(y, np.log(p), np.log1p(-p))
+        predicted = p >= 0.5
+        cell = np.where(y, np.where(predicted, 0, 2), np.where(predicted, 1, 3))
+        calibration_bins = self.calibration.shape[1]
+        calibration_bin = np.clip(np.searchsorted(CALIBRATION_EDGES, p, side='right') - 1, 0, calibration_bins - 1)
+        
+        y_all = np.tile(y, copies)
+        auc_cell = group * AUC_BINS + np.tile(score_bin, copies)
+        self.positives += np.bincount(auc_cell[y_all], minlength=groups * AUC_BINS).reshape(groups, AUC_BINS)
+        self.negatives += np.bincount(auc_cell[~y_all], minlength=groups * AUC_BINS).reshape(groups, AUC_BINS)
+        self.log_loss_sum += np.bincount(group, weights=np.tile(loss, copies), minlength=groups)
+        self.confusion += np.bincount(group * 4 + np.tile(cell, copies), minlength=groups * 4).reshape(groups, 4)
+        
+        calibration_cell = group * calibration_bins + np.tile(calibration_bin, copies)
+        size = groups * calibration_bins
+        self.calibration[..., 0] += np.bincount(calibration_cell, minlength=size).reshape(groups, calibration_bins)
+        self.calibration[..., 1] += np.bincount(
+            calibration_cell, weights=np.tile(p, copies), minlength=size
+        ).reshape(groups, calibration_bins)
+        self.calibration[..., 2] += np.bincount(
+            calibration_cell, weights=y_all.astype(np.float64), minlength=size
+        ).reshape(groups, calibration_bins)
+        return self
+    
+    def update_features(self, y_true, y_pred, X, feature_columns):
+        """update() with the slice columns read from a feature matrix or frame"""
+        X = np.asarray(X)
+        slice_values = {name: X[:, feature_columns.index(name)] for name in self.slices}
+        return self.update(y_true, y_pred, slice_values)
+    
+    def merge(self, other):
+        """Fold another Evaluation (e.g. from a shard or worker) into this one"""
+        if other.slices != self.slices:
+            raise ValueError(f"Cannot merge evaluations over different slices: {self.slices} vs {other.slices}")
+        
+        self.positives += other.positives
+        self.negatives += other.negatives
+        self.log_loss_sum += other.log_loss_sum
+        self.confusion += other.confusion
+        self.calibration += other.calibration
+        return self
+    
+    def count(self, group=0):
+        return int(self.confusion[group].sum())
+    
+    def auc(self, group=0):
+        """ROC AUC from the score histograms; rows sharing a bin count as ties"""
+        positives = self.positives[group].astype(np.float64)
+        negatives = self.negatives[group].astype(np.float64)
+        total_positives, total_negatives = positives.sum(), negatives.sum()
+        if total_positives == 0 or total_negatives == 0:
+            return None
+        
+        negatives_below = np.cumsum(negatives) - negatives
+        wins = (positives * (negatives_below + 0.5 * negatives)).sum()
+        return float(wins / (total_positives * total_negatives))
+    
+    def metrics(self, group=0):
+        """Scalar metrics of one group, or None if it saw no rows"""
+        tp, fp, fn, tn = (int(value) for value in self.confusion[group])
+        count = tp + fp + fn + tn
+        if count == 0:
+            return None
+        
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        return {
+            'accuracy': (tp + tn) / count,
+            'precision': precision,
+            'recall': recall,
+            'f1_score': f1,
+            'auc': self.auc(group),
+            'log_loss': float(self.log_loss_sum[group] / count),
+            'count': count,
+            'positive_rate': (tp + fn) / count,
+        }
+    
+    def summary(self):
+        """Overall headline metrics, in compute_metrics' keys; None where undefined"""
+        metrics = self.metrics(0) or {}
+        return {name: metrics.get(name) for name in SUMMARY_METRICS}
+    
+    def calibration_table(self, group=0):
+        """Non-empty calibration bins with mean prediction vs observed rate, and the ECE"""
+        bins = []
+        error = 0.0
+        for index, (rows, predicted, observed) in enumerate(self.calibration[group]):
+            if rows == 0:
+                continue
+            bins.append({
+                'lower': float(CALIBRATION_EDGES[index]),
+                'upper': float(CALIBRATION_EDGES[index + 1]),
+                'count': int(rows),
+                'mean_predicted': float(predicted / rows),
+                'observed_rate': float(observed / rows),
+            })
+            error += abs(predicted - observed)
+        total = self.count(group)
+        return bins, (float(error / total) if total else None)
+    
+    def report(self):
+        """JSON-ready metrics: overall with calibration, then one entry per slice value"""
+        bins, ece = self.calibration_table(0)
+        overall = self.metrics(0) or dict(self.summary(), count=0, positive_rate=None)
+        report = {'overall': dict(overall, expected_calibration_error=ece, calibration=bins)}
+        for name, size in self.slices.items():
+            breakdown = {}
+            for value in range(size):
+                metrics = self.metrics(self.offsets[name] + value)
+                if metrics is not None:
+                    breakdown[str(value)] = metrics
+            report[f'by_{name}'] = breakdown
+        return report
+    
+    def to_arrays(self, prefix=''):
+        return {
+            f'{prefix}positives': self.positives,
+            f'{prefix}negatives': self.negatives,
+            f'{prefix}log_loss_sum': self.log_loss_sum,
+            f'{prefix}confusion': self.confusion,
+            f'{prefix}calibration': self.calibration,
+        }
+    
+    @classmethod
+    def from_arrays(cls, arrays, slices, prefix=''):
+        evaluation = cls(slices)
+        for name, array in evaluation.to_arrays().items():
+            loaded = arrays[f'{prefix}{name}']
+            if loaded.shape != array.shape:
+                raise ValueError(f"Saved {name} has shape {loaded.shape}, expected {array.shape}")
+            setattr(evaluation, name, loaded.astype(array.dtype))
+        return evaluation
+
+
+def save_states(path, evaluations):
+    """Write {model name: Evaluation} to one .npz for a later merge"""
+    arrays = {}
+    slices = {}
+    for name, evaluation in evaluations.items():
+        arrays.update(evaluation.to_arrays(f'{name}.'))
+        slices[name] = evaluation.slices
+    arrays['slices'] = np.array(json.dumps(slices))
+    np.savez(path, **arrays)
+
+
+def load_states(path):
+    """Read a save_states() file back into {model name: Evaluation}"""
+    with np.load(path) as arrays:
+        slices = json.loads(str(arrays['slices']))
+        return {name: Evaluation.from_arrays(arrays, model_slices, f'{name}.')
+                for name, model_slices in slices.items()}
+
+
+def merge_states(paths):
+    """Merge saved partial states, model by model"""
+    merged = {}
+    for path in paths:
+        for name, evaluation in load_states(path).items():
+            if name in merged:
+                merged[name].merge(evaluation)
+            else:
+                merged[name] = evaluation
+    return merged
+
+
+def evaluate_dataset(bundle, data_path, chunk_size=100000):
+    """Stream a holdout through a loaded ModelBundle; CTR on impressions, CVR on clicks"""
+    from columnar import iter_chunks
+    
+    columns = list(bundle.feature_columns) + ['clicked', 'converted']
+    ctr_evaluation, cvr_evaluation = Evaluation(), Evaluation()
+    for chunk in iter_chunks(data_path, columns, chunk_size):
+        X = np.column_stack([chunk[name] for name in bundle.feature_columns]).astype(np.float32)
+        ctr, cvr, _ = bundle.score(X)
+        clicked = np.asarray(chunk['clicked']) > 0
+        
+        ctr_evaluation.update_features(chunk['clicked'], ctr, X, bundle.feature_columns)
+        cvr_evaluation.update_features(np.asarray(chunk['converted'])[clicked], cvr[clicked],
+                                       X[clicked], bundle.feature_columns)
+    return {'ctr': ctr_evaluation, 'cvr': cvr_evaluation}
+
+
+def write_evaluation(model_path, evaluations):
+    """Store the merged reports in a model directory's evaluation.json; returns its path"""
+    evaluation_path = os.path.join(model_path, EVALUATION_FILE)
+    tmp_path = evaluation_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({name: evaluation.report() for name, evaluation in evaluations.items()}, f, indent=2)
+    os.replace(tmp_path, evaluation_path)
+    return evaluation_path
+
+
+def print_report(evaluations):
+    for name, evaluation in evaluations.items():
+        report = evaluation.report()
+        overall = report['overall']
+        print(f"\n{name.upper()} ({overall['count']} rows):")
+        for metric in SUMMARY_METRICS + ['expected_calibration_error']:
+            print(f"  {metric}: {format_metric(overall[metric])}")
+        for slice_name in evaluation.slices:
+            aucs = ', '.join(
+                f"{value}={format_metric(metrics['auc'], '{:.3f}')}"
+                for value, metrics in report[f'by_{slice_name}'].items()
+            )
+            print(f"  auc by {slice_name}: {aucs}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chunked holdout evaluation with mergeable per-slice metrics')
+    parser.add_argument('--data', default=None,
+                        help='holdout to score: CSV file, columnar directory or sharded directory')
+    parser.add_argument('--model-dir', default='models', help='directory holding the trained models')
+    parser.add_argument('--version', default=None, help='model version to evaluate (default: newest)')
+    parser.add_argument('--engine', default='auto', choices=['auto', 'xgboost', 'compiled', 'lookup'],
+                        help='scoring engine, as for MODEL_ENGINE')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='rows per chunk')
+    parser.add_argument('--merge', nargs='+', default=None, metavar='STATE',
+                        help='combine saved partial states instead of scoring --data')
+    parser.add_argument('--save-state', default=None, metavar='PATH',
+                        help='write the (partial) state as .npz for a later --merge')
+    parser.add_argument('--write-evaluation', action='store_true',
+                        help="store the report in the model version's evaluation.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if (args.data is None) == (args.merge is None):
+        raise SystemExit("Pass exactly one of --data or --merge")
+    
+    print("="*60)
+    print("RTB DSP Streaming Evaluation")
+    print("="*60)
+    
+    from model_store import ModelStore
+    
+    store = None
+    if args.data is not None or args.write_evaluation:
+        store = ModelStore(args.model_dir, engine=args.engine)
+    
+    if args.merge:
+        print(f"\nMerging {len(args.merge)} partial states")
+        evaluations = merge_states(args.merge)
+    else:
+        bundle = store.load(args.version, warm=False) if args.version else store.active
+        print(f"\nScoring {args.data} with model version {bundle.version} ({bundle.engine})")
+        evaluations = evaluate_dataset(bundle, args.data, args.chunk_size)
+    
+    print_report(evaluations)
+    
+    if args.save_state:
+        save_states(args.save_state, evaluations)
+        print(f"\nPartial state saved to {args.save_state}")
+    
+    if args.write_evaluation:
+        version = args.version or store.target_version()
+        model_path = store.version_path(version)
+        print(f"\nEvaluation written to {write_evaluation(model_path, evaluations)}")
+
+
+if __name__ == "__main__":
+    main()
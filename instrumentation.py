@@ -0,0 +1,317 @@
+"""
+RTB DSP API Instrumentation
+Low-overhead histograms, counters and gauges, rendered in the Prometheus text
+format and optionally shared by all worker processes through memory-mapped files
+"""
+
+import array
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+
+# Seconds; roughly x2-x2.5 steps from 25us to 10s
+LATENCY_BUCKETS = [
+    0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+]
+
+# Rows per request, powers of two
+BATCH_SIZE_BUCKETS = [2 ** i for i in range(17)]
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Shared mode: each process keeps its series in <directory>/<pid>.db, a sparse
+# file mapped once. After a header holding the bytes in use come records of
+# (key length, value count), the key padded to 8 bytes, then float64 values
+SHARED_FILE_SIZE = 64 * 1024 * 1024
+_HEADER = struct.Struct('<Q')
+_RECORD = struct.Struct('<II')
+
+
+def _zeros(count):
+    return array.array('d', bytes(8 * count))
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+class Histogram:
+    """Fixed-bucket histogram over float64 slots: bucket counts (the last is +Inf), sum, count
+    
+    observe() is one bisect and three adds.
+    """
+    
+    def __init__(self, bounds, values=None):
+        self.bounds = bounds
+        self.values = _zeros(len(bounds) + 3) if values is None else values
+    
+    @property
+    def counts(self):
+        return self.values[:-2]
+    
+    @property
+    def sum(self):
+        return self.values[-2]
+    
+    @property
+    def count(self):
+        return int(self.values[-1])
+    
+    def observe(self, value):
+        values = self.values
+        values[bisect.bisect_left(self.bounds, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+    
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (estimate)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def _number(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _records(buffer):
+    """(key, offset, value count) of every complete record in a shared file"""
+    used = _HEADER.unpack_from(buffer)[0]
+    position = _HEADER.size
+    while position < used:
+        key_size, count = _RECORD.unpack_from(buffer, position)
+        key_start = position + _RECORD.size
+        offset = key_start + _padded(key_size)
+        yield bytes(buffer[key_start:key_start + key_size]).decode(), offset, count
+        position = offset + 8 * count
+
+
+def read_shared(directory):
+    """Yield (pid, key, values) for every series of every process sharing directory"""
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.db'):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size < _HEADER.size:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for key, offset, count in _records(buffer):
+                    yield int(filename[:-3]), key, struct.unpack_from(f'<{count}d', buffer, offset)
+
+
+class SharedValues:
+    """This process's float64 slots, in a memory-mapped file other processes read
+    
+    Only the owning process writes its file, so updates need no locking
+    across processes. A new record becomes visible once the header's
+    length covers it, and that is written last.
+    """
+    
+    def __init__(self, directory, size=SHARED_FILE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(os.path.join(directory, f'{os.getpid()}.db'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Sparse: pages are only allocated as records are written
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        
+        # A recycled pid reopens its predecessor's file and keeps adding to its totals
+        self.used = _HEADER.unpack_from(self.mmap)[0] or _HEADER.size
+        self.slots = {key: self._view(offset, count) for key, offset, count in _records(self.mmap)}
+    
+    def _view(self, offset, count):
+        return memoryview(self.mmap)[offset:offset + 8 * count].cast('d')
+    
+    def values(self, key, count):
+        """The float64 slots stored under key, zeroed when new; None once the file is full"""
+        view = self.slots.get(key)
+        if view is None:
+            encoded = key.encode()
+            key_start = self.used + _RECORD.size
+            offset = key_start + _padded(len(encoded))
+            end = offset + 8 * count
+            if end > len(self.mmap):
+                return None
+            _RECORD.pack_into(self.mmap, self.used, len(encoded), count)
+            self.mmap[key_start:key_start + len(encoded)] = encoded
+            view = self.slots[key] = self._view(offset, count)
+            self.used = end
+            _HEADER.pack_into(self.mmap, 0, end)
+        return view
+
+
+class MetricsRegistry:
+    """Named, labelled histograms, counters and gauges shared by all request threads
+    
+    With a directory, each process keeps its series in a memory-mapped file
+    there, and render() and quantiles() sum every process's file. Prefork
+    workers behind one socket then report the same totals whichever of them
+    answers a scrape. Counters and histograms of exited workers stay in the
+    sums, so they never go backwards; gauges only count live processes.
+    """
+    
+    def __init__(self, namespace='rtb', directory=None):
+        self.namespace = namespace
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.histograms = {}  # name -> (help, label names, bounds, {label values: Histogram})
+        self.counters = {}  # name -> (help, label names, {label values: float64 slot})
+        self.gauges = {}  # name -> (help, label names, {label values: float64 slot})
+        self.shared = None
+        self.overflow = False
+        os.register_at_fork(after_in_child=self._after_fork)
+    
+    def histogram(self, name, help_text, label_names, bounds=LATENCY_BUCKETS):
+        self.histograms[name] = (help_text, label_names, bounds, {})
+    
+    def counter(self, name, help_text, label_names):
+        self.counters[name] = (help_text, label_names, {})
+    
+    def gauge(self, name, help_text, label_names):
+        self.gauges[name] = (help_text, label_names, {})
+    
+    def _values(self, name, labels, count):
+        """Zeroed float64 slots for a new series, in the shared file when there is one"""
+        if self.directory is None:
+            return _zeros(count)
+        if self.shared is None:
+            self.shared = SharedValues(self.directory)
+        values = self.shared.values(json.dumps([name, list(labels)]), count)
+        if values is None:
+            if not self.overflow:
+                self.overflow = True
+                print(f"Metrics file in {self.directory} is full; new series are kept per process")
+            return _zeros(count)
+        return values
+    
+    def observe(self, name, labels, value):
+        _, _, bounds, series = self.histograms[name]
+        with self.lock:
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(bounds, self._values(name, labels, len(bounds) + 3))
+            histogram.observe(value)
+    
+    def _slot(self, name, labels, series):
+        slot = series.get(labels)
+        if slot is None:
+            slot = series[labels] = self._values(name, labels, 1)
+        return slot
+    
+    def inc(self, name, labels, amount=1):
+        series = self.counters[name][2]
+        with self.lock:
+            self._slot(name, labels, series)[0] += amount
+    
+    def set(self, name, labels, value):
+        """Set a gauge, or a counter mirrored from a total kept elsewhere"""
+        series = (self.gauges.get(name) or self.counters[name])[2]
+        with self.lock:
+            self._slot(name, labels, series)[0] = value
+    
+    def _after_fork(self):
+        # A child must not write into its parent's file; it starts its own
+        self.lock = threading.Lock()
+        if self.directory is not None:
+            self.shared = None
+            for definitions in (self.histograms, self.counters, self.gauges):
+                for definition in definitions.values():
+                    definition[-1].clear()
+    
+    def collect(self):
+        """{name: {label values: values}}, summed over every process sharing the directory"""
+        if self.directory is None:
+            with self.lock:
+                # Histogram series hold a Histogram, the others their slot
+                return {
+                    name: {
+                        labels: list(getattr(values, 'values', values))
+                        for labels, values in definition[-1].items()
+                    }
+                    for definitions in (self.histograms, self.counters, self.gauges)
+                    for name, definition in definitions.items()
+                }
+        
+        merged = {}
+        alive = {}
+        for pid, key, values in read_shared(self.directory):
+            name, labels = json.loads(key)
+            if name in self.gauges:
+                if pid not in alive:
+                    alive[pid] = _alive(pid)
+                if not alive[pid]:
+                    continue
+            totals = merged.setdefault(name, {}).setdefault(tuple(labels), [0.0] * len(values))
+            for i, value in enumerate(values):
+                totals[i] += value
+        return merged
+    
+    def quantiles(self, name, quantiles=(0.5, 0.95, 0.99)):
+        """{label values: {'count', 'p50', ...}} in milliseconds, for JSON summaries"""
+        bounds = self.histograms[name][2]
+        summaries = {}
+        for labels, values in self.collect().get(name, {}).items():
+            histogram = Histogram(bounds, values)
+            summaries[labels] = dict(
+                count=histogram.count,
+                **{f'p{int(q * 100)}': round(histogram.quantile(q) * 1000, 3) for q in quantiles}
+            )
+        return summaries
+    
+    def render(self, extra_lines=()):
+        """Prometheus text exposition of every metric"""
+        merged = self.collect()
+        lines = []
+        for kind, definitions in (('counter', self.counters), ('gauge', self.gauges)):
+            for name, (help_text, label_names, _) in definitions.items():
+                full_name = f'{self.namespace}_{name}'
+                lines += [f'# HELP {full_name} {help_text}', f'# TYPE {full_name} {kind}']
+                for values, (total,) in sorted(merged.get(name, {}).items()):
+                    labels = _labels(label_names, values)
+                    series = f'{full_name}{{{labels}}}' if labels else full_name
+                    lines.append(f'{series} {_number(total)}')
+        
+        for name, (help_text, label_names, bounds, _) in self.histograms.items():
+            full_name = f'{self.namespace}_{name}'
+            lines += [f'# HELP {full_name} {help_text}', f'# TYPE {full_name} histogram']
+            for values, slots in sorted(merged.get(name, {}).items()):
+                histogram = Histogram(bounds, slots)
+                labels = _labels(label_names, values)
+                prefix = f'{labels},' if labels else ''
+                cumulative = 0
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += int(count)
+                    lines.append(f'{full_name}_bucket{{{prefix}le="{bound:g}"}} {cumulative}')
+                lines.append(f'{full_name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+                lines.append(f'{full_name}_sum{{{labels}}} {histogram.sum:.9g}')
+                lines.append(f'{full_name}_count{{{labels}}} {histogram.count}')
+        
+        lines += list(extra_lines)
+        return '\n'.join(lines) + '\n'
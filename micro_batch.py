@@ -0,0 +1,90 @@
+"""
+RTB DSP Micro-Batching
+Gather concurrent single-row requests into one vectorized model call
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Dynamic batching: score queued rows together once the batch fills or the wait budget runs out
+    
+    Each row carries the context it must be scored with (the model bundle
+    it was built against); score_fn(X, context) is called once per context
+    present in a batch, so rows never cross to another model version.
+    """
+    
+    def __init__(self, score_fn, max_batch_size=64, max_wait_ms=2.0):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.rows = 0
+        
+        # Threads do not survive fork(), so prefork workers start their own
+        self._start()
+        os.register_at_fork(after_in_child=self._start)
+    
+    def _start(self):
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.worker.start()
+    
+    def score(self, row, context=None):
+        """Score one (1, n_features) row with context; blocks until its batch has been scored"""
+        future = Future()
+        self.pending.put((row, context, future))
+        return future.result()
+    
+    def _collect(self):
+        """Block for the first row, then take more until full or the deadline passes"""
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            # Almost always one group; a model swap mid-batch splits it in two
+            groups = {}
+            for row, context, future in self._collect():
+                groups.setdefault(context, []).append((row, future))
+            for context, batch in groups.items():
+                self._score_batch(batch, context)
+    
+    def _score_batch(self, batch, context):
+        futures = [future for _, future in batch]
+        try:
+            # Rows are copied out here, so callers may reuse their buffers
+            X = np.concatenate([row for row, _ in batch])
+            outputs = self.score_fn(X, context)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        
+        self.batches += 1
+        self.rows += len(batch)
+        for i, future in enumerate(futures):
+            future.set_result(tuple(output[i:i + 1] for output in outputs))
+    
+    def stats(self):
+        """Counters for /health"""
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'batches': self.batches,
+            'rows': self.rows,
+            'mean_batch_size': round(self.rows / self.batches, 2) if self.batches else 0.0,
+        }
@@ -3,80 +3,312 @@ RTB DSP Model API
 Flask API to serve trained ML models
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import joblib
-import json
+import hmac
+import os
+import threading
+from time import perf_counter
 import numpy as np
-import pandas as pd
+
+import batch_protocol
+from evaluation import format_metric
+from instrumentation import BATCH_SIZE_BUCKETS, PROMETHEUS_CONTENT_TYPE, MetricsRegistry
+from micro_batch import MicroBatcher
+from model_store import ModelStore
+from response_cache import ResponseCache
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for Next.js frontend
+# Enable CORS for the Next.js frontend (CORS_ORIGINS, comma-separated); never
+# for /admin, which browsers must not reach cross-origin
+CORS(app, resources={r'/(?!admin/).*': {'origins': os.environ.get('CORS_ORIGINS', '*').split(',')}})
+
+# Request metrics, exported at /metrics. With METRICS_DIR (set by serve.py)
+# every worker's series are summed at scrape time; otherwise per process
+registry = MetricsRegistry(directory=os.environ.get('METRICS_DIR') or None)
+registry.counter('requests_total', 'Requests by endpoint and HTTP status', ('endpoint', 'status'))
+registry.counter('request_errors_total', 'Requests answered with a 4xx or 5xx status', ('endpoint',))
+registry.counter('rows_scored_total', 'Feature rows scored', ('endpoint',))
+registry.histogram('request_duration_seconds', 'Handler latency, parse to serialize', ('endpoint',))
+registry.histogram('stage_duration_seconds', 'Latency of each serving stage', ('endpoint', 'stage'))
+registry.histogram('batch_size', 'Rows per scoring request', ('endpoint',), BATCH_SIZE_BUCKETS)
+registry.gauge('cache_entries', 'Scores held in the response caches', ())
+for name in ('hits', 'misses', 'evictions'):
+    registry.counter(f'cache_{name}_total', f'Response cache {name}', ())
+
+
+# Scores keyed by the normalized feature tuple; PREDICTION_CACHE_SIZE=0 disables
+response_cache = ResponseCache(int(os.environ.get('PREDICTION_CACHE_SIZE', 50000)))
 
-# Load models at startup
+# Load the newest model version at startup. MODEL_ENGINE picks the serving
+# engine (auto, xgboost, compiled or lookup); swaps invalidate the cache
 print("Loading models...")
-ctr_model = joblib.load('models/ctr_model.pkl')
-cvr_model = joblib.load('models/cvr_model.pkl')
+store = ModelStore(
+    os.environ.get('MODEL_DIR', 'models'),
+    engine=os.environ.get('MODEL_ENGINE', 'auto'),
+    on_swap=lambda bundle: response_cache.reset(bundle.cache_key)
+)
+
+# Pick up new versions written under MODEL_DIR/versions (0 disables polling)
+store.watch(float(os.environ.get('MODEL_WATCH_INTERVAL', 10)))
+
+print(f"Models loaded successfully! (version: {store.active.version}, engine: {store.active.engine})")
+print(f"CTR Model AUC: {format_metric(store.active.metrics['ctr']['auc'])}")
+print(f"CVR Model AUC: {format_metric(store.active.metrics['cvr']['auc'])}")
+
+# Request key, feature column and default for every raw input feature
+REQUEST_FIELDS = [
+    ('userAge', 'user_age', 30),
+    ('deviceType', 'device_type', 1),
+    ('location', 'location', 0),
+    ('timeOfDay', 'hour_of_day', 12),
+    ('dayOfWeek', 'day_of_week', 0),
+    ('adCategory', 'ad_category', 0),
+    ('frequencyCount', 'frequency_count', 0),
+    ('floorPrice', 'floor_price', 1.0),
+    ('competitionLevel', 'competition_level', 2),
+]
+PEAK_HOURS = [9, 10, 11, 12, 13, 14, 18, 19, 20, 21]
 
-with open('models/feature_columns.json', 'r') as f:
-    feature_columns = json.load(f)
+# /rank: the request keys a candidate may set for itself (no derived
+# feature depends on them), the default candidate set and ranking keys
+RANK_CANDIDATE_FIELDS = {'adCategory': 'ad_category', 'frequencyCount': 'frequency_count'}
+AD_CATEGORIES = range(10)
+RANK_BY = ['performance_score', 'expected_value']
+MAX_RANK_CANDIDATES = 1000
 
-with open('models/metrics.json', 'r') as f:
-    metrics = json.load(f)
 
-print("Models loaded successfully!")
-print(f"CTR Model AUC: {metrics['ctr']['auc']:.4f}")
-print(f"CVR Model AUC: {metrics['cvr']['auc']:.4f}")
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and bool(np.isfinite(value))
+
+
+def check_rank_fields(fields, where):
+    """Raise ValueError unless the candidate-level fields of a /rank request or candidate are valid"""
+    for key in ('adCategory', 'frequencyCount', 'conversionValue'):
+        if key in fields and not is_number(fields[key]):
+            raise ValueError(f"{where} {key} must be a number")
+    if 'adCategory' in fields and fields['adCategory'] not in AD_CATEGORIES:
+        raise ValueError(f"{where} adCategory must be an integer in [0, {len(AD_CATEGORIES)})")
+
+
+def build_feature_matrix(requests_data, feature_columns):
+    """Build one contiguous float32 matrix, columns in feature_columns order"""
+    n = len(requests_data)
+    columns = {
+        column: np.fromiter((req.get(key, default) for req in requests_data), dtype=np.float32, count=n)
+        for key, column, default in REQUEST_FIELDS
+    }
+    
+    # Derived features, vectorized
+    columns['is_weekend'] = np.isin(columns['day_of_week'], [5, 6])
+    columns['is_peak_hour'] = np.isin(columns['hour_of_day'], PEAK_HOURS)
+    columns['is_mobile'] = columns['device_type'] == 1
+    
+    X = np.empty((n, len(feature_columns)), dtype=np.float32)
+    for i, column in enumerate(feature_columns):
+        X[:, i] = columns[column]
+    return X
+
+
+# One preallocated input row per serving thread, reused across requests
+_row_buffers = threading.local()
+
+
+def build_feature_row(data, feature_columns):
+    """Fill this thread's preallocated (1, n_features) row; returns (row, features)"""
+    features = {column: data.get(key, default) for key, column, default in REQUEST_FIELDS}
+    
+    # Add derived features
+    features['is_weekend'] = 1 if features['day_of_week'] in [5, 6] else 0
+    features['is_peak_hour'] = 1 if features['hour_of_day'] in PEAK_HOURS else 0
+    features['is_mobile'] = 1 if features['device_type'] == 1 else 0
+    
+    row = getattr(_row_buffers, 'row', None)
+    if row is None or row.shape[1] != len(feature_columns):
+        row = _row_buffers.row = np.empty((1, len(feature_columns)), dtype=np.float32)
+    for i, column in enumerate(feature_columns):
+        row[0, i] = features[column]
+    return row, features
+
+
+def build_candidate_matrix(data, candidates, feature_columns):
+    """One row per candidate: the request's row, shared, with each candidate's own columns set"""
+    X = np.repeat(build_feature_matrix([data], feature_columns), len(candidates), axis=0)
+    defaults = {key: default for key, _, default in REQUEST_FIELDS}
+    for key, column in RANK_CANDIDATE_FIELDS.items():
+        if any(key in candidate for candidate in candidates):
+            shared = data.get(key, defaults[key])
+            X[:, feature_columns.index(column)] = np.fromiter(
+                (candidate.get(key, shared) for candidate in candidates), dtype=np.float32, count=len(candidates)
+            )
+    return X
+
+
+def row_view(X):
+    """One opaque (void) element per row, so rows compare and hash by their raw bytes"""
+    X = np.ascontiguousarray(X)
+    return X.view(np.dtype((np.void, X.shape[1] * X.itemsize))).ravel()
+
+
+def score_unique(X, bundle, stages=None, keys=None):
+    """Score rows through the response cache; rows of X must be distinct
+    
+    Cache keys are the rows' raw bytes, built with one view instead of a
+    tuple per row.
+    """
+    if keys is None:
+        keys = row_view(X).tolist()
+    cached = response_cache.get_many(keys)
+    missing = [i for i, value in enumerate(cached) if value is None]
+    
+    scores = np.empty((len(X), 2), dtype=np.float64)
+    if len(missing) < len(X):
+        hits = [i for i, value in enumerate(cached) if value is not None]
+        scores[hits] = [cached[i] for i in hits]
+    if missing:
+        X_missing = X if len(missing) == len(X) else X[missing]
+        ctr, cvr, timings = bundle.score(X_missing)
+        if stages is not None:
+            stages.update(timings)
+        scores[missing, 0] = ctr
+        scores[missing, 1] = cvr
+        response_cache.put_many([keys[i] for i in missing], scores[missing].tolist(), bundle.cache_key)
+    return scores
+
+
+def score_matrix(X, bundle=None, stages=None):
+    """Score every row with one call per model; returns float64 (ctr, cvr, performance_score)
+    
+    Per-model timings are added to stages when given.
+    """
+    bundle = bundle or store.active
+    if not response_cache.enabled:
+        # Nothing to look up: no keys, and duplicates cost less to score than to find
+        ctr, cvr, timings = bundle.score(X)
+        if stages is not None:
+            stages.update(timings)
+        ctr, cvr = np.asarray(ctr, dtype=np.float64), np.asarray(cvr, dtype=np.float64)
+    elif len(X) == 1:
+        scores = score_unique(X, bundle, stages)
+        ctr, cvr = scores[:, 0], scores[:, 1]
+    else:
+        # Duplicate rows are looked up and scored once, then fanned back out
+        rows = row_view(X)
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        if len(first) < len(X):
+            scores = score_unique(X[first], bundle, stages, rows[first].tolist())[inverse.reshape(-1)]
+        else:
+            scores = score_unique(X, bundle, stages, rows.tolist())
+        ctr, cvr = scores[:, 0], scores[:, 1]
+    
+    return ctr, cvr, (ctr * 0.6) + (cvr * 0.4)
+
+
+# Optional micro-batching of concurrent /predict calls (MICRO_BATCHING=1);
+# MICRO_BATCH_MAX_WAIT_MS is the latency each request may give up to batching
+micro_batcher = None
+if os.environ.get('MICRO_BATCHING', '0') == '1':
+    micro_batcher = MicroBatcher(
+        score_matrix,
+        max_batch_size=int(os.environ.get('MICRO_BATCH_MAX_SIZE', 64)),
+        max_wait_ms=float(os.environ.get('MICRO_BATCH_MAX_WAIT_MS', 2.0))
+    )
+
+
+def lap(stage, since):
+    """Record the time since `since` as a stage of the current request; returns now"""
+    now = perf_counter()
+    g.stages[stage] = g.stages.get(stage, 0.0) + now - since
+    return now
+
+
+@app.before_request
+def start_request_timer():
+    g.start = perf_counter()
+    g.stages = {}
+    g.batch_size = None
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request and record its latency, stages and batch size"""
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    registry.observe('request_duration_seconds', (endpoint,), perf_counter() - g.start)
+    for stage, seconds in g.stages.items():
+        registry.observe('stage_duration_seconds', (endpoint, stage), seconds)
+    if g.batch_size is not None:
+        registry.observe('batch_size', (endpoint,), g.batch_size)
+        registry.inc('rows_scored_total', (endpoint,), g.batch_size)
+    
+    registry.inc('requests_total', (endpoint, str(response.status_code)))
+    if response.status_code >= 400:
+        registry.inc('request_errors_total', (endpoint,))
+    
+    # Mirrored into the registry so that /metrics sums them over workers
+    cache = response_cache.stats()
+    registry.set('cache_entries', (), cache['size'])
+    for name in ('hits', 'misses', 'evictions'):
+        registry.set(f'cache_{name}_total', (), cache[name])
+    return response
 
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    bundle = store.active
     return jsonify({
         'status': 'healthy',
         'models_loaded': True,
-        'ctr_model_auc': metrics['ctr']['auc'],
-        'cvr_model_auc': metrics['cvr']['auc']
+        'model_version': bundle.version,
+        'ctr_model_auc': bundle.metrics['ctr']['auc'],
+        'cvr_model_auc': bundle.metrics['cvr']['auc'],
+        'cache': response_cache.stats(),
+        'micro_batching': micro_batcher.stats() if micro_batcher else None,
+        'latency_ms': {
+            labels[0]: summary
+            for labels, summary in registry.quantiles('request_duration_seconds').items()
+        }
     })
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, summed over every worker under serve.py"""
+    bundle = store.active
+    extra = [
+        '# HELP rtb_model_info Model version and engine of the worker answering the scrape',
+        '# TYPE rtb_model_info gauge',
+        f'rtb_model_info{{version="{bundle.version}",engine="{bundle.engine}"}} 1',
+    ]
+    return Response(registry.render(extra), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
 @app.route('/predict', methods=['POST'])
 def predict():
     """Predict CTR and CVR for a bid request"""
     try:
+        mark = g.start
         data = request.json
+        mark = lap('parse', mark)
         
-        # Extract features
-        features = {
-            'user_age': data.get('userAge', 30),
-            'device_type': data.get('deviceType', 1),
-            'location': data.get('location', 0),
-            'hour_of_day': data.get('timeOfDay', 12),
-            'day_of_week': data.get('dayOfWeek', 0),
-            'ad_category': data.get('adCategory', 0),
-            'frequency_count': data.get('frequencyCount', 0),
-            'floor_price': data.get('floorPrice', 1.0),
-            'competition_level': data.get('competitionLevel', 2),
-        }
-        
-        # Add derived features
-        features['is_weekend'] = 1 if features['day_of_week'] in [5, 6] else 0
-        features['is_peak_hour'] = 1 if features['hour_of_day'] in [9, 10, 11, 12, 13, 14, 18, 19, 20, 21] else 0
-        features['is_mobile'] = 1 if features['device_type'] == 1 else 0
+        # Fill the preallocated row and score it with both models directly
+        bundle = store.active
+        X, features = build_feature_row(data, bundle.feature_columns)
+        mark = lap('features', mark)
+        g.batch_size = 1
+        if micro_batcher:
+            # Queue wait and the shared batch call are not separable per request;
+            # the row is scored by the bundle it was built against
+            ctr, cvr, performance = micro_batcher.score(X, bundle)
+            mark = lap('score_batched', mark)
+        else:
+            ctr, cvr, performance = score_matrix(X, bundle, g.stages)
+            mark = perf_counter()
+        ctr_proba = float(ctr[0])
+        cvr_proba = float(cvr[0])
+        performance_score = float(performance[0])
         
-        # Create DataFrame with correct column order
-        X = pd.DataFrame([features])[feature_columns]
-        
-        # Predict CTR
-        ctr_proba = float(ctr_model.predict_proba(X)[0, 1])
-        
-        # Predict CVR
-        cvr_proba = float(cvr_model.predict_proba(X)[0, 1])
-        
-        # Calculate performance score
-        performance_score = (ctr_proba * 0.6) + (cvr_proba * 0.4)
-        
-        return jsonify({
+        response = jsonify({
             'success': True,
             'predictions': {
                 'ctr': round(ctr_proba, 4),
@@ -88,6 +320,8 @@ def predict():
             'features': features,
             'method': 'xgboost-ml'
         })
+        lap('serialize', mark)
+        return response
     
     except Exception as e:
         return jsonify({
@@ -96,11 +330,37 @@ def predict():
         }), 500
 
 
+def predict_batch_binary():
+    """/predict/batch over the packed float32 protocol (batch_protocol)"""
+    bundle = store.active
+    try:
+        X = batch_protocol.decode_features(request.get_data(cache=False))
+        mark = lap('parse', g.start)
+        if X.shape[1] != len(bundle.feature_columns):
+            raise ValueError(f"Expected {len(bundle.feature_columns)} feature columns, got {X.shape[1]}")
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    g.batch_size = len(X)
+    ctr, cvr, performance_score = score_matrix(X, bundle, g.stages)
+    mark = perf_counter()
+    body = batch_protocol.encode_scores(ctr, cvr, performance_score)
+    lap('serialize', mark)
+    return Response(body, mimetype=batch_protocol.CONTENT_TYPE)
+
+
 @app.route('/predict/batch', methods=['POST'])
 def predict_batch():
     """Predict CTR and CVR for multiple bid requests"""
     try:
+        if request.mimetype == batch_protocol.CONTENT_TYPE:
+            return predict_batch_binary()
+        
         data = request.json
+        mark = lap('parse', g.start)
         requests_data = data.get('requests', [])
         
         if not requests_data:
@@ -109,46 +369,113 @@ def predict_batch():
                 'error': 'No requests provided'
             }), 400
         
-        results = []
+        # One feature matrix, one call per model, all on the same model version
+        bundle = store.active
+        X = build_feature_matrix(requests_data, bundle.feature_columns)
+        lap('features', mark)
+        g.batch_size = len(X)
+        ctr, cvr, performance_score = score_matrix(X, bundle, g.stages)
+        mark = perf_counter()
         
-        for req in requests_data:
-            # Extract features
-            features = {
-                'user_age': req.get('userAge', 30),
-                'device_type': req.get('deviceType', 1),
-                'location': req.get('location', 0),
-                'hour_of_day': req.get('timeOfDay', 12),
-                'day_of_week': req.get('dayOfWeek', 0),
-                'ad_category': req.get('adCategory', 0),
-                'frequency_count': req.get('frequencyCount', 0),
-                'floor_price': req.get('floorPrice', 1.0),
-                'competition_level': req.get('competitionLevel', 2),
-            }
-            
-            # Add derived features
-            features['is_weekend'] = 1 if features['day_of_week'] in [5, 6] else 0
-            features['is_peak_hour'] = 1 if features['hour_of_day'] in [9, 10, 11, 12, 13, 14, 18, 19, 20, 21] else 0
-            features['is_mobile'] = 1 if features['device_type'] == 1 else 0
-            
-            # Create DataFrame
-            X = pd.DataFrame([features])[feature_columns]
-            
-            # Predict
-            ctr_proba = float(ctr_model.predict_proba(X)[0, 1])
-            cvr_proba = float(cvr_model.predict_proba(X)[0, 1])
-            performance_score = (ctr_proba * 0.6) + (cvr_proba * 0.4)
-            
-            results.append({
-                'ctr': round(ctr_proba, 4),
-                'cvr': round(cvr_proba, 4),
-                'performance_score': round(performance_score, 4)
-            })
+        # Round and convert in bulk
+        results = [
+            {'ctr': c, 'cvr': v, 'performance_score': p}
+            for c, v, p in zip(
+                np.round(ctr, 4).tolist(),
+                np.round(cvr, 4).tolist(),
+                np.round(performance_score, 4).tolist()
+            )
+        ]
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'count': len(results),
             'predictions': results
         })
+        lap('serialize', mark)
+        return response
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/rank', methods=['POST'])
+def rank():
+    """Score every candidate ad for one bid request and return the top k"""
+    try:
+        mark = g.start
+        data = request.json
+        mark = lap('parse', mark)
+        
+        bid_request = data.get('request', data)
+        candidates = data.get('candidates') or [{'adCategory': category} for category in AD_CATEGORIES]
+        rank_by = data.get('rankBy', 'performance_score')
+        top_k = int(data.get('topK', len(candidates)))
+        default_value = float(data.get('conversionValue', 1.0))
+        
+        if rank_by not in RANK_BY:
+            raise ValueError(f"rankBy must be one of {RANK_BY}")
+        if not isinstance(bid_request, dict):
+            raise ValueError("request must be an object")
+        check_rank_fields(bid_request, 'request')
+        if not isinstance(candidates, list) or len(candidates) > MAX_RANK_CANDIDATES:
+            raise ValueError(f"candidates must be a list of at most {MAX_RANK_CANDIDATES} objects")
+        for i, candidate in enumerate(candidates):
+            if not isinstance(candidate, dict):
+                raise ValueError(f"candidates[{i}] must be an object")
+            unknown = set(candidate) - set(RANK_CANDIDATE_FIELDS) - {'id', 'conversionValue'}
+            if unknown:
+                raise ValueError(f"Unsupported candidate fields: {sorted(unknown)}")
+            check_rank_fields(candidate, f"candidates[{i}]")
+    except (AttributeError, TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    try:
+        # One shared feature row fanned out to every candidate, scored in one call
+        bundle = store.active
+        X = build_candidate_matrix(bid_request, candidates, bundle.feature_columns)
+        lap('features', mark)
+        g.batch_size = len(X)
+        ctr, cvr, performance_score = score_matrix(X, bundle, g.stages)
+        mark = perf_counter()
+        
+        # Expected value per thousand impressions, comparable with floorPrice (CPM)
+        values = np.fromiter((candidate.get('conversionValue', default_value) for candidate in candidates),
+                             dtype=np.float64, count=len(candidates))
+        expected_value = ctr * cvr * values * 1000.0
+        floor_price = float(bid_request.get('floorPrice', 1.0))
+        
+        key = performance_score if rank_by == 'performance_score' else expected_value
+        order = np.argsort(-key, kind='stable')[:max(top_k, 0)]
+        ranked = [
+            {
+                'rank': rank + 1,
+                'id': candidates[i].get('id', i),
+                'adCategory': candidates[i].get('adCategory', bid_request.get('adCategory', 0)),
+                'ctr': round(float(ctr[i]), 4),
+                'cvr': round(float(cvr[i]), 4),
+                'performance_score': round(float(performance_score[i]), 4),
+                'expected_value': round(float(expected_value[i]), 4),
+                'clears_floor': bool(expected_value[i] >= floor_price)
+            }
+            for rank, i in enumerate(order.tolist())
+        ]
+        
+        response = jsonify({
+            'success': True,
+            'count': len(candidates),
+            'rank_by': rank_by,
+            'floor_price': floor_price,
+            'ranked': ranked
+        })
+        lap('serialize', mark)
+        return response
     
     except Exception as e:
         return jsonify({
@@ -160,18 +487,24 @@ def predict_batch():
 @app.route('/model/info', methods=['GET'])
 def model_info():
     """Get model information and metrics"""
+    bundle = store.active
     return jsonify({
         'success': True,
+        'engine': bundle.engine,
+        'version': bundle.version,
+        'loaded_at': bundle.loaded_at,
+        'available_versions': store.versions(),
+        'last_reload_error': store.last_error,
         'models': {
             'ctr': {
                 'type': 'XGBoost Classifier',
-                'metrics': metrics['ctr'],
-                'features': feature_columns
+                'metrics': bundle.metrics['ctr'],
+                'features': bundle.feature_columns
             },
             'cvr': {
                 'type': 'XGBoost Classifier',
-                'metrics': metrics['cvr'],
-                'features': feature_columns
+                'metrics': bundle.metrics['cvr'],
+                'features': bundle.feature_columns
             }
         }
     })
@@ -180,14 +513,15 @@ def model_info():
 @app.route('/model/feature-importance', methods=['GET'])
 def feature_importance():
     """Get feature importance for both models"""
+    bundle = store.active
     ctr_importance = {
         feature: float(importance)
-        for feature, importance in zip(feature_columns, ctr_model.feature_importances_)
+        for feature, importance in zip(bundle.feature_columns, bundle.feature_importances('ctr'))
     }
     
     cvr_importance = {
         feature: float(importance)
-        for feature, importance in zip(feature_columns, cvr_model.feature_importances_)
+        for feature, importance in zip(bundle.feature_columns, bundle.feature_importances('cvr'))
     }
     
     # Sort by importance
@@ -196,11 +530,54 @@ def feature_importance():
     
     return jsonify({
         'success': True,
+        'version': bundle.version,
         'ctr_importance': dict(ctr_sorted),
         'cvr_importance': dict(cvr_sorted)
     })
 
 
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Pin a model version (default: unpin and follow the newest) and reload"""
+    # Disabled unless ADMIN_TOKEN is set
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        return jsonify({
+            'success': False,
+            'error': 'Admin endpoints are disabled (ADMIN_TOKEN is not set)'
+        }), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid admin token'
+        }), 403
+    
+    # The pin file reaches every worker: this one reloads now, the others
+    # on their next watcher poll or on SIGHUP to serve.py
+    data = request.get_json(silent=True) or {}
+    try:
+        store.pin(data.get('version'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except OSError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    
+    # Loading and warming take seconds; done off the request thread
+    store.reload_async()
+    return jsonify({
+        'success': True,
+        'previous_version': store.active.version,
+        'version': store.target_version(),
+        'pinned': store.pinned_version() is not None
+    }), 202
+
+
 if __name__ == '__main__':
     print("\n" + "="*60)
     print("RTB DSP Model API Server")
@@ -209,9 +586,13 @@ if __name__ == '__main__':
     print("  GET  /health                  - Health check")
     print("  POST /predict                 - Single prediction")
     print("  POST /predict/batch           - Batch predictions")
+    print("  POST /rank                    - Rank candidate ads for one request")
     print("  GET  /model/info              - Model information")
     print("  GET  /model/feature-importance - Feature importance")
-    print("\nStarting server on http://localhost:5000")
+    print("  POST /admin/reload            - Pin and swap in a model version (needs ADMIN_TOKEN)")
+    print("  GET  /metrics                 - Prometheus metrics")
+    print("\nStarting development server on http://localhost:5000")
+    print("(production: python serve.py --workers N)")
     print("="*60 + "\n")
     
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,315 @@
+"""
+RTB DSP Model Store
+Versioned model directories, loaded and warmed in the background, swapped in atomically
+"""
+
+import json
+import os
+import threading
+import time
+from time import perf_counter
+from datetime import datetime
+
+import numpy as np
+
+VERSIONS_DIR = 'versions'
+
+# save_models writes metrics.json after every model file, so its presence
+# marks a version directory as complete
+READY_FILE = 'metrics.json'
+
+# Version every process should serve, shared through <model_dir>; without it
+# the newest version is served
+PIN_FILE = 'PINNED_VERSION'
+
+
+def ready_stamp(path):
+    """Modification time of a model directory's READY_FILE"""
+    return os.stat(os.path.join(path, READY_FILE)).st_mtime_ns
+
+
+def booster_importances(booster, feature_columns):
+    """Normalized gain importances, as XGBClassifier.feature_importances_ reports them"""
+    scores = booster.get_score(importance_type='gain')
+    names = booster.feature_names or [f'f{i}' for i in range(len(feature_columns))]
+    importances = np.array([scores.get(name, 0.0) for name in names], dtype=np.float32)
+    total = importances.sum()
+    return importances / total if total > 0 else importances
+
+
+def booster_scorer(booster):
+    """Wrap a booster as X -> positive-class probabilities"""
+    # Columns are ordered by construction, so skip per-call name validation
+    return lambda X: booster.inplace_predict(X, validate_features=False)
+
+
+def esmm_cvr(ctr, ctcvr):
+    """ESMM post-click conversion rate: pCVR = pCTCVR / pCTR, clipped to [0, 1]"""
+    # The two models are fit separately, so pCTCVR can exceed pCTR on some rows
+    return np.clip(ctcvr / np.maximum(ctr, 1e-12), 0.0, 1.0)
+
+
+class ModelBundle:
+    """One loaded model version: both models, their scorers, feature list and metrics
+    
+    With the split formulation the second model is the CVR model, trained on
+    clicked rows. With ESMM it is a pCTCVR model trained on all impressions,
+    and CVR is served as pCTCVR / pCTR. cvr_model holds whichever was trained.
+    """
+    
+    def __init__(self, path, version, engine='auto'):
+        self.path = path
+        self.version = version
+        
+        with open(os.path.join(path, 'feature_columns.json'), 'r') as f:
+            self.feature_columns = json.load(f)
+        
+        with open(os.path.join(path, 'metrics.json'), 'r') as f:
+            self.metrics = json.load(f)
+        
+        self.formulation = self.metrics.get('formulation', 'split')
+        second = 'ctcvr' if self.formulation == 'esmm' else 'cvr'
+        
+        # Serving engine: auto (lookup if a table was exported, else compiled if
+        # exported, else xgboost), xgboost, compiled (tree_engine.FusedEnsemble)
+        # or lookup (tree_engine.LookupTable). Tables are only ever built by the
+        # trainer (--export-lookup); without one, lookup serves compiled
+        table = None
+        compiled = os.path.exists(self.compiled_path('ctr')) and os.path.exists(self.compiled_path(second))
+        if engine in ('auto', 'lookup') and compiled:
+            table = self.load_table()
+        if engine == 'auto':
+            engine = 'lookup' if table is not None else 'compiled' if compiled else 'xgboost'
+        elif engine == 'lookup' and table is None:
+            print(f"No lookup table exported in {path}; serving the compiled engine")
+            engine = 'compiled'
+        self.engine = engine
+        self.fused_scorer = None
+        
+        # Compiled evaluators need no xgboost and are memory-mapped read-only,
+        # so all workers share one copy in the page cache
+        if engine in ('compiled', 'lookup'):
+            from tree_engine import TreeEnsemble, FusedEnsemble
+            
+            self.ctr_model = TreeEnsemble.load(self.compiled_path('ctr'))
+            self.cvr_model = TreeEnsemble.load(self.compiled_path(second))
+            if engine == 'compiled':
+                # Both models' trees walked in one traversal
+                self.fused_scorer = FusedEnsemble([self.ctr_model, self.cvr_model])
+            else:
+                self.fused_scorer = table
+        elif engine == 'xgboost':
+            # Native boosters need no sklearn wrapper; pickles only for older model directories
+            if os.path.exists(os.path.join(path, 'ctr_model.ubj')):
+                import xgboost as xgb
+                
+                self.ctr_model = xgb.Booster(model_file=os.path.join(path, 'ctr_model.ubj'))
+                self.cvr_model = xgb.Booster(model_file=os.path.join(path, f'{second}_model.ubj'))
+                ctr_booster, cvr_booster = self.ctr_model, self.cvr_model
+            else:
+                import joblib
+                
+                self.ctr_model = joblib.load(os.path.join(path, 'ctr_model.pkl'))
+                self.cvr_model = joblib.load(os.path.join(path, f'{second}_model.pkl'))
+                ctr_booster = self.ctr_model.get_booster()
+                cvr_booster = self.cvr_model.get_booster()
+            
+            # Single-threaded copies for one-row requests, where spinning up the
+            # OpenMP pool costs more than walking the trees
+            ctr_row_booster = ctr_booster.copy()
+            cvr_row_booster = cvr_booster.copy()
+            ctr_row_booster.set_param({'nthread': 1})
+            cvr_row_booster.set_param({'nthread': 1})
+            
+            self.batch_scorers = (booster_scorer(ctr_booster), booster_scorer(cvr_booster))
+            self.row_scorers = (booster_scorer(ctr_row_booster), booster_scorer(cvr_row_booster))
+        else:
+            raise ValueError(f"Unknown MODEL_ENGINE: {engine}")
+        
+        # Cached scores are only valid for the exact models that produced them;
+        # the stamp also catches a directory retrained in place
+        self.stamp = ready_stamp(path)
+        self.cache_key = f'{version}:{self.stamp}:{engine}'
+        self.loaded_at = datetime.now().isoformat(timespec='seconds')
+    
+    def compiled_path(self, name):
+        """Memory-mappable ensemble directory, or the older single .npz file"""
+        path = os.path.join(self.path, f'{name}_trees')
+        return path if os.path.isdir(path) else os.path.join(self.path, f'{name}_model.npz')
+    
+    def load_table(self):
+        """The exported score table, or None if there is none usable
+        
+        Tables exported before NaN had its own bucket score missing values
+        wrongly, so they count as absent.
+        """
+        table_path = os.path.join(self.path, 'score_table')
+        if not os.path.isdir(table_path):
+            return None
+        from tree_engine import LookupTable
+        
+        table = LookupTable.load(table_path)
+        return table if table.handles_missing else None
+    
+    def feature_importances(self, name):
+        """Per-feature importances of the 'ctr' or 'cvr' model, in feature_columns order"""
+        model = self.ctr_model if name == 'ctr' else self.cvr_model
+        if hasattr(model, 'feature_importances_'):
+            return model.feature_importances_
+        return booster_importances(model, self.feature_columns)
+    
+    def score(self, X):
+        """Score a feature matrix; returns (ctr, cvr, {stage: seconds})"""
+        start = perf_counter()
+        if self.fused_scorer is not None:
+            # One pass yields both models, so the stage cannot be split
+            ctr, second = self.fused_scorer.predict(X)
+            timings = {'score_fused': perf_counter() - start}
+        else:
+            ctr_predict, cvr_predict = self.row_scorers if len(X) == 1 else self.batch_scorers
+            ctr = ctr_predict(X)
+            ctr_done = perf_counter()
+            second = cvr_predict(X)
+            timings = {'score_ctr': ctr_done - start, 'score_cvr': perf_counter() - ctr_done}
+        
+        cvr = esmm_cvr(ctr, second) if self.formulation == 'esmm' else second
+        return ctr, cvr, timings
+    
+    def warm_up(self):
+        """Run both scorers once so the first request after a swap pays no first-call costs"""
+        X = np.zeros((8, len(self.feature_columns)), dtype=np.float32)
+        self.score(X[:1])
+        self.score(X)
+
+
+class ModelStore:
+    """Serving version under a model directory, hot-swapped on reload
+    
+    Versions are the complete subdirectories of <model_dir>/versions (as
+    written by the trainer's --refresh); the newest name wins unless one is
+    pinned in <model_dir>/PINNED_VERSION. Without any, <model_dir> itself is
+    served as version 'base'. A new version is fully loaded and warmed before
+    one reference assignment makes it active; requests that already hold the
+    old bundle finish on it.
+    
+    The pin lives on disk, so every process serving the directory (prefork
+    workers, respawned ones, their watchers and SIGHUP reloads) converges on it.
+    """
+    
+    def __init__(self, model_dir='models', engine='auto', on_swap=None):
+        self.model_dir = model_dir
+        self.engine = engine
+        self.on_swap = on_swap
+        self.last_error = None
+        self.load_lock = threading.Lock()
+        self.watch_interval = 0
+        self.active = None
+        
+        # Not warmed here: a prefork parent must not start scorer thread pools
+        self.load(warm=False)
+        os.register_at_fork(after_in_child=self._after_fork)
+    
+    def versions(self):
+        """Complete version names, oldest first"""
+        root = os.path.join(self.model_dir, VERSIONS_DIR)
+        if not os.path.isdir(root):
+            return []
+        return sorted(
+            name for name in os.listdir(root)
+            if os.path.exists(os.path.join(root, name, READY_FILE))
+        )
+    
+    def latest_version(self):
+        versions = self.versions()
+        return versions[-1] if versions else 'base'
+    
+    def pinned_version(self):
+        """Version named in the pin file, or None"""
+        try:
+            with open(os.path.join(self.model_dir, PIN_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+    
+    def target_version(self):
+        """Version that should be served: the pinned one, else the newest"""
+        return self.pinned_version() or self.latest_version()
+    
+    def pin(self, version=None):
+        """Pin every process to a version; None unpins (follow the newest)"""
+        path = os.path.join(self.model_dir, PIN_FILE)
+        if version is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        if version != 'base' and version not in self.versions():
+            raise ValueError(f"Unknown model version: {version}")
+        
+        # Replaced atomically, so a watcher never reads a half-written name
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(version + '\n')
+        os.replace(tmp_path, path)
+    
+    def version_path(self, version):
+        if version == 'base':
+            return self.model_dir
+        return os.path.join(self.model_dir, VERSIONS_DIR, version)
+    
+    def load(self, version=None, warm=True):
+        """Load and warm a version (default: the target), then swap it in; returns it"""
+        with self.load_lock:
+            version = version or self.target_version()
+            if version != 'base' and version not in self.versions():
+                raise ValueError(f"Unknown model version: {version}")
+            
+            bundle = ModelBundle(self.version_path(version), version, self.engine)
+            if warm:
+                bundle.warm_up()
+            
+            # Atomic reference swap; readers take self.active once per request
+            self.active = bundle
+            self.last_error = None
+            if self.on_swap:
+                self.on_swap(bundle)
+            return bundle
+    
+    def sync(self, warm=True):
+        """Load the target version unless it is already active; returns the new bundle or None"""
+        target = self.target_version()
+        if (target, ready_stamp(self.version_path(target))) == (self.active.version, self.active.stamp):
+            return None
+        bundle = self.load(target, warm)
+        print(f"Switched to model version {target}")
+        return bundle
+    
+    def reload_async(self):
+        """Sync to the target version in a background thread; failures are kept in last_error"""
+        threading.Thread(target=self._sync, name='model-reload', daemon=True).start()
+    
+    def _sync(self, warm=True):
+        try:
+            self.sync(warm)
+        except Exception as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"Model reload failed: {self.last_error}")
+    
+    def watch(self, interval):
+        """Poll the target version every interval seconds and swap it in when it changes"""
+        self.watch_interval = interval
+        if interval > 0:
+            threading.Thread(target=self._watch, name='model-watcher', daemon=True).start()
+    
+    def _watch(self):
+        while True:
+            self._sync()
+            time.sleep(self.watch_interval)
+    
+    def _after_fork(self):
+        # Threads and held locks do not survive fork(); prefork workers restart
+        # both. A worker respawned after a pin or a new version must not serve
+        # the bundle the parent loaded at startup, so sync first (not warmed:
+        # the worker warms up before serving)
+        self.load_lock = threading.Lock()
+        self._sync(warm=False)
+        self.watch(self.watch_interval)
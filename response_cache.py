@@ -0,0 +1,77 @@
+"""
+RTB DSP Response Cache
+Bounded LRU cache of model scores keyed by the normalized feature vector
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of (ctr, cvr) scores, tied to one model version"""
+    
+    def __init__(self, max_size=50000, version=None):
+        self.max_size = max_size
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self):
+        return self.max_size > 0
+    
+    def reset(self, version):
+        """Drop every entry if the serving models changed"""
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+    
+    def get_many(self, keys):
+        """Cached value per key, None for misses; refreshes recency of hits"""
+        if self.max_size <= 0:
+            self.misses += len(keys)
+            return [None] * len(keys)
+        
+        values = []
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                values.append(value)
+        return values
+    
+    def put_many(self, keys, values, version):
+        """Store scores computed by the given model version, evicting the oldest"""
+        if self.max_size <= 0:
+            return
+        
+        with self.lock:
+            # Scores from models that were swapped out mid-request are not kept
+            if version != self.version:
+                return
+            for key, value in zip(keys, values):
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        """Counters for /health"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
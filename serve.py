@@ -0,0 +1,155 @@
+"""
+RTB DSP Model API Server
+Prefork launcher: load models once, then share them copy-on-write across worker processes
+"""
+
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+
+from werkzeug.serving import make_server
+
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Serve the CTR/CVR model API with prefork workers')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--backlog', type=int, default=1024,
+                        help='listen queue shared by all workers')
+    parser.add_argument('--access-log', action='store_true',
+                        help='log every request (costs throughput)')
+    return parser.parse_args()
+
+
+def bind_socket(host, port, backlog):
+    """Listening socket created once in the parent and inherited by every worker"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, host, port, model_api):
+    """Serve requests on the shared socket until SIGTERM"""
+    server = make_server(host, port, model_api.app, threaded=True, fd=sock.fileno())
+    
+    # serve_forever() must be stopped from another thread
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    # SIGHUP: load, warm and swap in the target version (pinned, else newest)
+    signal.signal(signal.SIGHUP, lambda signum, frame: model_api.store.reload_async())
+    
+    # Warm up after the fork so the parent never starts scorer thread pools
+    model_api.store.active.warm_up()
+    server.serve_forever()
+
+
+def spawn_worker(sock, host, port, model_api):
+    """Fork one worker; returns its pid in the parent"""
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock, host, port, model_api)
+        except Exception as e:
+            print(f"Worker {os.getpid()} failed: {e}", file=sys.stderr)
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    """Load models, fork workers and keep them running"""
+    args = parse_args()
+    if not args.access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    
+    sock = bind_socket(args.host, args.port, args.backlog)
+    
+    # Workers keep their metrics in per-process files under one directory,
+    # which /metrics sums, so any worker can answer a scrape
+    created_metrics_dir = not os.environ.get('METRICS_DIR')
+    metrics_dir = os.environ.get('METRICS_DIR') or tempfile.mkdtemp(prefix='rtb-metrics-')
+    os.makedirs(metrics_dir, exist_ok=True)
+    for filename in os.listdir(metrics_dir):
+        if filename.endswith('.db'):
+            os.remove(os.path.join(metrics_dir, filename))
+    os.environ['METRICS_DIR'] = metrics_dir
+    
+    # Load models once; workers inherit them through fork. Only workers
+    # watch for new model versions, the parent never loads or scores
+    watch_interval = float(os.environ.get('MODEL_WATCH_INTERVAL', 10))
+    os.environ['MODEL_WATCH_INTERVAL'] = '0'
+    import model_api
+    model_api.store.watch_interval = watch_interval
+    
+    # Keep the collector from touching (and so copying) every inherited object
+    gc.collect()
+    gc.freeze()
+    
+    print("\n" + "="*60)
+    print("RTB DSP Model API Server (prefork)")
+    print("="*60)
+    print(f"\nModel version: {model_api.store.active.version}")
+    print(f"Engine: {model_api.store.active.engine}")
+    print(f"Workers: {args.workers}")
+    print(f"Listening on http://{args.host}:{args.port}")
+    print("="*60 + "\n")
+    
+    workers = {spawn_worker(sock, args.host, args.port, model_api) for _ in range(args.workers)}
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def reload(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGHUP)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+    
+    # Replace workers that die until asked to stop
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited ({status}), restarting", file=sys.stderr)
+            workers.add(spawn_worker(sock, args.host, args.port, model_api))
+    
+    sock.close()
+    if created_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    print("Server stopped")
+
+
+if __name__ == '__main__':
+    main()
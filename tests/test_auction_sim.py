@@ -0,0 +1,66 @@
+"""Budget-capped replay totals do not depend on the chunk size"""
+
+import numpy as np
+import pytest
+
+from auction_sim import AuctionSimulator, Strategy, default_strategies
+
+
+class FakeBundle:
+    """Scores derived from the features, so every chunking sees the same predictions"""
+    feature_columns = ['x']
+    version = 'test'
+    engine = 'fake'
+    
+    def score(self, X):
+        ctr = 0.01 + 0.04 * X[:, 0]
+        return ctr, np.full(len(X), 0.3), None
+
+
+def replay_auctions(rows=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'x': rng.random(rows),
+        'floor_price': rng.uniform(0.5, 3.0, rows),
+        'competition_level': rng.integers(0, 5, rows),
+        'clicked': (rng.random(rows) < 0.03).astype(int),
+        'converted': (rng.random(rows) < 0.01).astype(int),
+    }
+
+
+def replay(auctions, chunk_size, budget):
+    simulator = AuctionSimulator(FakeBundle(), default_strategies(20.0, 0.8, budget), seed=7)
+    rows = len(auctions['x'])
+    for start in range(0, rows, chunk_size):
+        simulator.run_chunk({name: column[start:start + chunk_size] for name, column in auctions.items()})
+    return simulator.results()['strategies']
+
+
+@pytest.mark.parametrize('chunk_size', [1, 37, 1000])
+def test_budget_totals_independent_of_chunk_size(chunk_size):
+    auctions = replay_auctions()
+    expected = replay(auctions, len(auctions['x']), budget=0.5)
+    results = replay(auctions, chunk_size, budget=0.5)
+    
+    capped = results['value_budget_0.5']
+    assert capped['exhausted']
+    assert 0 < capped['spend'] <= 0.5
+    assert capped['wins'] < results['value']['wins']
+    for name, totals in expected.items():
+        for key in ('bids', 'wins', 'clicks', 'conversions'):
+            assert results[name][key] == totals[key], (name, key)
+        assert results[name]['spend'] == pytest.approx(totals['spend'])
+
+
+def test_exhausted_strategy_sits_out_cheaper_auctions():
+    # The second auction does not fit, so the cheap third one is not bought either
+    strategy = Strategy('capped', lambda auctions: np.full(3, 10.0), budget=0.004)
+    auctions = {
+        'floor_price': np.ones(3), 'ctr': np.full(3, 0.1), 'cvr': np.full(3, 0.1),
+        'clicked': np.zeros(3, dtype=bool), 'converted': np.zeros(3, dtype=bool),
+    }
+    strategy.run(auctions, np.array([2.0, 3.0, 1.0]), 'second')
+    
+    assert strategy.totals['wins'] == 1
+    assert strategy.totals['spend'] == pytest.approx(0.002)
+    assert strategy.exhausted
@@ -0,0 +1,16 @@
+"""Sharded columnar datasets without any shards"""
+
+import json
+
+from columnar import COLUMN_DTYPES, MANIFEST_FILE, load_columns
+
+
+def test_manifest_without_shards_loads_empty_typed_columns(tmp_path):
+    (tmp_path / MANIFEST_FILE).write_text(json.dumps({'format': 'npy', 'shards': []}))
+    
+    columns = load_columns(str(tmp_path), ['clicked', 'floor_price'])
+    assert {name: (len(column), column.dtype.name) for name, column in columns.items()} == {
+        'clicked': (0, COLUMN_DTYPES['clicked']),
+        'floor_price': (0, COLUMN_DTYPES['floor_price']),
+    }
+    assert list(load_columns(str(tmp_path))) == list(COLUMN_DTYPES)
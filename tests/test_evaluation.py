@@ -0,0 +1,42 @@
+"""Streaming evaluation on degenerate groups and its report file"""
+
+import json
+
+import numpy as np
+
+from evaluation import EVALUATION_FILE, SUMMARY_METRICS, Evaluation, format_metric, print_report, write_evaluation
+
+
+def test_empty_evaluation_reports_undefined_metrics(capsys):
+    evaluation = Evaluation(slices={'device_type': 3})
+    
+    assert evaluation.summary() == dict.fromkeys(SUMMARY_METRICS)
+    assert evaluation.report()['overall']['count'] == 0
+    print_report({'ctr': evaluation})
+    assert 'auc: n/a' in capsys.readouterr().out
+
+
+def test_one_class_group_has_no_auc(capsys):
+    evaluation = Evaluation(slices={'device_type': 3})
+    evaluation.update(np.zeros(50), np.full(50, 0.1), {'device_type': np.zeros(50, dtype=int)})
+    
+    summary = evaluation.summary()
+    assert summary['auc'] is None
+    assert summary['accuracy'] == 1.0
+    assert format_metric(summary['auc']) == 'n/a'
+    print_report({'cvr': evaluation})
+    assert 'auc by device_type: 0=n/a' in capsys.readouterr().out
+
+
+def test_write_evaluation_leaves_metrics_untouched(tmp_path):
+    metrics_path = tmp_path / 'metrics.json'
+    metrics_path.write_text('{"ctr": {}}')
+    stamp = metrics_path.stat().st_mtime_ns
+    
+    rng = np.random.default_rng(0)
+    evaluation = Evaluation(slices={}).update(rng.random(200) < 0.3, rng.random(200))
+    path = write_evaluation(str(tmp_path), {'ctr': evaluation})
+    
+    assert path == str(tmp_path / EVALUATION_FILE)
+    assert json.loads((tmp_path / EVALUATION_FILE).read_text())['ctr']['overall']['count'] == 200
+    assert metrics_path.stat().st_mtime_ns == stamp
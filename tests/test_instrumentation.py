@@ -0,0 +1,70 @@
+"""Metrics shared by forked workers are summed at scrape time"""
+
+import os
+
+from instrumentation import MetricsRegistry
+
+
+def make_registry(directory=None):
+    registry = MetricsRegistry(directory=directory)
+    registry.counter('requests_total', 'Requests', ('endpoint',))
+    registry.gauge('cache_entries', 'Cache entries', ())
+    registry.histogram('request_duration_seconds', 'Latency', ('endpoint',), [0.01, 0.1])
+    return registry
+
+
+def record(registry, requests):
+    for _ in range(requests):
+        registry.inc('requests_total', ('/predict',))
+        registry.observe('request_duration_seconds', ('/predict',), 0.05)
+    registry.set('cache_entries', (), requests)
+
+
+def run_worker(registry, requests, hold):
+    """Record in a forked child; returns its pid and, when holding it alive, the pipe that releases it"""
+    ready_read, ready_write = os.pipe()
+    release_read, release_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        record(registry, requests)
+        os.write(ready_write, b'x')
+        if hold:
+            os.read(release_read, 1)
+        os._exit(0)
+    os.read(ready_read, 1)
+    for fd in (ready_read, ready_write, release_read):
+        os.close(fd)
+    if not hold:
+        os.close(release_write)
+        os.waitpid(pid, 0)
+        return pid, None
+    return pid, release_write
+
+
+def test_local_registry_renders_its_own_series():
+    registry = make_registry()
+    record(registry, 3)
+    text = registry.render()
+    assert 'rtb_requests_total{endpoint="/predict"} 3' in text
+    assert 'rtb_cache_entries 3' in text
+    assert 'rtb_request_duration_seconds_bucket{endpoint="/predict",le="0.1"} 3' in text
+
+
+def test_shared_registry_sums_workers(tmp_path):
+    registry = make_registry(str(tmp_path))
+    exited, _ = run_worker(registry, 2, hold=False)
+    live, release = run_worker(registry, 5, hold=True)
+    try:
+        # Any process reading the directory sees every worker
+        text = registry.render()
+        assert 'rtb_requests_total{endpoint="/predict"} 7' in text
+        assert 'rtb_request_duration_seconds_count{endpoint="/predict"} 7' in text
+        assert 'rtb_request_duration_seconds_bucket{endpoint="/predict",le="0.01"} 0' in text
+        # Gauges count live workers only; the exited one's 2 entries are gone
+        assert 'rtb_cache_entries 5' in text
+        assert registry.quantiles('request_duration_seconds')[('/predict',)]['count'] == 7
+    finally:
+        os.write(release, b'x')
+        os.close(release)
+        os.waitpid(live, 0)
+    assert sorted(os.listdir(tmp_path)) == sorted([f'{exited}.db', f'{live}.db'])
@@ -0,0 +1,34 @@
+"""Micro-batched rows are scored with the context they were queued with"""
+
+import threading
+
+import numpy as np
+
+from micro_batch import MicroBatcher
+
+
+def test_batches_are_split_by_context():
+    calls = []
+    
+    def score(X, context):
+        calls.append((context, len(X)))
+        return (X[:, 0] * context, X[:, 0])
+    
+    batcher = MicroBatcher(score, max_batch_size=8, max_wait_ms=200)
+    results = {}
+    
+    def submit(i):
+        # Two model versions in flight at once, as around a hot swap
+        results[i] = batcher.score(np.array([[float(i)]], dtype=np.float32), 10 if i % 2 else 100)
+    
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    for i, (scaled, row) in results.items():
+        assert row[0] == i
+        assert scaled[0] == i * (10 if i % 2 else 100)
+    assert sorted(context for context, _ in calls) == [10, 100]
+    assert batcher.stats()['rows'] == 8
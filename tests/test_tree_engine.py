@@ -0,0 +1,65 @@
+"""Compiled and lookup engines against XGBoost's own predictions"""
+
+import numpy as np
+import pytest
+
+xgb = pytest.importorskip('xgboost')
+
+from tree_engine import FusedEnsemble, LookupTable, compile_booster
+
+
+def train_booster(rng, max_depth, num_features=5, rows=4000, missing_rate=0.1):
+    """Small binary:logistic booster trained on data with missing values"""
+    X = rng.normal(size=(rows, num_features)).astype(np.float32)
+    logits = X[:, 0] - 0.5 * X[:, 1] + 0.8 * (X[:, 2] > 0.3)
+    y = (rng.random(rows) < 1 / (1 + np.exp(-logits))).astype(int)
+    X[rng.random(X.shape) < missing_rate] = np.nan
+    params = {'objective': 'binary:logistic', 'max_depth': max_depth, 'learning_rate': 0.3,
+              'tree_method': 'hist', 'seed': 0}
+    return xgb.train(params, xgb.DMatrix(X, label=y), num_boost_round=20)
+
+
+def scoring_rows(rng, num_features=5, rows=2000):
+    X = rng.normal(size=(rows, num_features)).astype(np.float32)
+    X[rng.random(X.shape) < 0.2] = np.nan
+    X[0] = np.nan
+    return X
+
+
+def test_engines_match_xgboost_with_missing_values():
+    rng = np.random.default_rng(0)
+    ctr_booster, cvr_booster = train_booster(rng, 4), train_booster(rng, 3)
+    ctr, cvr = compile_booster(ctr_booster), compile_booster(cvr_booster)
+    X = scoring_rows(rng)
+    expected = [ctr_booster.inplace_predict(X), cvr_booster.inplace_predict(X)]
+    
+    np.testing.assert_allclose(ctr.predict(X), expected[0], rtol=0, atol=1e-6)
+    np.testing.assert_allclose(cvr.predict(X), expected[1], rtol=0, atol=1e-6)
+    for scores, target in zip(FusedEnsemble([ctr, cvr]).predict(X[:100]), expected):
+        np.testing.assert_allclose(scores, target[:100], rtol=0, atol=1e-6)
+    
+    lookup = LookupTable([ctr, cvr])
+    for scores, target, ensemble in zip(lookup.predict(X), expected, [ctr, cvr]):
+        np.testing.assert_allclose(scores, target, rtol=0, atol=1e-6)
+        np.testing.assert_array_equal(scores, ensemble.predict(X))
+
+
+def test_lookup_table_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    ensemble = compile_booster(train_booster(rng, 3))
+    LookupTable([ensemble]).save(tmp_path / 'score_table')
+    
+    loaded = LookupTable.load(tmp_path / 'score_table')
+    X = scoring_rows(rng)
+    assert loaded.handles_missing
+    assert all(offsets.dtype == np.int64 for offsets in loaded.offsets)
+    np.testing.assert_array_equal(loaded.predict(X)[0], ensemble.predict(X))
+
+
+def test_lookup_table_refuses_oversized_models():
+    ensemble = compile_booster(train_booster(np.random.default_rng(2), 6))
+    cells = LookupTable.estimate_cells([ensemble])
+    
+    with pytest.raises(ValueError, match='cells'):
+        LookupTable([ensemble], max_cells=cells - 1)
+    assert LookupTable([ensemble], max_cells=cells).table.size == cells
@@ -0,0 +1,421 @@
+"""
+RTB DSP Tree Engine
+Flat-array evaluator for trained XGBoost ensembles, needs only NumPy at serving time
+"""
+
+import json
+import os
+
+import numpy as np
+
+# Node arrays of a compiled ensemble and the dtypes they are evaluated in;
+# saved in those dtypes so memory maps are used as-is, without a copy
+NODE_ARRAYS = {
+    'roots': np.intp,
+    'feature': np.intp,
+    'threshold': np.float32,
+    'children': np.intp,
+    'default_left': np.bool_,
+    'value': np.float32,
+    'feature_importances': np.float32,
+}
+META_FILE = 'meta.json'
+
+# Rows walked per step; keeps the (rows, trees) work arrays cache sized
+BLOCK_ROWS = 4096
+
+# Above this many rows a fused walk saves no per-call overhead worth the
+# extra levels walked by shallower models, so each model is walked alone
+FUSED_MAX_ROWS = 512
+
+# Largest LookupTable built (float32 cells, ~4 bytes each); dense tables grow
+# exponentially with tree depth, so deep models are refused up front
+LOOKUP_MAX_CELLS = 2**28
+
+
+def save_arrays(path, arrays, meta):
+    """Write a directory of raw .npy arrays plus a JSON file of scalars"""
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        # Replace rather than overwrite: a server may have the old file mapped,
+        # and truncating a mapped file crashes its readers
+        target = os.path.join(path, f'{name}.npy')
+        np.save(target + '.tmp.npy', array)
+        os.replace(target + '.tmp.npy', target)
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_arrays(path, names, mmap=True):
+    """Map (or read) the arrays written by save_arrays; returns (arrays, meta)
+    
+    Mapped pages are read-only and live in the page cache, so every process
+    serving the same files shares one physical copy.
+    """
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    mmap_mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in names}
+    return arrays, meta
+
+
+class TreeEnsemble:
+    """Binary:logistic tree ensemble packed into flat node arrays"""
+    
+    def __init__(self, arrays):
+        # Children interleaved (left, right) so one gather picks the branch
+        if 'children' not in arrays:
+            arrays = dict(arrays, children=np.column_stack([arrays['left'], arrays['right']]).ravel())
+        
+        self.roots = np.asarray(arrays['roots'], dtype=np.intp)
+        self.feature = np.asarray(arrays['feature'], dtype=np.intp)
+        self.threshold = np.asarray(arrays['threshold'], dtype=np.float32)
+        self.children = np.asarray(arrays['children'], dtype=np.intp)
+        self.default_left = np.asarray(arrays['default_left'], dtype=bool)
+        self.value = np.asarray(arrays['value'], dtype=np.float32)
+        self.base_margin = float(arrays['base_margin'])
+        self.max_depth = int(arrays['max_depth'])
+        self.feature_importances_ = np.asarray(arrays['feature_importances'], dtype=np.float32)
+        
+        self.left = self.children[0::2]
+        self.right = self.children[1::2]
+    
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a compiled ensemble: a save() directory (memory-mapped) or a legacy .npz"""
+        if not os.path.isdir(path):
+            with np.load(path, allow_pickle=False) as data:
+                return cls({name: data[name] for name in data.files})
+        
+        arrays, meta = load_arrays(path, NODE_ARRAYS, mmap)
+        return cls(dict(arrays, **meta))
+    
+    def save(self, path):
+        """Write the node arrays as a directory of .npy files"""
+        arrays = {name: getattr(self, name) for name in NODE_ARRAYS if name != 'feature_importances'}
+        arrays['feature_importances'] = self.feature_importances_
+        save_arrays(path, arrays, {'base_margin': self.base_margin, 'max_depth': self.max_depth})
+    
+    @property
+    def num_trees(self):
+        return len(self.roots)
+    
+    def predict_leaves(self, X):
+        """Global leaf index reached in every tree, shape (n_rows, n_trees)
+        
+        All trees are walked together, one level per step. Leaves point back
+        at themselves, so after max_depth steps every row sits on a leaf.
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if len(X) > BLOCK_ROWS:
+            return np.concatenate([self.predict_leaves(X[start:start + BLOCK_ROWS])
+                                   for start in range(0, len(X), BLOCK_ROWS)])
+        
+        n_rows, n_features = X.shape
+        values = X.ravel()
+        row_offset = (np.arange(n_rows, dtype=np.intp) * n_features)[:, None]
+        has_missing = np.isnan(values).any()
+        
+        node = np.repeat(self.roots[None, :], n_rows, axis=0)
+        for _ in range(self.max_depth):
+            x = values[row_offset + self.feature[node]]
+            go_right = x >= self.threshold[node]  # False for NaN
+            if has_missing:
+                go_right = np.where(np.isnan(x), ~self.default_left[node], go_right)
+            node = self.children[2 * node + go_right]
+        return node
+    
+    def predict_margin(self, X):
+        """Raw log-odds score per row"""
+        return self.value[self.predict_leaves(X)].sum(axis=1, dtype=np.float64) + self.base_margin
+    
+    def predict(self, X):
+        """Positive-class probability per row (float64)"""
+        return 1.0 / (1.0 + np.exp(-self.predict_margin(X)))
+
+
+def compile_booster(booster, feature_importances=None):
+    """Pack an xgboost.Booster into a TreeEnsemble
+    
+    Reads the booster's JSON model, so thresholds and leaf values are the
+    exact float32 numbers XGBoost itself evaluates.
+    """
+    model = json.loads(booster.save_raw('json'))['learner']
+    if model['objective']['name'] != 'binary:logistic':
+        raise ValueError(f"Unsupported objective: {model['objective']['name']}")
+    
+    params = model['learner_model_param']
+    num_features = int(params['num_feature'])
+    base_score = float(params['base_score'].strip('[]'))
+    trees = model['gradient_booster']['model']['trees']
+    
+    roots, feature, threshold, left, right, default_left, value = [], [], [], [], [], [], []
+    max_depth = 0
+    offset = 0
+    for tree in trees:
+        if any(tree['split_type']):
+            raise ValueError("Categorical splits are not supported")
+        
+        tree_left = np.asarray(tree['left_children'], dtype=np.int32)
+        tree_right = np.asarray(tree['right_children'], dtype=np.int32)
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+        is_leaf = tree_left == -1
+        node_ids = np.arange(len(tree_left), dtype=np.int32)
+        
+        # Leaves loop onto themselves and carry their weight in split_conditions
+        roots.append(offset)
+        feature.append(np.where(is_leaf, 0, tree['split_indices']))
+        threshold.append(np.where(is_leaf, 0.0, conditions))
+        left.append(np.where(is_leaf, node_ids, tree_left) + offset)
+        right.append(np.where(is_leaf, node_ids, tree_right) + offset)
+        default_left.append(np.asarray(tree['default_left'], dtype=bool))
+        value.append(np.where(is_leaf, conditions, 0.0))
+        
+        # Depth of every node from its parent; parents come before children
+        depth = np.zeros(len(tree_left), dtype=np.int32)
+        for node in node_ids[1:]:
+            depth[node] = depth[tree['parents'][node]] + 1
+        max_depth = max(max_depth, int(depth.max()))
+        offset += len(tree_left)
+    
+    if feature_importances is None:
+        feature_importances = np.zeros(num_features, dtype=np.float32)
+    
+    return TreeEnsemble({
+        'roots': roots,
+        'feature': np.concatenate(feature),
+        'threshold': np.concatenate(threshold),
+        'children': np.column_stack([np.concatenate(left), np.concatenate(right)]).ravel(),
+        'default_left': np.concatenate(default_left),
+        'value': np.concatenate(value),
+        'base_margin': np.log(base_score / (1.0 - base_score)),
+        'max_depth': max_depth,
+        'feature_importances': feature_importances,
+    })
+
+
+class FusedEnsemble:
+    """Several compiled ensembles walked as one, so every model scores in a single traversal
+    
+    Node arrays are concatenated (child indices shifted), all trees of all
+    models descend together for the deepest model's depth, and leaf values
+    are then summed per model.
+    """
+    
+    def __init__(self, ensembles):
+        self.ensembles = ensembles
+        node_offsets = np.cumsum([0] + [len(ensemble.feature) for ensemble in ensembles[:-1]])
+        self.tree_starts = np.cumsum([0] + [ensemble.num_trees for ensemble in ensembles[:-1]])
+        self.base_margins = [ensemble.base_margin for ensemble in ensembles]
+        self.walker = TreeEnsemble({
+            'roots': np.concatenate([e.roots + offset for e, offset in zip(ensembles, node_offsets)]),
+            'feature': np.concatenate([e.feature for e in ensembles]),
+            'threshold': np.concatenate([e.threshold for e in ensembles]),
+            'children': np.concatenate([e.children + offset for e, offset in zip(ensembles, node_offsets)]),
+            'default_left': np.concatenate([e.default_left for e in ensembles]),
+            'value': np.concatenate([e.value for e in ensembles]),
+            'base_margin': 0.0,
+            'max_depth': max(e.max_depth for e in ensembles),
+            'feature_importances': ensembles[0].feature_importances_,
+        })
+    
+    def predict(self, X):
+        """Positive-class probabilities (float64), one array per ensemble"""
+        if len(X) > FUSED_MAX_ROWS:
+            return [ensemble.predict(X) for ensemble in self.ensembles]
+        
+        leaf_values = self.walker.value[self.walker.predict_leaves(X)]
+        margins = np.add.reduceat(leaf_values, self.tree_starts, axis=1, dtype=np.float64)
+        return [1.0 / (1.0 + np.exp(-(margins[:, i] + base_margin)))
+                for i, base_margin in enumerate(self.base_margins)]
+
+
+class LookupTable:
+    """Exact score tables over split-threshold buckets, for several ensembles at once
+    
+    Every feature is cut at the union of thresholds the trees split it on.
+    Inside one bucket no split can tell values apart, so each tree reduces
+    to a dense table over the buckets of the features it reads. Scoring is
+    one searchsorted per feature, integer adds, and one gather into the
+    concatenated tables. Leaf values and their summation order match
+    TreeEnsemble.predict bit for bit.
+    
+    Each feature's global bounds end in NaN, which sorts after every number,
+    so a missing value gets its own global bucket. Per tree it maps to the
+    value bucket that every split on the feature routes the same way as its
+    default direction (XGBoost's missing-value rule), or, if no bucket does,
+    to an extra missing bucket on that tree's axis.
+    """
+    
+    def __init__(self, ensembles, max_cells=LOOKUP_MAX_CELLS):
+        self.base_margins = [ensemble.base_margin for ensemble in ensembles]
+        trees = [(ensemble, root) for ensemble in ensembles for root in ensemble.roots]
+        self.model_trees = np.cumsum([0] + [ensemble.num_trees for ensemble in ensembles])
+        
+        # Size check before anything is allocated
+        layouts = [self._tree_layout(ensemble, root) for ensemble, root in trees]
+        num_cells = sum(self._num_cells(layout) for layout in layouts)
+        if num_cells > max_cells:
+            raise ValueError(f"Lookup table would need {num_cells:,} cells ({num_cells * 4 / 2**30:.1f} GiB), "
+                             f"over the limit of {max_cells:,}; use the compiled engine for these models")
+        
+        # Global bucket bounds per feature: union of split thresholds, then NaN
+        used = sorted({feature for layout in layouts for feature in layout})
+        self.features = np.asarray(used, dtype=np.intp)
+        self.bounds = [
+            np.append(np.unique(np.concatenate([layout[feature][0] for layout in layouts if feature in layout])),
+                      np.float32(np.nan))
+            for feature in used
+        ]
+        
+        # Per tree: dense table over local buckets, and per feature the cell
+        # offset each global bucket contributes (zero if the tree ignores it).
+        # int64, since a table past 2**31 cells must not wrap silently
+        self.offsets = [np.zeros((len(bounds) + 1, len(trees)), dtype=np.int64) for bounds in self.bounds]
+        tables = []
+        cell_offset = 0
+        for t, ((ensemble, root), layout) in enumerate(zip(trees, layouts)):
+            tree_features = sorted(layout)
+            table = np.empty(self._shape(layout), dtype=np.float32)
+            self._fill(ensemble, root, table, tree_features, [layout[feature] for feature in tree_features])
+            
+            for axis, feature in enumerate(tree_features):
+                bounds, nan_bucket = layout[feature]
+                k = used.index(feature)
+                representatives = np.concatenate([[-np.inf], self.bounds[k][:-1]]).astype(np.float32)
+                local = np.searchsorted(bounds, representatives, side='right')
+                local = np.append(local, len(bounds) + 1 if nan_bucket is None else nan_bucket)
+                self.offsets[k][:, t] = local * (table.strides[axis] // table.itemsize)
+            self.offsets[0][:, t] += cell_offset
+            
+            tables.append(table.ravel())
+            cell_offset += table.size
+        self.table = np.concatenate(tables)
+        self.handles_missing = True
+    
+    @staticmethod
+    def _shape(layout):
+        """Table shape of one tree: value buckets per feature, plus a missing one where needed"""
+        return [len(bounds) + 1 + (nan_bucket is None) for _, (bounds, nan_bucket) in sorted(layout.items())]
+    
+    @classmethod
+    def _num_cells(cls, layout):
+        return int(np.prod(cls._shape(layout), dtype=np.float64))
+    
+    @classmethod
+    def estimate_cells(cls, ensembles):
+        """Cells a LookupTable over these ensembles would hold, without building it"""
+        return sum(cls._num_cells(cls._tree_layout(ensemble, root))
+                   for ensemble in ensembles for root in ensemble.roots)
+    
+    @staticmethod
+    def _tree_layout(ensemble, root):
+        """Map feature -> (sorted split thresholds, value bucket NaN shares or None)"""
+        splits = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            left, right = ensemble.left[node], ensemble.right[node]
+            if left == node:
+                continue
+            splits.setdefault(int(ensemble.feature[node]), []).append(
+                (ensemble.threshold[node], bool(ensemble.default_left[node]))
+            )
+            stack.extend([left, right])
+        
+        layout = {}
+        for feature, feature_splits in splits.items():
+            bounds = np.unique(np.asarray([threshold for threshold, _ in feature_splits], dtype=np.float32))
+            # Bucket b goes left at the split on bounds[i] exactly when b <= i
+            lowest, highest = 0, len(bounds)
+            for threshold, default_left in feature_splits:
+                i = int(np.searchsorted(bounds, threshold))
+                if default_left:
+                    highest = min(highest, i)
+                else:
+                    lowest = max(lowest, i + 1)
+            layout[feature] = (bounds, lowest if lowest <= highest else None)
+        return layout
+    
+    @staticmethod
+    def _fill(ensemble, root, table, tree_features, axes):
+        """Write each leaf value into the block of buckets that reaches it
+        
+        A node's reach per axis is a run of value buckets [lo, hi) plus,
+        on axes with a missing bucket, whether missing values get there.
+        """
+        if not tree_features:
+            table[()] = ensemble.value[root]
+            return
+        stack = [(root, [(0, len(bounds) + 1, nan_bucket is None) for bounds, nan_bucket in axes])]
+        while stack:
+            node, ranges = stack.pop()
+            left, right = ensemble.left[node], ensemble.right[node]
+            if left == node:
+                index = [
+                    np.r_[lo:hi, [len(bounds) + 1] if missing else []].astype(np.intp)
+                    for (lo, hi, missing), (bounds, _) in zip(ranges, axes)
+                ]
+                table[np.ix_(*index)] = ensemble.value[node]
+                continue
+            
+            # Buckets up to the threshold's own index lie strictly below it
+            axis = tree_features.index(int(ensemble.feature[node]))
+            bounds = axes[axis][0]
+            cut = int(np.searchsorted(bounds, ensemble.threshold[node])) + 1
+            lo, hi, missing = ranges[axis]
+            default_left = bool(ensemble.default_left[node])
+            for child, child_range in [(left, (lo, min(hi, cut), missing and default_left)),
+                                       (right, (max(lo, cut), hi, missing and not default_left))]:
+                if child_range[0] < child_range[1] or child_range[2]:
+                    stack.append((child, ranges[:axis] + [child_range] + ranges[axis + 1:]))
+    
+    @property
+    def nbytes(self):
+        return self.table.nbytes + sum(offsets.nbytes for offsets in self.offsets)
+    
+    def save(self, path):
+        """Write the tables as a directory of .npy files"""
+        arrays = {'features': self.features, 'model_trees': self.model_trees, 'table': self.table}
+        for k in range(len(self.features)):
+            arrays[f'bounds_{k}'] = self.bounds[k]
+            arrays[f'offsets_{k}'] = self.offsets[k]
+        save_arrays(path, arrays, {'base_margins': self.base_margins, 'num_features': len(self.features),
+                                   'missing_bucket': True})
+    
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Map tables written by save() instead of rebuilding them"""
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            num_features = json.load(f)['num_features']
+        names = ['features', 'model_trees', 'table']
+        names += [f'{prefix}_{k}' for k in range(num_features) for prefix in ('bounds', 'offsets')]
+        arrays, meta = load_arrays(path, names, mmap)
+        
+        lookup = cls.__new__(cls)
+        lookup.features = arrays['features']
+        lookup.model_trees = arrays['model_trees']
+        lookup.table = arrays['table']
+        lookup.bounds = [arrays[f'bounds_{k}'] for k in range(num_features)]
+        lookup.offsets = [arrays[f'offsets_{k}'] for k in range(num_features)]
+        lookup.base_margins = meta['base_margins']
+        # Tables saved before the missing bucket existed send NaN to the top bucket
+        lookup.handles_missing = meta.get('missing_bucket', False)
+        return lookup
+    
+    def predict(self, X):
+        """Positive-class probabilities per ensemble, as a list of float64 arrays"""
+        X = np.asarray(X, dtype=np.float32)
+        if len(X) > BLOCK_ROWS:
+            blocks = [self.predict(X[start:start + BLOCK_ROWS]) for start in range(0, len(X), BLOCK_ROWS)]
+            return [np.concatenate(scores) for scores in zip(*blocks)]
+        
+        cells = self.offsets[0][np.searchsorted(self.bounds[0], X[:, self.features[0]], side='right')]
+        for k in range(1, len(self.features)):
+            cells += self.offsets[k][np.searchsorted(self.bounds[k], X[:, self.features[k]], side='right')]
+        values = self.table[cells]
+        
+        return [
+            1.0 / (1.0 + np.exp(-(values[:, start:end].sum(axis=1, dtype=np.float64) + base_margin)))
+            for start, end, base_margin in zip(self.model_trees[:-1], self.model_trees[1:], self.base_margins)
+        ]